@@ -0,0 +1,120 @@
+import asyncio
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.db import close_old_connections, connection
+from django.shortcuts import get_object_or_404, render
+
+from .fragments import apply_review_state, favorited_review_ids, review_counts
+from .instrumentation import track_queries
+from .models import Product, Profile, Review
+from .routers import replica_reads
+from . import views
+
+#読み込みの多いページの非同期版（ASGI で ASYNC_VIEWS = True のときに urls.py で使う）
+#互いに依存しないクエリ（セッション・ユーザーの読み込みを含む）を同時に実行してから、テンプレートを描画する
+#Django の非同期ORM（aget() など）は1つのスレッドで順に実行されるため、同時に実行するクエリはそれぞれ別のスレッド・接続で行う
+
+
+def _in_atomic_block():
+    return connection.in_atomic_block
+
+
+class Queries:
+    @classmethod
+    async def start(cls):
+        queries = cls()
+        #トランザクションの途中（テストなど）は、別の接続からは未コミットの内容が見えないため同じ接続で順に実行する
+        queries.concurrent = not await sync_to_async(_in_atomic_block)()
+        return queries
+
+    async def run(self, func, *args, **kwargs):
+        if not self.concurrent:
+            return await sync_to_async(func)(*args, **kwargs)
+        return await sync_to_async(partial(_run_in_thread, func), thread_sensitive=False)(*args, **kwargs)
+
+
+def _run_in_thread(func, *args, **kwargs):
+    #スレッドプールのスレッドでも、リクエストと同じように接続を管理し、SQLを計測する
+    close_old_connections()
+    try:
+        with track_queries():
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def _render(request, user, template_name, context):
+    #テンプレートから request.user を参照したときに、ユーザーを読み込み直さない
+    request.user = user
+    return await sync_to_async(render)(request, template_name, context)
+
+
+@replica_reads
+async def home(request):
+    queries = await Queries.start()
+    #新着レビューの断片はログインの有無で分けてキャッシュするため、ユーザーの読み込みを待つ
+    user, ranking_html = await asyncio.gather(
+        request.auser(),
+        queries.run(views.home_ranking_html),
+    )
+    request.user = user
+    latest = await queries.run(views.home_latest_reviews, request)
+
+    counts, favorited_ids = await asyncio.gather(
+        queries.run(review_counts, latest["review_ids"]),
+        queries.run(favorited_review_ids, user, latest["review_ids"]),
+    )
+    return await _render(request, user, "form_app/home.html", {
+        "ranking_html": ranking_html,
+        "latest_reviews_html": apply_review_state(request, latest["html"], counts, favorited_ids),
+    })
+
+
+@replica_reads
+async def ranking(request, category=None):
+    queries = await Queries.start()
+    user, context = await asyncio.gather(
+        request.auser(),
+        queries.run(views.build_ranking_context, request, category),
+    )
+    return await _render(request, user, "form_app/ranking.html", context)
+
+
+@replica_reads
+async def product_detail(request, pk):
+    queries = await Queries.start()
+    user, product, (items, next_cursor) = await asyncio.gather(
+        request.auser(),
+        queries.run(get_object_or_404, Product, pk=pk),
+        queries.run(views.review_feed_page, request, "product", pk),
+    )
+    items = await queries.run(views.attach_favorite_state, items, user)
+
+    context = views.review_feed_context(request, "product", items, next_cursor, product.id)
+    context["product"] = product
+    return await _render(request, user, "form_app/product_detail.html", context)
+
+
+def latest_reviews(user):
+    return list(
+        Review.objects
+        .filter(user=user, is_draft=False)
+        .select_related("product")
+        .order_by("-posted_at")[:1]
+    )
+
+
+@login_required
+async def my_page(request):
+    queries = await Queries.start()
+    user = await request.auser()
+    (profile, _), reviews = await asyncio.gather(
+        queries.run(Profile.objects.get_or_create, user=user),
+        queries.run(latest_reviews, user),
+    )
+    return await _render(request, user, "form_app/my_page.html", {
+        "profile": profile,
+        "reviews": reviews,
+    })
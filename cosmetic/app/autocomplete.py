@@ -0,0 +1,65 @@
+import threading
+from bisect import bisect_left
+
+from .models import Product
+from .search import normalize
+from .versions import CATALOG, get_version
+
+AUTOCOMPLETE_LIMIT = 10
+
+
+class PrefixIndex:
+    #正規化したキーの昇順配列（商品名全体と、空白区切りの各語をキーにする）
+    def __init__(self, rows):
+        entries = []
+        for product_id, name in rows:
+            key = normalize(name)
+            words = key.split()
+            for i in range(len(words)):
+                entries.append((" ".join(words[i:]), product_id))
+        entries.sort()
+
+        self.keys = [key for key, _ in entries]
+        self.product_ids = [product_id for _, product_id in entries]
+        self.names = dict(rows)
+
+    def lookup(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        prefix = " ".join(normalize(prefix).split())
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix) and len(results) < limit:
+            product_id = self.product_ids[i]
+            if product_id not in seen:
+                seen.add(product_id)
+                results.append((product_id, self.names[product_id]))
+            i += 1
+        return results
+
+
+_index = None
+_index_version = None
+_lock = threading.Lock()
+
+
+def get_index():
+    #商品カタログのバージョンが変わったときだけ作り直す（ワーカーごと）
+    global _index, _index_version
+
+    version = get_version(CATALOG)
+    if _index is not None and _index_version == version:
+        return _index
+
+    with _lock:
+        if _index is None or _index_version != version:
+            rows = list(Product.objects.values_list("id", "cosme_name").iterator(chunk_size=2000))
+            _index = PrefixIndex(rows)
+            _index_version = version
+    return _index
+
+
+def suggest(prefix, limit=AUTOCOMPLETE_LIMIT):
+    return get_index().lookup(prefix, limit)
@@ -0,0 +1,350 @@
+import asyncio
+import contextvars
+import io
+import multiprocessing
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import unquote
+from wsgiref.util import setup_testing_defaults
+
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .models import AGE_CHOICES, SKIN_CHOICES, Product, Profile
+from .search import split_terms
+
+#本番に近いアクセスの比率（ビュー名: 重み）
+DEFAULT_MIX = {
+    "home": 30,
+    "ranking": 20,
+    "product_detail": 35,
+    "product_search": 15,
+}
+
+HOST = "localhost"
+
+
+class Catalog:
+    #URLを組み立てるための商品ID・カテゴリー・検索語（ワーカーへ渡せるよう素の値のみ持つ）
+    def __init__(self, product_ids, categories, terms):
+        self.product_ids = product_ids
+        self.categories = categories
+        self.terms = terms
+
+    @classmethod
+    def load(cls, limit=1000):
+        #レビューの多い商品ほどよく見られる想定で、件数順に取得
+        products = list(
+            Product.objects
+            .order_by("-review_count", "id")
+            .values_list("id", "cosme_name", "category")[:limit]
+        )
+        terms = sorted({term for _, name, _ in products for term in split_terms(name) if len(term) >= 2})
+        return cls(
+            product_ids=[product_id for product_id, _, _ in products],
+            categories=sorted({category for _, _, category in products}),
+            terms=terms,
+        )
+
+    def url(self, view, rng):
+        if view == "home":
+            return reverse("form_app:home")
+        if view == "ranking":
+            if self.categories and rng.random() < 0.5:
+                path = reverse("form_app:ranking_by_category", args=[rng.choice(self.categories)])
+            else:
+                path = reverse("form_app:ranking_all")
+            if rng.random() < 0.3:
+                path += f"?skin_type={rng.choice(SKIN_CHOICES)[0]}&age={rng.choice(AGE_CHOICES)[0]}"
+            return path
+        if view == "product_detail":
+            #上位の商品ほど選ばれやすくする
+            index = min(int(rng.paretovariate(1.2)) - 1, len(self.product_ids) - 1)
+            return reverse("form_app:product_detail", args=[self.product_ids[index]])
+        if view == "product_search":
+            return reverse("form_app:product_search") + "?" + urlencode({"q": rng.choice(self.terms)})
+        raise ValueError(f"未対応のビューです: {view}")
+
+
+def login_cookies(count):
+    #ログイン済みセッションのCookieを用意（プロフィールのあるユーザーから）
+    cookies = []
+    for profile in Profile.objects.select_related("user").order_by("id")[:count]:
+        client = Client()
+        client.force_login(profile.user)
+        cookie = client.cookies[settings.SESSION_COOKIE_NAME]
+        cookies.append(f"{cookie.key}={cookie.value}")
+    return cookies
+
+
+def _environ(url, cookie):
+    path, _, query = url.partition("?")
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "HTTP_HOST": HOST,
+        "wsgi.input": io.BytesIO(),
+    }
+    if cookie:
+        environ["HTTP_COOKIE"] = cookie
+    setup_testing_defaults(environ)
+    return environ
+
+
+def plan(catalog, mix, count, cookies, auth_ratio, rng):
+    #送るリクエストの [(ビュー名, URL, Cookie)]
+    views = list(mix)
+    weights = [mix[view] for view in views]
+    requests = []
+    for _ in range(count):
+        view = rng.choices(views, weights)[0]
+        cookie = rng.choice(cookies) if cookies and rng.random() < auth_ratio else None
+        requests.append((view, catalog.url(view, rng), cookie))
+    return requests
+
+
+_query_count = contextvars.ContextVar("benchmark_query_count", default=None)
+
+
+@contextmanager
+def counting_queries(delay=0):
+    #すべての接続（ASGIではリクエストごとにスレッドが変わる）でクエリを数える。数え先はリクエストごとに _query_count で切り替える
+    #delay 秒の待ちを加えると、ネットワーク越しのDB（PostgreSQL など）の往復を模擬できる
+    def count_query(execute, sql, params, many, context):
+        counter = _query_count.get()
+        if counter is not None:
+            counter[0] += 1
+        if delay:
+            time.sleep(delay)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        #execute_wrapper() は末尾から外すため先頭に置く（再接続のたびに呼ばれるので1回だけ）
+        if count_query not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, count_query)
+
+    for conn in connections.all():
+        install(None, conn)
+    connection_created.connect(install)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(install)
+        for conn in connections.all():
+            if count_query in conn.execute_wrappers:
+                conn.execute_wrappers.remove(count_query)
+
+
+def run(catalog, mix, requests, cookies, auth_ratio, seed, warmup=0, query_delay=0):
+    #WSGIアプリケーションへ直接リクエストを送り、([(ビュー名, 秒, クエリ数, ステータス)], 計測時間) を返す
+    #最初の warmup 件（キャッシュ・索引の準備分）は計測しない
+    #django.setup() は済んでいる（コマンド・子プロセスの initializer）。get_wsgi_application() はログ設定などをやり直すため使わない
+    application = WSGIHandler()
+    planned = plan(catalog, mix, warmup + requests, cookies, auth_ratio, random.Random(seed))
+
+    samples = []
+    started = time.perf_counter()
+    with counting_queries(query_delay):
+        for i, (view, url, cookie) in enumerate(planned):
+            if i == warmup:
+                started = time.perf_counter()
+            environ = _environ(url, cookie)
+            status = []
+
+            counter = [0]
+            _query_count.set(counter)
+            request_started = time.perf_counter()
+            body = application(environ, lambda code, headers, exc_info=None: status.append(code))
+            for _ in body:
+                pass
+            if hasattr(body, "close"):
+                body.close()
+
+            if i >= warmup:
+                samples.append((
+                    view,
+                    time.perf_counter() - request_started,
+                    counter[0],
+                    int(status[0].split()[0]),
+                ))
+    return samples, time.perf_counter() - started
+
+
+def _scope(url, cookie):
+    path, _, query = url.partition("?")
+    headers = [(b"host", HOST.encode())]
+    if cookie:
+        headers.append((b"cookie", cookie.encode()))
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": unquote(path),
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": (HOST, 80),
+    }
+
+
+async def _asgi_get(application, url, cookie):
+    status = []
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        #応答を返し終えるまで切断しない（Django が待ち受けを取り消す）
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await application(_scope(url, cookie), receive, send)
+    return status[0]
+
+
+def run_asgi(catalog, mix, requests, cookies, auth_ratio, seed, warmup=0, query_delay=0, concurrency=1):
+    #ASGIアプリケーションへ concurrency 件ずつ同時にリクエストを送る（戻り値は run() と同じ）
+    #URLの読み込み前に ASYNC_VIEWS を有効にしたプロセスで実行する
+    with counting_queries(query_delay):
+        return asyncio.run(_run_asgi(catalog, mix, requests, cookies, auth_ratio, seed, warmup, concurrency))
+
+
+async def _run_asgi(catalog, mix, requests, cookies, auth_ratio, seed, warmup, concurrency):
+    application = ASGIHandler()
+    rng = random.Random(seed)
+    warmup_requests = plan(catalog, mix, warmup, cookies, auth_ratio, rng)
+    measured_requests = plan(catalog, mix, requests, cookies, auth_ratio, rng)
+    samples = []
+
+    async def send_all(planned, record):
+        pending = iter(planned)
+
+        async def client():
+            #次のリクエストを順に取り出す（クライアントごとに前の応答を待ってから送る）
+            for view, url, cookie in pending:
+                counter = [0]
+                _query_count.set(counter)
+                request_started = time.perf_counter()
+                status = await _asgi_get(application, url, cookie)
+                if record:
+                    samples.append((view, time.perf_counter() - request_started, counter[0], status))
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    await send_all(warmup_requests, False)
+    started = time.perf_counter()
+    await send_all(measured_requests, True)
+    return samples, time.perf_counter() - started
+
+
+def _run_worker(job):
+    server, args = job
+    return (run_asgi if server == "asgi" else run)(*args)
+
+
+def percentile(sorted_values, percent):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method="inclusive")[percent - 1]
+
+
+def summarize(samples, elapsed):
+    def stats(rows):
+        latencies = sorted(row[1] * 1000 for row in rows)
+        queries = [row[2] for row in rows]
+        return {
+            "requests": len(rows),
+            "throughput": round(len(rows) / elapsed, 2),
+            "mean_ms": round(statistics.fmean(latencies), 3),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "queries_mean": round(statistics.fmean(queries), 2),
+            "queries_max": max(queries),
+            "errors": sum(1 for row in rows if row[3] >= 500),
+        }
+
+    by_view = defaultdict(list)
+    for row in samples:
+        by_view[row[0]].append(row)
+
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "total": stats(samples),
+        "views": {view: stats(rows) for view, rows in sorted(by_view.items())},
+    }
+
+
+def benchmark(mix=None, requests=1000, workers=1, auth_ratio=0.3, sessions=20, warmup=50, seed=0,
+              server="wsgi", concurrency=1, query_delay_ms=0):
+    mix = mix or DEFAULT_MIX
+    if requests < workers:
+        #計測するリクエストのないプロセスができないように
+        raise ValueError("--requests は --workers 以上を指定してください")
+    catalog = Catalog.load()
+    if not catalog.product_ids:
+        raise ValueError("商品がありません（generate_load_data でデータを作成してください）")
+    cookies = login_cookies(sessions) if auth_ratio > 0 else []
+
+    if server == "wsgi" and workers == 1:
+        samples, elapsed = run(catalog, mix, requests, cookies, auth_ratio, seed, warmup, query_delay_ms / 1000)
+    else:
+        jobs = []
+        for i in range(workers):
+            args = [catalog, mix, requests // workers + (1 if i < requests % workers else 0),
+                    cookies, auth_ratio, seed + i, warmup, query_delay_ms / 1000]
+            if server == "asgi":
+                args.append(concurrency)
+            jobs.append((server, args))
+        #ASGI では非同期版のビューを使う。環境変数は、起動時に引き継がれる子プロセスでだけ切り替える
+        async_views = os.environ.get("ASYNC_VIEWS")
+        os.environ["ASYNC_VIEWS"] = "1" if server == "asgi" else "0"
+        try:
+            #各プロセスは並行して動くため、全体の時間は最も遅いプロセスの計測時間とする
+            with multiprocessing.get_context("spawn").Pool(workers, initializer=django.setup) as pool:
+                results = pool.map(_run_worker, jobs)
+        finally:
+            if async_views is None:
+                os.environ.pop("ASYNC_VIEWS")
+            else:
+                os.environ["ASYNC_VIEWS"] = async_views
+        samples = [row for rows, _ in results for row in rows]
+        elapsed = max(worker_elapsed for _, worker_elapsed in results)
+
+    report = summarize(samples, elapsed)
+    report["config"] = {
+        "server": server,
+        "concurrency": concurrency if server == "asgi" else 1,
+        "query_delay_ms": query_delay_ms,
+        "mix": mix,
+        "requests": requests,
+        "workers": workers,
+        "auth_ratio": auth_ratio,
+        "sessions": len(cookies),
+        "warmup": warmup,
+        "seed": seed,
+        "debug": settings.DEBUG,
+        "database": connection.vendor,
+    }
+    return report
@@ -0,0 +1,36 @@
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+#SQLite の書き込み競合への対策
+#書き込みのトランザクションは BEGIN IMMEDIATE で始め（settings の transaction_mode）、
+#busy_timeout を過ぎても書き込みロックが取れなかったときは、トランザクションごとやり直す
+
+
+def is_lock_error(exc):
+    message = str(exc)
+    return "database is locked" in message or "database table is locked" in message
+
+
+def retry_on_lock(view_func):
+    #POST の処理全体を1つのトランザクションにし、ロック待ちで失敗したら DB_LOCK_RETRIES 回までやり直す
+    #フォームの表示（GET）はトランザクションにしない（BEGIN IMMEDIATE で書き込みロックを取ったまま描画しないように）
+    @wraps(view_func)
+    def _wrapped(request, *args, **kwargs):
+        if request.method != "POST" or connection.in_atomic_block:
+            #外側のトランザクションの途中からはやり直せない
+            return view_func(request, *args, **kwargs)
+
+        for attempt in range(settings.DB_LOCK_RETRIES + 1):
+            try:
+                with transaction.atomic():
+                    return view_func(request, *args, **kwargs)
+            except OperationalError as exc:
+                if attempt == settings.DB_LOCK_RETRIES or not is_lock_error(exc):
+                    raise
+            #同時にやり直して再び競合しないよう、待ち時間をずらす
+            time.sleep(settings.DB_LOCK_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+    return _wrapped
@@ -1,9 +1,14 @@
+import zipfile
+
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm,AuthenticationForm,PasswordChangeForm
 from django.contrib.auth import authenticate, get_user_model
-from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.files.storage import default_storage
 from .models import AGE_CHOICES, GENDER_CHOICES, SKIN_CHOICES,Product,Review,Profile
+from .product_io import product_format
 
 User = get_user_model()
 
@@ -208,6 +213,106 @@ class CosmeForm(AddFormInputClassMixin,CosmeCreateForm):
         self.add_form_input_class()
 
 
+#商品の一括登録（1行分の検証。CosmeForm と同じ規則）
+#画像はアップロードの代わりに、保存済みの画像の名前（stored_image）でも指定できる。更新では省略すると元の画像のまま
+class ProductImportForm(CosmeForm):
+    image = forms.ImageField(label='画像', required=False)
+
+    def __init__(self, *args, stored_image=None, **kwargs):
+        self.stored_image = stored_image
+        super().__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned = super().clean()
+        if self.stored_image:
+            if not self.stored_image_exists():
+                self.add_error("image", f"画像が見つかりません: {self.stored_image}")
+        elif "image" not in self.errors and not cleaned.get("image") and not self.instance.image:
+            self.add_error("image", CosmeForm.base_fields["image"].error_messages["required"])
+        return cleaned
+
+    def stored_image_exists(self):
+        #商品画像の保存先以外（「../」を含む名前など）は、1行のエラーとして扱う
+        upload_to = Product._meta.get_field("image").upload_to
+        if not self.stored_image.startswith(upload_to):
+            return False
+        try:
+            return default_storage.exists(self.stored_image)
+        except (SuspiciousFileOperation, ValueError):
+            return False
+
+
+class ProductImportUploadForm(AddFormInputClassMixin, forms.Form):
+    file = forms.FileField(
+        label='商品ファイル（CSV / JSON Lines）',
+        error_messages={
+            'required': 'ファイルを選択してください。'
+        })
+    archive = forms.FileField(label='画像（ZIP）', required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.label_suffix = ""
+        self.add_form_input_class()
+
+    def clean_file(self):
+        file = self.cleaned_data["file"]
+        if product_format(file.name) is None:
+            raise ValidationError("拡張子が .csv / .jsonl のファイルを選択してください。")
+        check_import_size(file, settings.PRODUCT_IMPORT_MAX_FILE_SIZE)
+        return file
+
+    def clean_archive(self):
+        archive = self.cleaned_data["archive"]
+        if archive and not zipfile.is_zipfile(archive):
+            raise ValidationError("ZIPファイルを選択してください。")
+        if archive:
+            check_import_size(archive, settings.PRODUCT_IMPORT_MAX_ARCHIVE_SIZE)
+        return archive
+
+
+def check_import_size(file, limit):
+    #画面からの登録はリクエストの中で行うため、大きなファイルはコマンドで登録してもらう
+    if file.size > limit:
+        raise ValidationError(
+            f"{limit // (1024 * 1024)}MBを超えるファイルは、manage.py import_products で登録してください。"
+        )
+
+
+#レビューの書き出しの絞り込み（すべて任意）
+class ReviewExportForm(AddFormInputClassMixin, forms.Form):
+    FORMAT_CHOICES = (
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+    )
+
+    date_from = forms.DateField(
+        label='投稿日（から）',
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(
+        label='投稿日（まで）',
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'}))
+    category = forms.ChoiceField(
+        label='カテゴリー',
+        choices=(('', 'すべて'),) + CosmeForm.CATEGORY_CHOICES[1:],
+        required=False)
+    format = forms.ChoiceField(choices=FORMAT_CHOICES)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.label_suffix = ""
+        self.add_form_input_class()
+
+    def clean(self):
+        cleaned = super().clean()
+        date_from, date_to = cleaned.get('date_from'), cleaned.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            self.add_error('date_to', '開始日以降の日付を入力してください。')
+        return cleaned
+
+
 class ReviewForm(forms.ModelForm):
     goodpoint_comment = forms.CharField(
         required=False,
@@ -0,0 +1,80 @@
+import re
+
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+from .metrics import inc
+from .models import Review, ReviewFavorite
+from .routers import primary_reads
+from .versions import get_version
+
+#断片は全ワーカープロセスで共有するキャッシュ（settings の CACHES）に保存し、キーに含めるバージョン番号で無効化する
+#（どのワーカーで商品・レビューが更新されても、他のワーカーは次の表示から新しいキーで描画し直す）
+FRAGMENT_TIMEOUT = 60 * 60
+
+#キャッシュする断片にはユーザーごとの内容を入れず、目印を置いて表示時に差し込む
+CSRF_PLACEHOLDER = "<!--csrf-token-->"
+REVIEW_PLACEHOLDER_RE = re.compile(r"<!--favorite-(mark|count):(\d+)-->")
+
+
+def fragment_key(name, *versions, vary_on=()):
+    parts = [str(get_version(version)) for version in versions] + [str(v) for v in vary_on]
+    return f"fragment:{name}:" + ":".join(parts)
+
+
+def cached_fragment(key, render):
+    value = cache.get(key)
+    inc("app_cache_requests_total", cache="fragment", result="miss" if value is None else "hit")
+    if value is None:
+        #新しいバージョンのキーで遅延したレプリカの内容を保存しないよう、プライマリから描画する
+        with primary_reads():
+            value = render()
+        cache.set(key, value, FRAGMENT_TIMEOUT)
+    return value
+
+
+def review_counts(review_ids):
+    return dict(
+        Review.objects
+        .filter(pk__in=review_ids)
+        .values_list("id", "favorite_count")
+    )
+
+
+def favorited_review_ids(user, review_ids):
+    if not user.is_authenticated or not review_ids:
+        return set()
+    return set(
+        ReviewFavorite.objects
+        .filter(user=user, review_id__in=review_ids)
+        .values_list("review_id", flat=True)
+    )
+
+
+def overlay_review_state(request, html, review_ids):
+    #お気に入り数と、ログインユーザーのお気に入り状態（♥/♡）を差し込む
+    return apply_review_state(
+        request, html,
+        review_counts(review_ids),
+        favorited_review_ids(request.user, review_ids),
+    )
+
+
+def apply_review_state(request, html, counts, favorited_ids):
+    #2つのクエリは互いに依存しないため、非同期ビューでは同時に実行してから差し込む
+    def replace(match):
+        kind, review_id = match.group(1), int(match.group(2))
+        if kind == "mark":
+            return "♥" if review_id in favorited_ids else "♡"
+        return str(counts.get(review_id, 0))
+
+    html = REVIEW_PLACEHOLDER_RE.sub(replace, html)
+    if CSRF_PLACEHOLDER in html:
+        csrf_input = format_html(
+            '<input type="hidden" name="csrfmiddlewaretoken" value="{}">',
+            get_token(request),
+        )
+        html = html.replace(CSRF_PLACEHOLDER, csrf_input)
+    return mark_safe(html)
@@ -0,0 +1,149 @@
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+from . import thumbnails
+from .models import Product, Review
+from .versions import CATALOG, REVIEWS, bump_version
+
+logger = logging.getLogger(__name__)
+
+MAX_DIMENSION = 2048 #長辺をこれ以下に縮小
+JPEG_QUALITY = 85
+
+
+def process_image(name):
+    #回転補正・メタデータ除去・再圧縮した画像を別名で保存し、その名前を返す
+    with default_storage.open(name, "rb") as source:
+        image = Image.open(source)
+        image.draft("RGB", (MAX_DIMENSION, MAX_DIMENSION))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.Resampling.LANCZOS)
+
+        #EXIF（撮影位置など）は渡さず、色の再現に必要なICCプロファイルのみ残す
+        options = {"icc_profile": image.info.get("icc_profile")}
+        out = io.BytesIO()
+        if "A" in image.getbands() or "transparency" in image.info:
+            image.convert("RGBA").save(out, "PNG", optimize=True, **options)
+            ext = "png"
+        else:
+            image.convert("RGB").save(
+                out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True, **options
+            )
+            ext = "jpg"
+
+    processed = default_storage.save(
+        f"{os.path.splitext(name)[0]}.{ext}", ContentFile(out.getvalue())
+    )
+
+    #一覧で使う縮小画像も先に作っておく
+    for fmt in thumbnails.FORMATS:
+        for width in thumbnails.WIDTH_BUCKETS:
+            thumbnails.render_thumbnail(processed, width, fmt)
+
+    return processed
+
+
+_lock = threading.Lock()
+_processes = None
+_threads = None
+
+
+def _executors():
+    global _processes, _threads
+    with _lock:
+        if _processes is None:
+            workers = settings.IMAGE_PROCESSING_WORKERS
+            #スレッドを持つWebサーバープロセスをforkしないよう、spawnで起動
+            _processes = ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+            #処理結果をDBへ反映する側（プロセスの完了待ち）
+            _threads = ThreadPoolExecutor(workers)
+    return _processes, _threads
+
+
+def wait():
+    #処理待ちの画像がすべて終わるまで待つ（一括登録のコマンドなど、終了前に呼ぶ）
+    global _processes, _threads
+    with _lock:
+        processes, threads = _processes, _threads
+        _processes = _threads = None
+    if threads is not None:
+        threads.shutdown(wait=True)
+        processes.shutdown(wait=True)
+
+
+def _finish(model, pk, field, name, processed):
+    #処理中に画像が差し替え・削除されていなければ、処理済みの画像に付け替える
+    if model.objects.filter(pk=pk, **{field: name}).update(**{field: processed, f"{field}_processed": True}):
+        default_storage.delete(name)
+        bump_version(CATALOG if model is Product else REVIEWS)
+    else:
+        default_storage.delete(processed)
+
+
+def _process_now(model, pk, field, name):
+    try:
+        _finish(model, pk, field, name, process_image(name))
+    except Exception:
+        logger.exception("画像の処理に失敗しました: %s", name)
+        return False
+    return True
+
+
+def _process_in_pool(model, pk, field, name):
+    processes, _ = _executors()
+    try:
+        processed = processes.submit(process_image, name).result()
+        _finish(model, pk, field, name, processed)
+    except Exception:
+        logger.exception("画像の処理に失敗しました: %s", name)
+    finally:
+        connection.close()
+
+
+def enqueue(instance, field="image"):
+    #アップロードされた画像を、コミット後にリクエストとは別に処理する
+    model, pk, name = type(instance), instance.pk, getattr(instance, field).name
+
+    if not settings.IMAGE_PROCESSING_WORKERS:
+        #0ならその場で処理（開発・テスト用）
+        transaction.on_commit(lambda: _process_now(model, pk, field, name))
+        return
+
+    def submit():
+        _, threads = _executors()
+        threads.submit(_process_in_pool, model, pk, field, name)
+
+    transaction.on_commit(submit)
+
+
+def process_pending(batch_size=100):
+    #後処理が済んでいない画像をその場で処理し、処理できた件数を返す
+    #処理待ちはプロセス内にしかないため、再起動などで処理されずに残った画像（EXIF付きの元画像）を拾う
+    count = 0
+    for model in (Product, Review):
+        pending = (
+            model.objects
+            .filter(image_processed=False)
+            .exclude(image="")
+            .exclude(image__isnull=True)
+            .order_by("id")
+            .values_list("id", "image")
+        )
+        for pk, name in pending.iterator(chunk_size=batch_size):
+            count += _process_now(model, pk, "image", name)
+    return count
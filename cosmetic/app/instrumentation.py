@@ -0,0 +1,178 @@
+import contextvars
+import json
+import logging
+import re
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.utils.functional import empty
+
+from . import memory
+from .metrics import record_request
+
+logger = logging.getLogger("app.performance")
+
+SLOW_QUERIES_IN_REPORT = 5 #遅いリクエストのログに含めるクエリ数
+
+_metrics = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.view_name = None
+        self.view_started = None
+        self.view_ms = 0.0
+        self.template_ms = 0.0
+        self.queries = [] #(正規化したSQL, ミリ秒)
+
+    @property
+    def query_ms(self):
+        return sum(ms for _, ms in self.queries)
+
+
+#リテラル・プレースホルダーを「?」にまとめ、同じ形のクエリを同じ文字列にする
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _IN_LIST.sub("(...)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+
+def _record_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics = _metrics.get()
+        if metrics is not None:
+            metrics.queries.append((normalize_sql(sql), (time.perf_counter() - started) * 1000))
+
+
+@contextmanager
+def track_queries():
+    #このスレッドの全DBの接続でSQLを記録する（非同期ビューが別スレッドで実行するクエリにも使う）
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(_record_query))
+        yield
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics = _metrics.get()
+            if metrics is not None:
+                metrics.template_ms += (time.perf_counter() - started) * 1000
+            #描画直後（コンテキストが残っている時点）のメモリを記録
+            memory.capture()
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    #テンプレートの描画時間を計測する（{% include %} 等は外側の描画時間に含まれる）
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class RequestTimingMiddleware:
+    #リクエストごとのSQL件数・時間、テンプレート描画時間、ビューの処理時間を計測し、
+    #スタッフには Server-Timing ヘッダーで返す。遅いリクエスト・クエリはログに出力する
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            with track_queries():
+                response = self.get_response(request)
+        finally:
+            _metrics.reset(token)
+
+        total_ms = (time.perf_counter() - started) * 1000
+        if metrics.view_started is not None:
+            metrics.view_ms = (time.perf_counter() - metrics.view_started) * 1000
+
+        record_request(
+            metrics.view_name or "(unresolved)",
+            request.method,
+            total_ms / 1000,
+            len(metrics.queries),
+            metrics.query_ms / 1000,
+        )
+        if self.is_staff(request):
+            response["Server-Timing"] = self.server_timing(metrics, total_ms)
+        self.log_slow(request, response, metrics, total_ms)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _metrics.get()
+        if metrics is not None:
+            match = request.resolver_match
+            metrics.view_name = match.view_name if match else view_func.__name__
+            metrics.view_started = time.perf_counter()
+
+    def is_staff(self, request):
+        #判定のためだけにユーザーを読み込まない（セッション・ユーザーのクエリを増やさない）
+        user = getattr(request, "user", None)
+        if user is None or getattr(user, "_wrapped", None) is empty:
+            return False
+        return user.is_staff
+
+    def server_timing(self, metrics, total_ms):
+        return ", ".join([
+            f'db;desc="{len(metrics.queries)} queries";dur={metrics.query_ms:.1f}',
+            f"tpl;dur={metrics.template_ms:.1f}",
+            f"view;dur={metrics.view_ms:.1f}",
+            f"total;dur={total_ms:.1f}",
+        ])
+
+    def log_slow(self, request, response, metrics, total_ms):
+        for sql, ms in metrics.queries:
+            if ms >= settings.SLOW_QUERY_MS:
+                logger.warning(json.dumps({
+                    "event": "slow_query",
+                    "view": metrics.view_name,
+                    "path": request.path,
+                    "ms": round(ms, 1),
+                    "sql": sql,
+                }, ensure_ascii=False))
+
+        if total_ms >= settings.SLOW_REQUEST_MS:
+            slowest = sorted(metrics.queries, key=lambda query: query[1], reverse=True)
+            logger.warning(json.dumps({
+                "event": "slow_request",
+                "view": metrics.view_name,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "total_ms": round(total_ms, 1),
+                "view_ms": round(metrics.view_ms, 1),
+                "template_ms": round(metrics.template_ms, 1),
+                "query_count": len(metrics.queries),
+                "query_ms": round(metrics.query_ms, 1),
+                "slowest_queries": [
+                    {"ms": round(ms, 1), "sql": sql} for sql, ms in slowest[:SLOW_QUERIES_IN_REPORT]
+                ],
+            }, ensure_ascii=False))
@@ -0,0 +1,86 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import benchmark
+
+
+def parse_mix(value):
+    #「home=30,ranking=20」形式
+    mix = {}
+    for item in value.split(","):
+        view, _, weight = item.partition("=")
+        try:
+            mix[view.strip()] = float(weight)
+        except ValueError:
+            raise CommandError(f"--mix の指定が正しくありません: {item}")
+    return mix
+
+
+class Command(BaseCommand):
+    help = "アクセスの比率に従ってリクエストを再生し、ビューごとの応答時間とクエリ数を計測します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=1, help="並行して動かすプロセス数")
+        parser.add_argument(
+            "--server", choices=["wsgi", "asgi"], default="wsgi",
+            help="asgi: 非同期版のビュー（ASYNC_VIEWS）を有効にしたASGIアプリケーションへ送る",
+        )
+        parser.add_argument("--concurrency", type=int, default=1, help="ASGIで1プロセスあたり同時に送るリクエスト数")
+        parser.add_argument(
+            "--query-delay-ms", type=float, default=0,
+            help="各クエリに加える待ち時間（ネットワーク越しのDBの往復を模擬する）",
+        )
+        parser.add_argument(
+            "--mix", type=parse_mix,
+            help="ビュー名=重み をカンマ区切りで指定（例: home=30,ranking=20,product_detail=35,product_search=15）",
+        )
+        parser.add_argument("--auth-ratio", type=float, default=0.3, help="ログイン済みセッションの割合")
+        parser.add_argument("--sessions", type=int, default=20, help="使用するログイン済みセッション数")
+        parser.add_argument("--warmup", type=int, default=50, help="計測しない最初のリクエスト数（プロセスごと）")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--json", help="結果をJSONで保存するファイル（実行ごとの比較用）")
+
+    def handle(self, *args, **options):
+        if options["requests"] < 1 or options["workers"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--requests・--workers・--concurrency は1以上を指定してください")
+        if options["requests"] < options["workers"]:
+            raise CommandError("--requests は --workers 以上を指定してください（リクエストはプロセスに振り分けます）")
+        if options["warmup"] < 0 or options["query_delay_ms"] < 0:
+            raise CommandError("--warmup・--query-delay-ms は0以上を指定してください")
+
+        mix = options["mix"] or benchmark.DEFAULT_MIX
+        unknown = set(mix) - set(benchmark.DEFAULT_MIX)
+        if unknown:
+            raise CommandError(f"未対応のビューです: {', '.join(sorted(unknown))}")
+
+        try:
+            report = benchmark.benchmark(
+                mix=mix,
+                requests=options["requests"],
+                workers=options["workers"],
+                auth_ratio=options["auth_ratio"],
+                sessions=options["sessions"],
+                warmup=options["warmup"],
+                seed=options["seed"],
+                server=options["server"],
+                concurrency=options["concurrency"],
+                query_delay_ms=options["query_delay_ms"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        columns = ["requests", "throughput", "p50_ms", "p95_ms", "p99_ms", "queries_mean", "queries_max", "errors"]
+        self.stdout.write(f"{'view':<16}" + "".join(f"{column:>14}" for column in columns))
+        rows = list(report["views"].items()) + [("total", report["total"])]
+        for view, stats in rows:
+            self.stdout.write(f"{view:<16}" + "".join(f"{stats[column]:>14}" for column in columns))
+
+        if report["config"]["debug"]:
+            self.stdout.write(self.style.WARNING("DEBUG = True のため、本番より遅い結果になります"))
+
+        if options["json"]:
+            with open(options["json"], "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f"結果を保存しました: {options['json']}"))
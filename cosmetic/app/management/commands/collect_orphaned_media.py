@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from app import storage
+
+
+class Command(BaseCommand):
+    help = "どの商品・レビューからも参照されていない画像ファイルを削除します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--min-age-hours", type=float, default=24,
+            help="これより新しいファイルは対象外（保存処理中のファイルを守るため）",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="削除せずに対象を表示")
+        parser.add_argument("--quarantine", action="store_true", help="削除せずに MEDIA_QUARANTINE_ROOT へ移動")
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+
+        def report(name, size):
+            if dry_run or options["verbosity"] >= 2:
+                self.stdout.write(f"{name}\t{size}")
+
+        count, total_size = storage.collect_orphans(
+            batch_size=options["batch_size"],
+            min_age=options["min_age_hours"] * 60 * 60,
+            dry_run=dry_run,
+            quarantine=options["quarantine"],
+            report=report,
+        )
+
+        if dry_run:
+            message = f"未参照の画像ファイル: {count}件（{total_size}バイト）"
+        elif options["quarantine"]:
+            message = f"未参照の画像ファイルを隔離しました: {count}件（{total_size}バイト）"
+        else:
+            message = f"未参照の画像ファイルを削除しました: {count}件（{total_size}バイト）"
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,49 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import synthetic
+
+
+class Command(BaseCommand):
+    help = "負荷試験用のユーザー・商品・レビュー・お気に入りを一括生成します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--products", type=int, default=500)
+        parser.add_argument("--reviews", type=int, default=100000)
+        parser.add_argument("--favorites", type=int, default=200000)
+        parser.add_argument("--draft-ratio", type=float, default=0.1, help="下書きの割合")
+        parser.add_argument("--seed", type=int, default=0, help="乱数の種（同じ値なら同じ内容を生成）")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--reference-date", type=date.fromisoformat, default=synthetic.REFERENCE_DATE,
+            help="投稿日時をこの日（YYYY-MM-DD）からさかのぼって作る",
+        )
+
+    def handle(self, *args, **options):
+        if not 0 <= options["draft_ratio"] <= 1:
+            raise CommandError("--draft-ratio は 0〜1 で指定してください")
+        error = synthetic.check_counts(options["users"], options["products"], options["reviews"])
+        if error:
+            raise CommandError(error)
+
+        started = time.perf_counter()
+
+        def log(message):
+            self.stdout.write(f"[{time.perf_counter() - started:7.1f}s] {message}")
+
+        synthetic.generate(
+            users=options["users"],
+            products=options["products"],
+            reviews=options["reviews"],
+            favorites=options["favorites"],
+            draft_ratio=options["draft_ratio"],
+            seed=options["seed"],
+            batch_size=options["batch_size"],
+            reference_date=options["reference_date"],
+            log=log,
+        )
+
+        self.stdout.write(self.style.SUCCESS(f"データを生成しました（{time.perf_counter() - started:.1f}秒）"))
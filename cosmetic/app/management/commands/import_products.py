@@ -0,0 +1,44 @@
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import image_processing, product_io
+
+
+class Command(BaseCommand):
+    help = "CSV / JSON Lines の商品ファイルを一括登録します（id のある行は既存の商品を更新）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="商品ファイル（.csv / .jsonl）")
+        parser.add_argument("--archive", help="画像をまとめたZIP（image 列にはZIP内のパスを指定）")
+        parser.add_argument("--batch-size", type=int, default=product_io.BATCH_SIZE, help="1トランザクションで登録する行数")
+
+    def handle(self, *args, **options):
+        fmt = product_io.product_format(options["path"])
+        if fmt is None:
+            raise CommandError("拡張子が .csv / .jsonl のファイルを指定してください")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上を指定してください")
+
+        started = time.perf_counter()
+
+        def log(message):
+            self.stdout.write(f"[{time.perf_counter() - started:7.1f}s] {message}")
+
+        try:
+            with open(options["path"], "rb") as file, product_io.ImageSource(options["archive"]) as images:
+                result = product_io.import_products(
+                    product_io.read_rows(file, fmt), images, batch_size=options["batch_size"], log=log,
+                )
+        except (OSError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+            raise CommandError(str(e))
+
+        log("画像の処理を待っています")
+        image_processing.wait()
+
+        for line, message in result.errors:
+            self.stderr.write(f"{line}行目: {message}")
+        summary = f"登録 {result.created}件・更新 {result.updated}件・エラー {result.error_count}件"
+        style = self.style.WARNING if result.error_count else self.style.SUCCESS
+        self.stdout.write(style(f"{summary}（{time.perf_counter() - started:.1f}秒）"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app import image_processing
+
+
+class Command(BaseCommand):
+    help = "後処理（メタデータ除去・縮小）が済んでいない画像を処理します（処理前にサーバーが停止した場合など）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        count = image_processing.process_pending(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"未処理の画像を処理しました（{count}件）"))
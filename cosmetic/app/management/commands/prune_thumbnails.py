@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app import thumbnails
+
+
+class Command(BaseCommand):
+    help = "縮小画像のキャッシュが上限（THUMBNAIL_CACHE_MAX_BYTES）を超えていれば、最終利用が古いものから削除します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-bytes", type=int, default=None, help="上限（省略時は THUMBNAIL_CACHE_MAX_BYTES）")
+
+    def handle(self, *args, **options):
+        removed = thumbnails.prune(max_bytes=options["max_bytes"])
+        self.stdout.write(self.style.SUCCESS(f"縮小画像のキャッシュを削除しました（{removed}件）"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app import ranking
+
+
+class Command(BaseCommand):
+    help = "公開済みレビューからランキング集計（ProductRanking）と商品ごとの評価集計を再構築します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        product_count = ranking.rebuild_product_stats(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"商品の評価集計を再構築しました（{product_count}件）"))
+
+        count = ranking.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"ランキング集計を再構築しました（{count}件）"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app import storage
+
+
+class Command(BaseCommand):
+    help = "既存の画像ファイルを内容ハッシュ名・階層ディレクトリへ移動します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        moved, missing = storage.relocate_legacy_files(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"画像ファイルを移動しました（{moved}件）"))
+        if missing:
+            self.stdout.write(self.style.WARNING(f"ファイルが見つからない画像があります（{missing}件）"))
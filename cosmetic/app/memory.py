@@ -0,0 +1,181 @@
+import contextvars
+import os
+import threading
+import tracemalloc
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .profiling import path_prefixes, short_path
+
+#ビューごとのメモリ使用量（tracemalloc）。MEMORY_PROFILING = True のときだけ有効
+#集計はプロセスごと（レポートはそのページを返したワーカーの値）
+#tracemalloc はプロセス全体を数えるため、スレッドで並行処理するサーバーでは他のリクエストの分も含まれる
+
+TOP_SITES = 10 #ビューごとに残す割り当て箇所の数
+
+_lock = threading.Lock()
+_stats = {}
+_requests = 0
+_sample = contextvars.ContextVar("memory_sample", default=None)
+
+#呼び出し元として扱わない計測用のモジュール（テンプレートの描画を包むものなど）
+_MEASUREMENT_FILES = {
+    os.path.join(os.path.dirname(__file__), name)
+    for name in ("instrumentation.py", "memory.py", "profiling.py")
+}
+
+#スナップショットを取り直すのは、前回よりこの割合以上メモリが増えたときだけ
+RECAPTURE_GROWTH = 1.1
+
+
+class ViewMemoryStats:
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.requests = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        self.retained_total = 0
+        self.samples = 0
+        self.sites = Counter() #(プロジェクト内の呼び出し元, 割り当て箇所): バイト数の合計
+
+    @property
+    def peak_mean(self):
+        return self.peak_total // self.requests if self.requests else 0
+
+    @property
+    def retained_mean(self):
+        return self.retained_total // self.requests if self.requests else 0
+
+    def top_sites(self):
+        #1回あたりの平均バイト数で並べる
+        return [
+            {"caller": caller, "site": site, "size": size // self.samples}
+            for (caller, site), size in self.sites.most_common(TOP_SITES)
+        ]
+
+
+def _snapshot():
+    #計測自体（このモジュール・tracemalloc）の割り当ては除く（割り当てた行で判定）
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+
+
+class _Sample:
+    #割り当て箇所を調べるリクエスト。最もメモリを使っていた時点の状態を残す
+    #スナップショットの取得・比較はトレースの数に比例して重いため、MEMORY_PROFILING_SAMPLE_EVERY 回に1回だけ行う
+    def __init__(self):
+        self.before = _snapshot()
+        self.after = None
+        self.size = -1
+
+    def capture(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.size * RECAPTURE_GROWTH:
+            self.after = None #古い状態を先に手放す
+            self.size = current
+            self.after = _snapshot()
+
+    def sites(self):
+        if self.after is None:
+            return Counter()
+        project = os.path.join(str(settings.BASE_DIR), "")
+        prefixes = path_prefixes()
+        sites = Counter()
+        for stat in self.after.compare_to(self.before, "traceback"):
+            if stat.size_diff <= 0 or not stat.traceback:
+                continue
+            #呼び出し履歴は古いフレームから順に並ぶので、新しい順にする
+            frames = list(reversed(stat.traceback))
+            #割り当てた行と、そこへ至るプロジェクト内（views.py など）の最も内側の行
+            caller = next(
+                (frame for frame in frames
+                 if frame.filename.startswith(project) and "site-packages" not in frame.filename
+                 and frame.filename not in _MEASUREMENT_FILES),
+                None,
+            )
+            sites[(_location(caller, prefixes), _location(frames[0], prefixes))] += stat.size_diff
+        return sites
+
+
+def _location(frame, prefixes):
+    if frame is None:
+        return "-"
+    return f"{short_path(frame.filename, prefixes)}:{frame.lineno}"
+
+
+def capture():
+    #テンプレートの描画直後など、コンテキストがまだ残っている時点で呼ぶ
+    sample = _sample.get()
+    if sample is not None:
+        sample.capture()
+
+
+def record(view_name, peak=None, retained=None, sites=None):
+    with _lock:
+        stats = _stats.get(view_name)
+        if stats is None:
+            stats = _stats[view_name] = ViewMemoryStats(view_name)
+        if peak is not None:
+            stats.requests += 1
+            stats.peak_total += peak
+            stats.peak_max = max(stats.peak_max, peak)
+            stats.retained_total += retained
+        if sites is not None:
+            stats.samples += 1
+            stats.sites.update(sites)
+
+
+def report():
+    #ピークの最大値が大きい順
+    with _lock:
+        return sorted(_stats.values(), key=lambda stats: stats.peak_max, reverse=True)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def _should_sample():
+    global _requests
+    with _lock:
+        _requests += 1
+        return _requests % settings.MEMORY_PROFILING_SAMPLE_EVERY == 0
+
+
+class MemoryProfilingMiddleware:
+    def __init__(self, get_response):
+        if not settings.MEMORY_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(settings.MEMORY_PROFILING_FRAMES)
+
+    def __call__(self, request):
+        if not _should_sample():
+            #通常のリクエストはピークと、リクエスト後に残った量だけを数える（スナップショットは取らない）
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            response = self.get_response(request)
+            current, peak = tracemalloc.get_traced_memory()
+            record(self.view_name(request), peak - baseline, current - baseline)
+            return response
+
+        #スナップショット自体がメモリを使うため、調べるリクエストでは使用量は数えない
+        sample = _Sample()
+        token = _sample.set(sample)
+        try:
+            response = self.get_response(request)
+            sample.capture()
+        finally:
+            _sample.reset(token)
+        record(self.view_name(request), sites=sample.sites())
+        return response
+
+    def view_name(self, request):
+        match = getattr(request, "resolver_match", None)
+        return match.view_name if match else "(unresolved)"
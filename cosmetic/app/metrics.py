@@ -0,0 +1,185 @@
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+#Prometheus 形式のメトリクス（外部ライブラリを使わないプロセス内カウンター）
+#METRICS_DIR を指定すると、各プロセスが METRICS_FLUSH_INTERVAL 秒ごとに自分の値をファイルへ書き出し、
+#/metrics では全プロセス分を合算して返す（終了したプロセスの値も残すため、ディレクトリは起動前に空にする）
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UPLOAD_BUCKETS = (100_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000, 20_000_000)
+
+#名前: (種類, 説明, ヒストグラムの区切り)
+METRICS = {
+    "app_http_request_duration_seconds": ("histogram", "リクエストの処理時間（URL名・メソッドごと）", LATENCY_BUCKETS),
+    "app_db_queries_total": ("counter", "SQLの実行回数（URL名ごと）", None),
+    "app_db_query_duration_seconds_total": ("counter", "SQLの実行時間の合計（URL名ごと）", None),
+    "app_cache_requests_total": ("counter", "キャッシュの参照回数（hit / miss）", None),
+    "app_upload_size_bytes": ("histogram", "アップロードされた画像のサイズ", UPLOAD_BUCKETS),
+    "app_favorite_toggles_total": ("counter", "お気に入りの登録・解除の回数", None),
+    "app_review_posts_total": ("counter", "公開されたレビューの件数", None),
+}
+
+_lock = threading.Lock()
+_values = {} #(名前, ラベル): カウンターの値、またはヒストグラムの [区切りごとの件数..., 合計, 件数]
+_last_flush = time.monotonic()
+_process_file = None
+_process_pid = None
+
+
+def _own_file():
+    #プロセスごとのファイル名（PIDは再利用されるため、作成時刻も含める）
+    #アプリを読み込んでから fork するサーバー（gunicorn --preload など）では、読み込み時に決めると
+    #全ワーカーが同じ名前になるため、書き出すときに決め、PIDが変わったら作り直す
+    global _process_file, _process_pid
+    pid = os.getpid()
+    if _process_pid != pid:
+        _process_file = f"{pid}-{time.time_ns()}.json"
+        _process_pid = pid
+    return _process_file
+
+
+def _after_fork():
+    #fork 前に数えた値は親プロセスのもの（子でも数えると二重に集計される）
+    global _lock
+    _lock = threading.Lock()
+    _values.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        row = _values.get(key)
+        if row is None:
+            row = _values[key] = [0] * (len(buckets) + 3)
+        #値が入る最初の区切り（le）に数え、出力時に累積する。最後の区切りを超えたものは +Inf
+        row[bisect_left(buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+
+def record_request(view_name, method, seconds, query_count, query_seconds):
+    observe("app_http_request_duration_seconds", seconds, view=view_name, method=method)
+    inc("app_db_queries_total", query_count, view=view_name)
+    inc("app_db_query_duration_seconds_total", query_seconds, view=view_name)
+    maybe_flush()
+
+
+def _snapshot():
+    with _lock:
+        return [
+            [name, list(labels), list(value) if isinstance(value, list) else value]
+            for (name, labels), value in _values.items()
+        ]
+
+
+def flush():
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not settings.METRICS_DIR:
+        return
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    path = os.path.join(settings.METRICS_DIR, _own_file())
+    #書きかけのファイルを読まれないよう、別名で書いてから置き換える
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(_snapshot(), file)
+    os.replace(path + ".tmp", path)
+
+
+def maybe_flush():
+    if settings.METRICS_DIR and time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+atexit.register(flush)
+
+
+def _rows():
+    #このプロセスは最新の値、他のプロセスは書き出されたファイルの値を使う
+    yield from _snapshot()
+    if not settings.METRICS_DIR:
+        return
+    try:
+        filenames = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for filename in filenames:
+        if filename == _own_file() or not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, filename), encoding="utf-8") as file:
+                yield from json.load(file)
+        except (OSError, ValueError):
+            continue
+
+
+def collect():
+    merged = {}
+    for name, labels, value in _rows():
+        if name not in METRICS:
+            continue
+        key = (name, tuple(tuple(label) for label in labels))
+        if isinstance(value, list):
+            total = merged.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                total[i] += count
+        else:
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    merged = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {_escape(help_text)}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(merged.items()):
+            if metric != name:
+                continue
+            if kind == "counter":
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + (float("inf"),), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value[-2])}")
+            lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:37
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_rankings(apps, schema_editor):
+    #既存の公開済みレビューから集計を作る（ranking.rebuild() と同じ内容）
+    ProductRanking = apps.get_model('app', 'ProductRanking')
+    Review = apps.get_model('app', 'Review')
+
+    cells = defaultdict(lambda: [0, 0, 0])
+    groups = (
+        Review.objects
+        .filter(is_draft=False, posted_at__isnull=False)
+        .values('product_id', 'product__category', 'skin_type', 'age')
+        .annotate(review_count=Count('id'), rating_count=Count('rating'), rating_sum=Sum('rating'))
+        .order_by()
+    )
+    for group in groups.iterator():
+        #指定なし（''）／指定ありの組み合わせごとに加算
+        for category in {'', group['product__category']}:
+            for skin_type in {'', group['skin_type']}:
+                for age in {'', group['age']}:
+                    cell = cells[(group['product_id'], category, skin_type, age)]
+                    cell[0] += group['review_count']
+                    cell[1] += group['rating_count']
+                    cell[2] += group['rating_sum'] or 0
+
+    ProductRanking.objects.bulk_create(
+        [
+            ProductRanking(
+                product_id=product_id,
+                category=category,
+                skin_type=skin_type,
+                age=age,
+                review_count=review_count,
+                rating_count=rating_count,
+                rating_sum=rating_sum,
+                avg_rating=rating_sum / rating_count if rating_count else None,
+            )
+            for (product_id, category, skin_type, age), (review_count, rating_count, rating_sum) in cells.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_alter_review_rating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(blank=True, max_length=50)),
+                ('skin_type', models.CharField(blank=True, max_length=50)),
+                ('age', models.CharField(blank=True, max_length=10)),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('avg_rating', models.FloatField(blank=True, null=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='app.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['category', 'skin_type', 'age', '-review_count', '-avg_rating'], name='ranking_order_idx')],
+                'unique_together': {('product', 'category', 'skin_type', 'age')},
+            },
+        ),
+        migrations.RunPython(fill_rankings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:38
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_review_stats(apps, schema_editor):
+    Product = apps.get_model('app', 'Product')
+    Review = apps.get_model('app', 'Review')
+
+    published = (
+        Review.objects
+        .filter(product=OuterRef('pk'), is_draft=False, posted_at__isnull=False)
+        .values('product')
+    )
+
+    def aggregate(expression, **filters):
+        return Coalesce(Subquery(published.filter(**filters).annotate(value=expression).values('value')), 0)
+
+    Product.objects.update(
+        review_count=aggregate(Count('id')),
+        rating_sum=aggregate(Sum('rating')),
+        **{f'rating_{rating}_count': aggregate(Count('id'), rating=rating) for rating in range(1, 6)},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_productranking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_review_stats, migrations.RunPython.noop),
+    ]
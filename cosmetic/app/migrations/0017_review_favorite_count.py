@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_favorite_count(apps, schema_editor):
+    Review = apps.get_model('app', 'Review')
+    ReviewFavorite = apps.get_model('app', 'ReviewFavorite')
+
+    counts = (
+        ReviewFavorite.objects
+        .filter(review=OuterRef('pk'))
+        .values('review')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    Review.objects.update(favorite_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_product_review_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='favorite_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_favorite_count, migrations.RunPython.noop),
+    ]
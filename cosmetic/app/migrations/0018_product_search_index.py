@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:41
+
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        #トライグラムトークナイザーは SQLite 3.34 以降（未対応なら部分一致検索で動作）
+        try:
+            schema_editor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS app_product_fts "
+                "USING fts5(search_text, tokenize='trigram')"
+            )
+        except OperationalError:
+            pass
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS app_product_search_trgm "
+            "ON app_product USING gin (search_text gin_trgm_ops)"
+        )
+
+
+def fill_search_text(apps, schema_editor):
+    #既存の商品の search_text と索引を作る（search.rebuild() と同じ内容）
+    from app.search import build_search_text
+
+    Product = apps.get_model('app', 'Product')
+    connection = schema_editor.connection
+    has_fts = connection.vendor == 'sqlite' and 'app_product_fts' in connection.introspection.table_names()
+
+    batch = []
+    products = Product.objects.only('id', 'cosme_name', 'category').order_by('id')
+    for product in products.iterator(chunk_size=1000):
+        product.search_text = build_search_text(product)
+        batch.append(product)
+        if len(batch) >= 1000:
+            Product.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    if batch:
+        Product.objects.bulk_update(batch, ['search_text'])
+
+    if has_fts:
+        schema_editor.execute(
+            "INSERT INTO app_product_fts (rowid, search_text) SELECT id, search_text FROM app_product"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS app_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS app_product_search_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_review_favorite_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_text',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_search_grams(apps, schema_editor):
+    from app.search import search_grams
+
+    Product = apps.get_model('app', 'Product')
+    ProductSearchGram = apps.get_model('app', 'ProductSearchGram')
+
+    batch = []
+    for product_id, search_text in Product.objects.order_by('id').values_list('id', 'search_text').iterator(chunk_size=1000):
+        batch.extend(ProductSearchGram(product_id=product_id, gram=gram) for gram in search_grams(search_text))
+        if len(batch) >= 10000:
+            ProductSearchGram.objects.bulk_create(batch, batch_size=1000)
+            batch = []
+    ProductSearchGram.objects.bulk_create(batch, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_review_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=2)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to='app.product')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('gram', 'product'), name='product_search_gram_unique')],
+            },
+        ),
+        migrations.RunPython(fill_search_grams, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 
 AGE_CHOICES = (
@@ -26,17 +26,99 @@ SKIN_CHOICES = (
 )
 
 
+#F式で差分更新する集計列は、通常の保存（編集画面など）で上書きしない
+class CounterFieldsMixin:
+    COUNTER_FIELDS = ()
 
-class Product(models.Model):
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+
+class Product(CounterFieldsMixin, models.Model):
     image = models.ImageField(upload_to='product_images/', blank=True, null=True) #商品画像
     cosme_name = models.CharField("商品名",max_length=200)  #商品名
     category = models.CharField("カテゴリー",max_length=50)  #カテゴリー    
     price = models.IntegerField("価格(円)", blank=True, null=True) #値段
+    search_text = models.TextField(blank=True, editable=False) #検索用（正規化した商品名・カテゴリー）
+    image_processed = models.BooleanField(default=True, editable=False) #アップロード画像の後処理（メタデータ除去・縮小）が済んだか
+
+    #公開済みレビューの集計（レビュー投稿・編集・削除時に差分更新）
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_1_count = models.IntegerField(default=0)
+    rating_2_count = models.IntegerField(default=0)
+    rating_3_count = models.IntegerField(default=0)
+    rating_4_count = models.IntegerField(default=0)
+    rating_5_count = models.IntegerField(default=0)
+
+    COUNTER_FIELDS = (
+        "review_count", "rating_sum",
+        "rating_1_count", "rating_2_count", "rating_3_count", "rating_4_count", "rating_5_count",
+    )
+
+    class Meta:
+        indexes = [
+            #未参照画像の削除・画像の移動（名前順の走査・名前での検索）
+            models.Index(fields=["image"], name="product_image_idx"),
+            #後処理が済んでいない画像（process_pending_images）
+            models.Index(fields=["id"], condition=models.Q(image_processed=False), name="product_image_pending_idx"),
+        ]
+
+    @property
+    def rating_count(self):
+        return (self.rating_1_count + self.rating_2_count + self.rating_3_count
+                + self.rating_4_count + self.rating_5_count)
+
+    @property
+    def avg_rating(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
+    @property
+    def avg_rating_int(self):
+        #四捨五入（round() は偶数への丸めで 2.5 → 2 になるため、整数で計算する）
+        if not self.rating_count:
+            return None
+        return (2 * self.rating_sum + self.rating_count) // (2 * self.rating_count)
+
+    @property
+    def rating_distribution(self):
+        #評価分布（★5→★1の順に、件数と割合）
+        total = self.rating_count
+        return [
+            {
+                "rating": rating,
+                "count": count,
+                "percent": round(count * 100 / total) if total else 0,
+            }
+            for rating, count in (
+                (5, self.rating_5_count),
+                (4, self.rating_4_count),
+                (3, self.rating_3_count),
+                (2, self.rating_2_count),
+                (1, self.rating_1_count),
+            )
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        #カテゴリー変更をランキング集計へ反映するため読み込み時の値を保持
+        instance._loaded_category = instance.__dict__.get("category")
+        #差し替えられた画像を削除するため読み込み時の画像名を保持
+        instance._loaded_image = instance.__dict__.get("image")
+        return instance
 
     def __str__(self):
         return self.cosme_name
     
-class Review(models.Model):
+class Review(CounterFieldsMixin, models.Model):
     #商品を紐づく（外部キー）
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -60,10 +142,66 @@ class Review(models.Model):
     goodpoint_comment = models.TextField(blank=True)
     badpoint_comment = models.TextField(blank=True)
     image = models.ImageField(upload_to='product_images/',blank=True,null=True)
+    image_processed = models.BooleanField(default=True, editable=False)
 
     is_draft= models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True) #下書き作成日時
     posted_at = models.DateTimeField(null=True, blank=True) #投稿日時
+
+    favorite_count = models.IntegerField(default=0) #お気に入り数（お気に入り追加・解除時に差分更新）
+    COUNTER_FIELDS = ("favorite_count",)
+
+    #集計（ランキング等）に使う項目
+    PUBLISHED_STATE_FIELDS = ("is_draft", "posted_at", "product_id", "skin_type", "age", "rating")
+
+    class Meta:
+        indexes = [
+            #公開済みレビューの新着順（全体・商品別・ユーザー別）。下書きは含めない部分索引
+            models.Index(
+                fields=["-posted_at", "-id"],
+                condition=models.Q(is_draft=False),
+                name="review_published_idx",
+            ),
+            models.Index(
+                fields=["product", "-posted_at", "-id"],
+                condition=models.Q(is_draft=False),
+                name="review_product_published_idx",
+            ),
+            models.Index(
+                fields=["user", "-posted_at", "-id"],
+                condition=models.Q(is_draft=False),
+                name="review_user_published_idx",
+            ),
+            #ユーザーごとの下書き一覧（作成日時順）
+            models.Index(
+                fields=["user", "-created_at"],
+                condition=models.Q(is_draft=True),
+                name="review_user_draft_idx",
+            ),
+            models.Index(fields=["image"], name="review_image_idx"),
+            models.Index(fields=["id"], condition=models.Q(image_processed=False), name="review_image_pending_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        #保存・削除時に集計の差分を出すため読み込み時の状態を保持
+        if all(name in instance.__dict__ for name in cls.PUBLISHED_STATE_FIELDS):
+            instance._loaded_state = instance.published_state()
+        #差し替えられた画像を削除するため読み込み時の画像名を保持
+        instance._loaded_image = instance.__dict__.get("image")
+        return instance
+
+    def published_state(self):
+        #公開済みレビューのみ集計対象（下書き・未投稿はNone）
+        if self.is_draft or self.posted_at is None:
+            return None
+        return (self.product_id, self.skin_type, self.age, self.rating)
+
+    def save(self, *args, **kwargs):
+        #レビュー本体と集計の更新を同一トランザクションで行う
+        with transaction.atomic():
+            super().save(*args, **kwargs)
   
     def __str__(self):
         return f"{self.product.cosme_name}のレビュー"
@@ -107,6 +245,55 @@ class ReviewFavorite(models.Model):
     
     class Meta:
         unique_together = ("user","review")
+        indexes = [
+            #ユーザーごとのお気に入り一覧（追加日時順）
+            models.Index(fields=["user", "-created_at", "-id"], name="favorite_user_created_idx"),
+        ]
         
     def __str__(self):
         return f'{self.user}♡{self.review}'
+
+
+#ランキング集計（商品×カテゴリー×肌質×年代）
+#「指定なし」は空文字で保持し、レビュー投稿・編集・削除のたびに差分更新する
+class ProductRanking(models.Model):
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="rankings"
+    )
+    category = models.CharField(max_length=50, blank=True)
+    skin_type = models.CharField(max_length=50, blank=True)
+    age = models.CharField(max_length=10, blank=True)
+
+    review_count = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    avg_rating = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("product", "category", "skin_type", "age")
+        indexes = [
+            models.Index(
+                fields=["category", "skin_type", "age", "-review_count", "-avg_rating"],
+                name="ranking_order_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.product}({self.category}/{self.skin_type}/{self.age})'
+
+
+#商品検索の2文字単位の索引（search_text の各語を2文字ずつに分けたもの。語の最後の1文字も含む）
+#トライグラム索引では探せない2文字以下の語（「化粧」「乳液」など）を、部分一致の全件走査をせずに探す
+class ProductSearchGram(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_grams')
+    gram = models.CharField(max_length=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gram', 'product'], name='product_search_gram_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.gram}({self.product_id})'
@@ -0,0 +1,50 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+FEED_PAGE_SIZE = 20
+
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    #不正なカーソルは先頭ページ扱い
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, pk = raw.split("|")
+        timestamp, pk = datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    #DBの整数に収まらないIDはクエリ実行時にエラーになる
+    if not 0 < pk < 2 ** 63:
+        return None
+    return timestamp, pk
+
+
+def keyset_page(qs, cursor, time_field="posted_at", page_size=FEED_PAGE_SIZE):
+    #(time_field, id) の降順で、カーソルより後ろを page_size 件取得する
+    #OFFSET を使わないため、何ページ目でも索引の範囲読みだけで済む
+    qs = qs.filter(**{f"{time_field}__isnull": False}).order_by(f"-{time_field}", "-id")
+
+    position = decode_cursor(cursor)
+    if position is not None:
+        timestamp, pk = position
+        qs = qs.filter(
+            Q(**{f"{time_field}__lt": timestamp})
+            | Q(**{time_field: timestamp, "id__lt": pk})
+        )
+
+    rows = list(qs[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, time_field), last.pk)
+
+    return rows, next_cursor
@@ -0,0 +1,236 @@
+import copy
+import csv
+import io
+import json
+import os
+import zipfile
+from itertools import islice
+
+from django.core.files.base import File
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+
+from . import image_processing, ranking, search, storage
+from .models import Product
+from .versions import CATALOG, bump_version
+
+#商品の一括登録・書き出し（CSV / JSON Lines）
+#登録は1行ずつ読み込んで ProductImportForm（CosmeForm と同じ規則）で検証し、BATCH_SIZE 件ごとに1つのトランザクションで
+#bulk_create / bulk_update する。ファイル全体・全商品をメモリに載せない
+#bulk_create / bulk_update はシグナルを通らないため、検索用の列・索引、ランキングのカテゴリー、キャッシュのバージョンはここで更新する
+
+COLUMNS = ["id", "cosme_name", "category", "price", "image"] #id のある行は既存の商品の更新
+EXPORT_COLUMNS = COLUMNS + ["review_count"] #review_count は参考（登録時は無視）
+UPDATE_FIELDS = ["image", "image_processed", "cosme_name", "category", "price", "search_text"]
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+MAX_ERRORS = 100 #結果に残すエラーの件数（件数はすべて数える）
+
+
+def product_format(filename):
+    return FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def read_rows(file, fmt):
+    #(行番号, 値の辞書) を1行ずつ返す。JSONのオブジェクトとして読めない行は値を None にする
+    #Excel で保存した BOM 付きの UTF-8 も読める
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(text)
+            for row in reader:
+                yield reader.line_num, row
+            return
+
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+    finally:
+        #元のファイルは呼び出し側で閉じる
+        text.detach()
+
+
+class ImageSource:
+    #画像をまとめたZIP。行の image がZIP内にあればその画像を登録し、なければ保存済みの画像の名前として扱う
+    def __init__(self, archive=None):
+        self.archive = zipfile.ZipFile(archive) if archive else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.archive is not None:
+            self.archive.close()
+
+    def member(self, name):
+        if self.archive is None:
+            return None
+        try:
+            return self.archive.getinfo(name)
+        except KeyError:
+            return None
+
+    def open(self, member):
+        return self.archive.open(member)
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = [] #(行番号, メッセージ)
+
+    @property
+    def rows(self):
+        return self.created + self.updated + self.error_count
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def _parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _error_message(form):
+    return " / ".join(
+        f"{form.fields[name].label}: {' '.join(messages)}" if name in form.fields else " ".join(messages)
+        for name, messages in form.errors.items()
+    )
+
+
+def import_products(rows, images=None, batch_size=BATCH_SIZE, log=None):
+    #rows は read_rows() の戻り値。ImportResult を返す
+    from .forms import ProductImportForm
+
+    images = images or ImageSource()
+    log = log or (lambda message: None)
+    result = ImportResult()
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        _import_batch(batch, images, result, ProductImportForm)
+        log(f"{result.rows}行（登録 {result.created}件・更新 {result.updated}件・エラー {result.error_count}件）")
+    return result
+
+
+def _import_batch(batch, images, result, form_class):
+    ids = {_parse_id(row.get("id")) for _, row in batch if row and row.get("id") not in (None, "")}
+    existing = Product.objects.in_bulk(ids - {None})
+
+    created = []
+    updated = {} #同じ商品が複数行あるときは後の行で上書き
+    uploads = [] #(商品, ZIP内の画像)
+
+    for line, row in batch:
+        if row is None:
+            result.add_error(line, "行を読み込めません（JSONのオブジェクトではありません）")
+            continue
+
+        product = None
+        if row.get("id") not in (None, ""):
+            product = existing.get(_parse_id(row["id"]))
+            if product is None:
+                result.add_error(line, f"商品が見つかりません: id={row['id']}")
+                continue
+            #エラーの行で変更された値が、同じ商品の他の行に残らないよう複製に反映する
+            product = copy.copy(product)
+
+        image = str(row.get("image") or "").strip()
+        member = images.member(image) if image else None
+        files = {}
+        if member is not None:
+            files["image"] = UploadedFile(
+                images.open(member), name=os.path.basename(member.filename), size=member.file_size,
+            )
+        stored_image = image if image and member is None else None
+        previous_image = product.image.name if product else None
+
+        form = form_class(row, files, instance=product, stored_image=stored_image)
+        try:
+            valid = form.is_valid()
+        finally:
+            for file in files.values():
+                file.close()
+        if not valid:
+            result.add_error(line, _error_message(form))
+            continue
+
+        product = form.save(commit=False)
+        product.search_text = search.build_search_text(product)
+        if member is not None:
+            #検証に使った画像は手放し、保存時にZIPから読み直す（1バッチ分の画像をメモリに持たない）
+            product.image = previous_image
+            uploads.append((product, member))
+        elif stored_image:
+            #保存済みの画像を共有するだけなので、名前を入れるだけでよい（削除時はストレージが参照中の行を調べる）
+            product.image = stored_image
+
+        if product.pk is None:
+            created.append(product)
+        else:
+            updated[product.pk] = product
+
+    with transaction.atomic():
+        for product, member in uploads:
+            #DBへの書き込みに失敗した場合の画像は、collect_orphaned_media で削除できる
+            with images.open(member) as file:
+                product.image.save(os.path.basename(member.filename), File(file), save=False)
+            product.image_processed = False
+        Product.objects.bulk_create(created)
+        Product.objects.bulk_update(updated.values(), UPDATE_FIELDS)
+
+        for product in updated.values():
+            if product.category != existing[product.pk].category:
+                ranking.move_product_category(product)
+            if product.image.name != existing[product.pk].image.name:
+                #bulk_update はシグナルを通らないため、差し替え前の画像はここで手放す
+                storage.release(existing[product.pk].image.name)
+        search.index_products(created + list(updated.values()))
+        for product, _ in uploads:
+            image_processing.enqueue(product)
+        if created or updated:
+            bump_version(CATALOG)
+
+    result.created += len(created)
+    result.updated += len(updated)
+
+
+class _Echo:
+    #csv.writer の書き込み先（書いた内容をそのまま返す）
+    def write(self, value):
+        return value
+
+
+def stream_rows(rows, columns, fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    #値のタプルを chunk_size 件ずつ CSV / JSON Lines の文字列にして返す（StreamingHttpResponse 用）
+    if fmt == "csv":
+        writer = csv.writer(_Echo())
+        #Excel で文字化けしないよう BOM を付ける
+        yield "\ufeff" + writer.writerow(columns)
+        encode = writer.writerow
+    else:
+        def encode(values):
+            return json.dumps(dict(zip(columns, values)), ensure_ascii=False) + "\n"
+
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        yield "".join(encode(values) for values in chunk)
+
+
+def export_products(fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    #形式は import_products() で読み込めるもの
+    rows = Product.objects.order_by("id").values_list(*EXPORT_COLUMNS).iterator(chunk_size=chunk_size)
+    return stream_rows(rows, EXPORT_COLUMNS, fmt, chunk_size)
@@ -0,0 +1,142 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
+
+#スタッフ向けのサンプリングプロファイラー
+#「?_profile=1」またはヘッダー「X-Profile: 1」で、ビューとテンプレート描画の間の呼び出し履歴を一定間隔で記録する
+#結果は flamegraph.pl / speedscope で読める folded 形式（「関数;関数;... 回数」）で保存する
+#「?_profile=folded」なら保存せず、そのままレスポンスとして返す
+
+QUERY_PARAMETER = "_profile"
+HEADER = "HTTP_X_PROFILE"
+RATE_LIMIT_KEY = "profiling:last"
+
+
+def path_prefixes():
+    #ファイル名を短くするため、プロジェクト・sys.path からの相対パスで表す
+    prefixes = {str(settings.BASE_DIR)} | {path for path in sys.path if path}
+    return sorted((os.path.join(prefix, "") for prefix in prefixes), key=len, reverse=True)
+
+
+def short_path(filename, prefixes):
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            return filename[len(prefix):]
+    return filename
+
+
+class SamplingProfiler:
+    #別スレッドから対象スレッドのスタックを interval 秒ごとに取得する（対象の処理には手を入れない）
+    #all_threads=True なら全スレッドを記録し、スタックの先頭にスレッド名を付ける
+    #（ASGI ではビューがこのミドルウェアと別のスレッド（イベントループ・sync_to_async のスレッド）で動くため。
+    #同時に処理中の他のリクエストや待機中のスレッドも含まれるので、スレッド名で見分ける）
+    def __init__(self, interval, all_threads=False):
+        self.interval = interval
+        self.all_threads = all_threads
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self._prefixes = path_prefixes()
+        self._names = {}
+
+    def __enter__(self):
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._started = time.perf_counter()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+        self.elapsed = time.perf_counter() - self._started
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.all_threads:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                targets = [
+                    (f"thread {names.get(ident, ident)}", frame)
+                    for ident, frame in frames.items()
+                    if ident != own
+                ]
+            else:
+                frame = frames.get(self._target)
+                if frame is None:
+                    break
+                targets = [(None, frame)]
+
+            for thread_name, frame in targets:
+                stack = []
+                while frame is not None:
+                    stack.append(self._name(frame.f_code))
+                    frame = frame.f_back
+                if thread_name is not None:
+                    stack.append(thread_name.replace(";", ":"))
+                #呼び出し元から順に並べる
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            filename = short_path(code.co_filename, self._prefixes)
+            name = f"{code.co_qualname} ({filename}:{code.co_firstlineno})".replace(";", ":")
+            self._names[code] = name
+        return name
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def save_profile(profiler, request):
+    #保存先のファイル名を返す
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    match = request.resolver_match
+    view = (match.view_name if match else "unknown").replace(":", "-")
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{view}-{os.getpid()}.folded"
+    with open(os.path.join(settings.PROFILING_DIR, filename), "w", encoding="utf-8") as file:
+        file.write(profiler.folded())
+    return filename
+
+
+class ProfilingMiddleware:
+    #AuthenticationMiddleware より後に置く
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = request.GET.get(QUERY_PARAMETER) or request.META.get(HEADER)
+        #指定のないリクエストではユーザーも読み込まない
+        if not mode or not request.user.is_staff:
+            return self.get_response(request)
+
+        #PROFILING_MIN_INTERVAL 秒に1回まで（プロファイル自体で負荷をかけない）
+        #プロセス間で共有するキャッシュ（CACHES）に記録するため、全プロセスを合わせた回数で制限される
+        #（ファイルのキャッシュの add は不可分ではないので、同時に来たリクエストがまれに両方通る）
+        if not cache.add(RATE_LIMIT_KEY, time.time(), settings.PROFILING_MIN_INTERVAL):
+            response = self.get_response(request)
+            response["X-Profile"] = "rate-limited"
+            return response
+
+        all_threads = isinstance(request, ASGIRequest)
+        with SamplingProfiler(settings.PROFILING_INTERVAL_MS / 1000, all_threads=all_threads) as profiler:
+            response = self.get_response(request)
+
+        summary = f"samples={profiler.samples}; elapsed={profiler.elapsed * 1000:.1f}ms"
+        if mode == "folded":
+            response = HttpResponse(profiler.folded(), content_type="text/plain; charset=utf-8")
+        else:
+            response["X-Profile-Artifact"] = save_profile(profiler, request)
+        response["X-Profile"] = summary
+        return response
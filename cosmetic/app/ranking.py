@@ -0,0 +1,185 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models.functions import Cast, NullIf
+
+from .models import Product, ProductRanking, Review
+
+#「指定なし」の集計キー
+ALL = ""
+
+
+def _cell_keys(category, skin_type, age):
+    #1件のレビューが加算される集計セル（指定なし／指定ありの組み合わせ）
+    return [
+        (c, s, a)
+        for c in {ALL, category}
+        for s in {ALL, skin_type}
+        for a in {ALL, age}
+    ]
+
+
+def _apply(state, sign):
+    product_id, skin_type, age, rating = state
+
+    #商品の件数・評価分布
+    product_values = {
+        "review_count": F("review_count") + sign,
+        "rating_sum": F("rating_sum") + sign * (rating or 0),
+    }
+    if rating:
+        field = f"rating_{rating}_count"
+        product_values[field] = F(field) + sign
+
+    if not Product.objects.filter(pk=product_id).update(**product_values):
+        #商品ごと削除済み
+        return
+
+    category = (
+        Product.objects
+        .filter(pk=product_id)
+        .values_list("category", flat=True)
+        .get()
+    )
+
+    if sign > 0:
+        ProductRanking.objects.bulk_create(
+            [
+                ProductRanking(product_id=product_id, category=c, skin_type=s, age=a)
+                for c, s, a in _cell_keys(category, skin_type, age)
+            ],
+            ignore_conflicts=True,
+        )
+
+    rating_count = F("rating_count") + (sign if rating else 0)
+    rating_sum = F("rating_sum") + sign * (rating or 0)
+
+    ProductRanking.objects.filter(
+        product_id=product_id,
+        category__in={ALL, category},
+        skin_type__in={ALL, skin_type},
+        age__in={ALL, age},
+    ).update(
+        review_count=F("review_count") + sign,
+        rating_count=rating_count,
+        rating_sum=rating_sum,
+        avg_rating=Cast(rating_sum, FloatField()) / NullIf(rating_count, 0),
+    )
+
+
+def apply_review_change(old_state, new_state):
+    #Review.published_state() の変化分だけ集計を更新
+    if old_state == new_state:
+        return
+
+    with transaction.atomic():
+        if old_state is not None:
+            _apply(old_state, -1)
+        if new_state is not None:
+            _apply(new_state, 1)
+
+
+def move_product_category(product):
+    #商品のカテゴリー変更時、カテゴリー別の集計行を付け替え
+    ProductRanking.objects.filter(product=product).exclude(category=ALL).update(
+        category=product.category
+    )
+
+
+def ranked_products(category=None, skin_type=None, age=None):
+    return (
+        Product.objects
+        .filter(
+            rankings__category=category or ALL,
+            rankings__skin_type=skin_type or ALL,
+            rankings__age=age or ALL,
+            rankings__review_count__gt=0,
+        )
+        .annotate(
+            ranked_review_count=F("rankings__review_count"),
+            ranked_avg_rating=F("rankings__avg_rating"),
+        )
+        #評価のないレビューだけの商品（平均がNULL）は、同じ件数の中で最後（PostgreSQL の降順は NULL が先頭になるため明示）
+        .order_by("-ranked_review_count", F("ranked_avg_rating").desc(nulls_last=True), "id")
+    )
+
+
+def rebuild(batch_size=1000):
+    #公開済みレビューから集計を作り直す
+    cells = defaultdict(lambda: [0, 0, 0])
+
+    groups = (
+        Review.objects
+        .filter(is_draft=False, posted_at__isnull=False)
+        .values("product_id", "product__category", "skin_type", "age")
+        .annotate(
+            review_count=Count("id"),
+            rating_count=Count("rating"),
+            rating_sum=Sum("rating"),
+        )
+        .order_by()
+    )
+
+    for group in groups.iterator():
+        for key in _cell_keys(group["product__category"], group["skin_type"], group["age"]):
+            cell = cells[(group["product_id"],) + key]
+            cell[0] += group["review_count"]
+            cell[1] += group["rating_count"]
+            cell[2] += group["rating_sum"] or 0
+
+    rows = [
+        ProductRanking(
+            product_id=product_id,
+            category=category,
+            skin_type=skin_type,
+            age=age,
+            review_count=review_count,
+            rating_count=rating_count,
+            rating_sum=rating_sum,
+            avg_rating=rating_sum / rating_count if rating_count else None,
+        )
+        for (product_id, category, skin_type, age), (review_count, rating_count, rating_sum)
+        in cells.items()
+    ]
+
+    with transaction.atomic():
+        ProductRanking.objects.all().delete()
+        ProductRanking.objects.bulk_create(rows, batch_size=batch_size)
+
+    return len(rows)
+
+
+def rebuild_product_stats(batch_size=1000):
+    #公開済みレビューから商品ごとの件数・評価分布を作り直す
+    published = Q(reviews__is_draft=False, reviews__posted_at__isnull=False)
+    stats = {
+        "review_count": Count("reviews", filter=published),
+        "rating_sum": Sum("reviews__rating", filter=published, default=0),
+    }
+    for rating in range(1, 6):
+        stats[f"rating_{rating}_count"] = Count(
+            "reviews", filter=published & Q(reviews__rating=rating)
+        )
+
+    fields = list(stats)
+    products = Product.objects.only("id").annotate(
+        **{f"new_{name}": aggregate for name, aggregate in stats.items()}
+    ).order_by("id")
+
+    count = 0
+    batch = []
+    with transaction.atomic():
+        for product in products.iterator(chunk_size=batch_size):
+            for name in fields:
+                setattr(product, name, getattr(product, f"new_{name}"))
+            batch.append(product)
+            if len(batch) >= batch_size:
+                Product.objects.bulk_update(batch, fields)
+                count += len(batch)
+                batch = []
+        if batch:
+            Product.objects.bulk_update(batch, fields)
+            count += len(batch)
+
+    return count
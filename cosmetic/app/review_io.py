@@ -0,0 +1,54 @@
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from .models import Review
+from .product_io import EXPORT_CHUNK_SIZE, stream_rows
+
+#公開済みレビューの書き出し（CSV / JSON Lines、運営の分析用）
+#values_list() で商品を結合して読み、iterator() で chunk_size 件ずつ取り出して書き出す。全件をメモリに載せない
+#投稿者は含めない
+
+EXPORT_COLUMNS = ["id", "product_id", "cosme_name", "category", "age", "skin_type", "rating", "created_at", "posted_at"]
+QUERY_COLUMNS = [
+    "id", "product_id", "product__cosme_name", "product__category",
+    "age", "skin_type", "rating", "created_at", "posted_at",
+]
+TIME_COLUMNS = [EXPORT_COLUMNS.index("created_at"), EXPORT_COLUMNS.index("posted_at")]
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+def published_reviews(date_from=None, date_to=None, category=None):
+    #日付は投稿日（TIME_ZONE の日付）で、date_to の日も含む
+    #posted_at を関数で包まずに範囲で絞り込み、公開済みレビューの索引（review_published_idx）を使う
+    reviews = Review.objects.filter(is_draft=False, posted_at__isnull=False)
+    if date_from:
+        reviews = reviews.filter(posted_at__gte=_start_of_day(date_from))
+    if date_to:
+        reviews = reviews.filter(posted_at__lt=_start_of_day(date_to + timedelta(days=1)))
+    if category:
+        reviews = reviews.filter(product__category=category)
+    return reviews.order_by("posted_at", "id")
+
+
+def _localize(tz):
+    #日時は TIME_ZONE の ISO 8601 で書き出す（タイムゾーンは行ごとに調べず、最初に1回だけ取得する）
+    def localize(values):
+        values = list(values)
+        for i in TIME_COLUMNS:
+            values[i] = values[i].astimezone(tz).isoformat() if values[i] else None
+        return values
+    return localize
+
+
+def export_reviews(fmt, date_from=None, date_to=None, category=None, chunk_size=EXPORT_CHUNK_SIZE):
+    rows = (
+        published_reviews(date_from, date_to, category)
+        .values_list(*QUERY_COLUMNS)
+        .iterator(chunk_size=chunk_size)
+    )
+    localize = _localize(timezone.get_current_timezone())
+    return stream_rows(map(localize, rows), EXPORT_COLUMNS, fmt, chunk_size)
@@ -0,0 +1,89 @@
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+
+#読み込みの多いビューをレプリカへ振り分ける
+#対象のビューには @replica_reads を付ける。書き込みはすべてプライマリ（default）
+#書き込みをしたユーザーは、REPLICA_STICKY_SECONDS の間プライマリから読む（レプリカの遅延で自分の投稿が見えなくならないように）
+
+PRIMARY = "default"
+STICKY_COOKIE = "primary_reads"
+
+_routing = contextvars.ContextVar("db_routing", default=None)
+
+
+class RequestRouting:
+    def __init__(self, sticky):
+        self.sticky = sticky #直前に書き込みをしたユーザー
+        self.replica = False #レプリカから読んでよいビュー
+        self.wrote = False
+
+    def use_replica(self):
+        return self.replica and not self.sticky and not self.wrote
+
+
+def replica_reads(view_func):
+    #レプリカから読んでよいビューの目印（遅延した内容を表示しても問題ない一覧・詳細）
+    view_func.replica_reads = True
+    return view_func
+
+
+@contextmanager
+def primary_reads():
+    #レプリカ対象のビューの中でも、この間はプライマリから読む
+    routing = _routing.get()
+    replica = routing.replica if routing is not None else False
+    if routing is not None:
+        routing.replica = False
+    try:
+        yield
+    finally:
+        if routing is not None:
+            routing.replica = replica
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if settings.DATABASE_REPLICAS and routing is not None and routing.use_replica():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #レプリカはプライマリの複製なので、どのDBから読んだオブジェクト同士でも関連付けてよい
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = RequestRouting(sticky=STICKY_COOKIE in request.COOKIES)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+        if routing.wrote:
+            response.set_cookie(
+                STICKY_COOKIE, "1",
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routing = _routing.get()
+        if routing is not None:
+            routing.replica = getattr(view_func, "replica_reads", False)
@@ -0,0 +1,242 @@
+import unicodedata
+
+from django.db import connection, connections, router, transaction
+from django.db.models import Case, IntegerField, Value, When
+from django.db.models.functions import Length
+
+from .models import Product, ProductSearchGram
+
+SEARCH_LIMIT = 200 #検索結果の最大件数
+TRIGRAM_MIN_LENGTH = 3 #トライグラム索引が使える最短の語長（これより短い語は2文字単位の索引で探す）
+
+FTS_TABLE = "app_product_fts"
+
+#カタカナ→ひらがな（ァ〜ヶ）
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+
+def normalize(text):
+    #全角/半角・互換文字（NFKC）、大文字/小文字、カタカナ/ひらがなの違いを吸収
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return text.translate(KATAKANA_TO_HIRAGANA)
+
+
+def split_terms(query):
+    return [term for term in normalize(query).split() if term]
+
+
+def build_search_text(product):
+    #商品名・カテゴリー（値と表示名）を検索対象にする
+    from .forms import CosmeForm
+
+    category_label = dict(CosmeForm.CATEGORY_CHOICES).get(product.category, "")
+    return normalize(f"{product.cosme_name} {product.category} {category_label}")
+
+
+def search_grams(text):
+    #語ごとに2文字ずつ区切る（語の最後の1文字も含める。1文字の語は、その文字で始まるものを探す）
+    return {word[i:i + 2] for word in text.split() for i in range(len(word))}
+
+
+def ranked(qs, terms, limit):
+    #すべての語を含む商品を、先頭の語で始まるもの・商品名の短いもの順に
+    for term in terms:
+        qs = qs.filter(search_text__contains=term)
+
+    first = terms[0]
+    return qs.annotate(
+        search_rank=Case(
+            When(search_text__startswith=first, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+        name_length=Length("cosme_name"),
+    ).order_by("search_rank", "name_length", "id")[:limit]
+
+
+class LikeBackend:
+    #索引なし（部分一致）。未対応DBで使う
+    def search(self, terms, limit):
+        return ranked(Product.objects.all(), terms, limit)
+
+    def index(self, products):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+
+class GramBackend(LikeBackend):
+    #2文字単位の索引（ProductSearchGram）。3文字未満の語はここで候補を絞り、部分一致で確かめる
+    #（商品の削除時は外部キーの CASCADE で消える）
+    def search(self, terms, limit):
+        qs = Product.objects.all()
+        for term in terms:
+            if len(term) < TRIGRAM_MIN_LENGTH:
+                qs = qs.filter(pk__in=self._matches(term))
+        return ranked(qs, terms, limit)
+
+    def _matches(self, term):
+        grams = ProductSearchGram.objects.values("product_id")
+        if len(term) == 2:
+            return grams.filter(gram=term)
+        #1文字の語: その文字で始まる2文字（語の最後の1文字を含む）を範囲で探す
+        return grams.filter(gram__gte=term, gram__lte=term + "\U0010ffff")
+
+    def index(self, products):
+        products = [product for product in products if product.pk]
+        if not products:
+            return
+        ProductSearchGram.objects.filter(product__in=[product.pk for product in products]).delete()
+        ProductSearchGram.objects.bulk_create(
+            [
+                ProductSearchGram(product_id=product.pk, gram=gram)
+                for product in products
+                for gram in search_grams(product.search_text)
+            ],
+            batch_size=1000,
+        )
+
+    def clear(self):
+        ProductSearchGram.objects.all().delete()
+
+
+class SQLiteFTSBackend(GramBackend):
+    #FTS5 トライグラム索引（app_product_fts、rowid = Product.id）
+    def search(self, terms, limit):
+        if min(len(term) for term in terms) < TRIGRAM_MIN_LENGTH:
+            return super().search(terms, limit)
+
+        match = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        #索引の検索と商品の読み込みは同じDB（レプリカ対象のビューではレプリカ）から行う
+        alias = router.db_for_read(Product)
+        with connections[alias].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                "ORDER BY rank, rowid LIMIT %s",
+                [match, limit],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+
+        return ordered_by_ids(ids, using=alias)
+
+    def index(self, products):
+        super().index(products)
+        rows = [(product.pk, product.search_text) for product in products if product.pk]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            self._delete(cursor, [pk for pk, _ in rows])
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, search_text) VALUES (%s, %s)",
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            self._delete(cursor, list(product_ids))
+
+    def clear(self):
+        super().clear()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    def _delete(self, cursor, product_ids):
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+            [(pk,) for pk in product_ids],
+        )
+
+
+class PostgresTrigramBackend(GramBackend):
+    #pg_trgm の GIN 索引（search_text）。LIKE '%語%' が索引を使い、類似度で並べる
+    def search(self, terms, limit):
+        if min(len(term) for term in terms) < TRIGRAM_MIN_LENGTH:
+            return super().search(terms, limit)
+
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        qs = Product.objects.all()
+        for term in terms:
+            qs = qs.filter(search_text__contains=term)
+
+        return qs.annotate(
+            similarity=TrigramWordSimilarity(" ".join(terms), "search_text"),
+        ).order_by("-similarity", "id")[:limit]
+
+
+def ordered_by_ids(ids, using=None):
+    if not ids:
+        return Product.objects.none()
+    order = Case(
+        *[When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)],
+        output_field=IntegerField(),
+    )
+    return Product.objects.using(using).filter(pk__in=ids).order_by(order)
+
+
+_backend = None
+
+
+def has_fts_table():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [FTS_TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if connection.vendor == "sqlite" and has_fts_table():
+            _backend = SQLiteFTSBackend()
+        elif connection.vendor == "postgresql":
+            _backend = PostgresTrigramBackend()
+        else:
+            _backend = GramBackend()
+    return _backend
+
+
+def search_products(query, limit=SEARCH_LIMIT):
+    #関連度順の Product クエリセットを返す
+    terms = split_terms(query)
+    if not terms:
+        return Product.objects.none()
+    return get_backend().search(terms, limit)
+
+
+def index_products(products):
+    get_backend().index(products)
+
+
+def remove_products(product_ids):
+    get_backend().remove(product_ids)
+
+
+def rebuild(batch_size=1000):
+    #全商品の search_text と索引を作り直す
+    backend = get_backend()
+
+    count = 0
+    batch = []
+    with transaction.atomic():
+        backend.clear()
+        for product in Product.objects.only("id", "cosme_name", "category").iterator(chunk_size=batch_size):
+            product.search_text = build_search_text(product)
+            batch.append(product)
+            if len(batch) >= batch_size:
+                Product.objects.bulk_update(batch, ["search_text"])
+                backend.index(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            Product.objects.bulk_update(batch, ["search_text"])
+            backend.index(batch)
+            count += len(batch)
+
+    return count
@@ -1,14 +1,142 @@
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Profile
+from .models import Profile, Product, Review, ReviewFavorite
+from . import image_processing, ranking, search, storage
+from .metrics import inc, observe
+from .versions import CATALOG, REVIEWS, bump_version
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
-        
+
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, "profile"):
         instance.profile.save()
+
+
+#レビューの状態変化をランキング集計へ反映
+@receiver(pre_save, sender=Review)
+def load_review_state(sender, instance, raw, **kwargs):
+    if raw or hasattr(instance, "_loaded_state"):
+        return
+    if instance._state.adding:
+        instance._loaded_state = None
+        return
+
+    #一部項目のみ読み込んだインスタンスはDBから保存前の状態を取得
+    loaded = (
+        Review.objects
+        .filter(pk=instance.pk)
+        .only(*Review.PUBLISHED_STATE_FIELDS)
+        .first()
+    )
+    instance._loaded_state = loaded.published_state() if loaded else None
+
+
+@receiver(post_save, sender=Review)
+def update_review_ranking(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    new_state = instance.published_state()
+    ranking.apply_review_change(instance._loaded_state, new_state)
+    if instance._loaded_state is None and new_state is not None:
+        inc("app_review_posts_total")
+    #公開中のレビューに関わる保存（本文の編集を含む）はキャッシュを無効化
+    if instance._loaded_state is not None or new_state is not None:
+        bump_version(REVIEWS)
+    instance._loaded_state = new_state
+
+
+@receiver(post_delete, sender=Review)
+def delete_review_ranking(sender, instance, origin=None, **kwargs):
+    loaded_state = getattr(instance, "_loaded_state", None)
+    #商品ごとの削除では商品の集計行も消えるため、1件ずつの差分更新は不要
+    if not isinstance(origin, Product):
+        ranking.apply_review_change(loaded_state, None)
+    if loaded_state is not None:
+        bump_version(REVIEWS)
+
+
+@receiver(post_save, sender=Product)
+def update_product_ranking(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    if not created and getattr(instance, "_loaded_category", instance.category) != instance.category:
+        ranking.move_product_category(instance)
+    instance._loaded_category = instance.category
+
+
+#お気に入り数の差分更新
+@receiver(post_save, sender=ReviewFavorite)
+def increment_favorite_count(sender, instance, created, raw, **kwargs):
+    if raw or not created:
+        return
+    Review.objects.filter(pk=instance.review_id).update(favorite_count=F("favorite_count") + 1)
+
+
+@receiver(post_delete, sender=ReviewFavorite)
+def decrement_favorite_count(sender, instance, origin=None, **kwargs):
+    #レビュー・商品ごとの削除では、対象のレビュー自体が消える
+    if isinstance(origin, (Review, Product)):
+        return
+    #同じお気に入りを別々に読み込んで2回削除しても、0 より小さくしない
+    Review.objects.filter(pk=instance.review_id, favorite_count__gt=0).update(favorite_count=F("favorite_count") - 1)
+
+
+#商品検索の索引を同期
+@receiver(pre_save, sender=Product)
+def set_product_search_text(sender, instance, raw, **kwargs):
+    if not raw:
+        instance.search_text = search.build_search_text(instance)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance])
+    bump_version(CATALOG)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+    bump_version(CATALOG)
+
+
+#アップロード画像の後処理
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=Review)
+def detect_image_upload(sender, instance, raw, **kwargs):
+    #保存前の未コミットのファイル＝今回アップロードされた画像
+    instance._image_uploaded = not raw and bool(instance.image) and not instance.image._committed
+    if instance._image_uploaded:
+        #処理が終わるまでは未処理として残す（処理前にプロセスが止まっても process_pending_images で処理し直せる）
+        instance.image_processed = False
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Review)
+def process_uploaded_image(sender, instance, raw, **kwargs):
+    if getattr(instance, "_image_uploaded", False):
+        instance._image_uploaded = False
+        observe("app_upload_size_bytes", instance.image.size, model=sender._meta.model_name)
+        image_processing.enqueue(instance)
+
+
+#使われなくなった画像ファイルの削除（同じ内容の画像を他の行が参照していれば残す）
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Review)
+def release_replaced_image(sender, instance, raw, **kwargs):
+    loaded = getattr(instance, "_loaded_image", None)
+    instance._loaded_image = instance.image.name or None
+    if not raw and loaded and loaded != instance._loaded_image:
+        storage.release(loaded)
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Review)
+def release_deleted_image(sender, instance, **kwargs):
+    storage.release(instance.image.name)
@@ -0,0 +1,249 @@
+import hashlib
+import heapq
+import os
+import re
+import shutil
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import connection, transaction
+from django.db.models.functions import Collate
+
+HASH_LENGTH = 64 #sha256（16進）
+
+#「<アップロード先>/ab/cd/<ハッシュ>.<拡張子>」
+CONTENT_ADDRESSED_NAME = re.compile(
+    r"(?:.*/)?([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{%d})(\.\w+)?$" % (HASH_LENGTH - 4)
+)
+
+
+def is_content_addressed(name):
+    return bool(CONTENT_ADDRESSED_NAME.match(name or ""))
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    #ファイル名を内容のハッシュにし、先頭4文字で2階層に振り分けて保存する
+    #同じ内容のファイルは1つだけ保存して複数の行から参照し、どの行からも参照されなくなったときだけ削除する
+
+    def __init__(self, **kwargs):
+        #同名＝同じ内容なので、上書きされても問題ない
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(**kwargs)
+
+    def hashed_name(self, name, content):
+        directory = os.path.dirname(name)
+        if is_content_addressed(name):
+            #保存済みの画像から作ったファイルは、振り分け用の2階層を除いた場所に置く
+            directory = os.path.dirname(os.path.dirname(directory))
+        ext = os.path.splitext(name)[1].lower()
+        digest = content_hash(content)
+        return os.path.join(directory, digest[:2], digest[2:4], f"{digest}{ext}").replace("\\", "/")
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content)
+        try:
+            #既にある内容なら保存しない。更新日時は新しくし、未参照ファイルの削除対象から外す
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            name = super()._save(name, content)
+        return name
+
+    def delete(self, name):
+        #他の商品・レビューが同じ内容の画像を参照していれば実体は消さない
+        #参照数は別に数えず、その時点の行を調べる（行の削除・画像の差し替えのたびに数を合わせる必要がなく、ずれない）
+        if not name or is_referenced(name) or self.recently_saved(name):
+            return
+        super().delete(name)
+
+    def recently_saved(self, name):
+        #同じ内容のアップロードが _save で既存のファイルを使い、まだ行をコミットしていない場合がある（その行はまだ見えない）
+        #保存時に更新日時を新しくしているので、MEDIA_DELETE_MIN_AGE 秒より新しいファイルは消さずに残す
+        #（残ったファイルは collect_orphaned_media で削除される）
+        if not is_content_addressed(name):
+            return False
+        try:
+            mtime = os.stat(self.path(name)).st_mtime
+        except FileNotFoundError:
+            return False
+        return mtime > time.time() - settings.MEDIA_DELETE_MIN_AGE
+
+
+def is_referenced(name):
+    return any(model.objects.filter(image=name).exists() for model in image_models())
+
+
+def release(name, storage=None):
+    #行の削除・画像の差し替えで使われなくなった画像を、コミット後に（他から参照されていなければ）削除する
+    storage = storage or default_storage
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+def image_models():
+    from .models import Product, Review
+
+    return [Product, Review]
+
+
+def _legacy_names(model, batch_size):
+    #まだハッシュ名になっていない画像名（重複なし、名前順に少しずつ）
+    last = ""
+    while True:
+        names = list(
+            model.objects
+            .filter(image__gt=last)
+            .order_by("image")
+            .values_list("image", flat=True)
+            .distinct()[:batch_size]
+        )
+        if not names:
+            return
+        last = names[-1]
+        yield [name for name in names if not is_content_addressed(name)]
+
+
+def relocate(name, storage=None):
+    #旧形式のファイル1件をハッシュ名へ移し、参照している行を付け替える
+    storage = storage or default_storage
+    if not storage.exists(name):
+        return None
+
+    with storage.open(name, "rb") as source:
+        new_name = storage.save(name, source)
+
+    with transaction.atomic():
+        for model in image_models():
+            model.objects.filter(image=name).update(image=new_name)
+
+    storage.delete(name)
+    return new_name
+
+
+def relocate_legacy_files(batch_size=500, storage=None):
+    #既存の画像をハッシュ名・階層ディレクトリへ移す（何度実行してもよい）
+    from .versions import CATALOG, REVIEWS, bump_version
+
+    moved = 0
+    missing = 0
+    for model in image_models():
+        for names in _legacy_names(model, batch_size):
+            for name in names:
+                if relocate(name, storage) is None:
+                    missing += 1
+                else:
+                    moved += 1
+
+    if moved:
+        bump_version(CATALOG)
+        bump_version(REVIEWS)
+    return moved, missing
+
+
+def _stored_files(root, prefix):
+    #ディレクトリを名前順にたどり、(ファイル名, stat) を文字列順で返す
+    #（ディレクトリは「名前/」として並べると、パス全体の文字列順と一致する）
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name)
+
+    for entry in entries:
+        name = prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield from _stored_files(entry.path, name + "/")
+        elif entry.is_file(follow_symlinks=False):
+            yield name, entry.stat(follow_symlinks=False)
+
+
+def _referenced_names(batch_size):
+    #画像を参照している名前を文字列順で返す（各テーブルを少しずつ読み、マージ）
+    order = "image"
+    if connection.vendor == "postgresql":
+        #ロケール依存の照合順序だとファイル側の並びと合わないため
+        order = Collate("image", "C")
+
+    streams = [
+        model.objects
+        .filter(image__gt="")
+        .order_by(order)
+        .values_list("image", flat=True)
+        .iterator(chunk_size=batch_size)
+        for model in image_models()
+    ]
+    return heapq.merge(*streams)
+
+
+def upload_directories():
+    directories = {
+        model._meta.get_field("image").upload_to.strip("/") + "/"
+        for model in image_models()
+    }
+    return sorted(directories)
+
+
+def find_orphans(storage=None, batch_size=500, min_age=24 * 60 * 60):
+    #どの行からも参照されていないファイル (名前, サイズ) を返す
+    #保存直後（行の保存前・後処理中）のファイルを消さないよう、min_age 秒より新しいものは除く
+    storage = storage or default_storage
+    cutoff = time.time() - min_age
+
+    referenced = _referenced_names(batch_size)
+    current = next(referenced, None)
+
+    for directory in upload_directories():
+        for name, stat in _stored_files(storage.path(directory), directory):
+            while current is not None and current < name:
+                current = next(referenced, None)
+            if current == name or stat.st_mtime > cutoff:
+                continue
+            yield name, stat.st_size
+
+
+def remove_orphans(names, storage=None, quarantine_root=None):
+    #quarantine_root を指定すると削除せずにそこへ移動する
+    storage = storage or default_storage
+    for name in names:
+        path = storage.path(name)
+        try:
+            if quarantine_root:
+                destination = os.path.join(quarantine_root, name)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.move(path, destination)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def collect_orphans(batch_size=500, min_age=24 * 60 * 60, dry_run=False, quarantine=False, storage=None, report=None):
+    #未参照ファイルを batch_size 件ずつ削除（または隔離）し、(件数, バイト数) を返す
+    quarantine_root = settings.MEDIA_QUARANTINE_ROOT if quarantine else None
+
+    count = 0
+    total_size = 0
+    batch = []
+    for name, size in find_orphans(storage, batch_size, min_age):
+        count += 1
+        total_size += size
+        if report:
+            report(name, size)
+        if dry_run:
+            continue
+        batch.append(name)
+        if len(batch) >= batch_size:
+            remove_orphans(batch, storage, quarantine_root)
+            batch = []
+    if batch:
+        remove_orphans(batch, storage, quarantine_root)
+
+    return count, total_size
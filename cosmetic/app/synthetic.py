@@ -0,0 +1,220 @@
+import random
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import ranking, search
+from .forms import CosmeForm
+from .models import AGE_CHOICES, GENDER_CHOICES, SKIN_CHOICES, Product, Profile, Review, ReviewFavorite
+from .versions import CATALOG, REVIEWS, bump_version
+
+#負荷試験用のデータ生成（シグナルを通さず bulk_create でまとめて登録）
+
+BRANDS = ["ルミエール", "さくら堂", "ミネラリー", "アクアベール", "ハナミズキ", "ナチュリア", "シロツメ", "コトノハ"]
+SERIES = ["モイスト", "クリア", "ブライト", "エッセンシャル", "プレミアム", "ナチュラル", "薬用", "オーガニック"]
+ITEMS = {
+    "skincare": ["化粧水", "乳液", "美容液", "クリーム", "クレンジング", "洗顔フォーム"],
+    "uvcare": ["日焼け止めジェル", "UVミルク", "UVスプレー"],
+    "basemake": ["ファンデーション", "化粧下地", "コンシーラー", "フェイスパウダー"],
+    "pointmake": ["リップ", "アイシャドウ", "マスカラ", "チーク", "アイライナー"],
+    "bodycare": ["ボディクリーム", "ボディソープ", "ハンドクリーム"],
+    "haircare": ["シャンプー", "トリートメント", "ヘアオイル"],
+    "other": ["ネイル", "フレグランス", "入浴剤"],
+}
+
+GOOD_POINTS = [
+    "しっとりするのにべたつかないところが気に入っています。",
+    "香りが控えめで毎日使いやすいです。",
+    "伸びが良く、少量で顔全体に広がります。",
+    "肌荒れしにくく、敏感肌でも安心して使えました。",
+    "プチプラなのに品質が良いと思います。",
+    "パッケージがかわいくて気分が上がります。",
+    "朝までうるおいが続きました。",
+    "色持ちが良く、夕方まで崩れにくいです。",
+]
+BAD_POINTS = [
+    "容器が出しにくいのが少し残念です。",
+    "冬場は少し乾燥が気になりました。",
+    "香りが好みではありませんでした。",
+    "量が少なく、すぐになくなってしまいます。",
+    "お店によって品切れのことが多いです。",
+    "特にありません。",
+    "",
+]
+
+#評価は高めに偏る（★1〜★5の重み）
+RATING_WEIGHTS = [4, 7, 16, 36, 37]
+AGE_WEIGHTS = [8, 32, 27, 18, 10, 5]
+GENDER_WEIGHTS = [10, 80, 3, 7]
+SKIN_WEIGHTS = [25, 25, 15, 25, 10]
+
+POSTED_WITHIN = timedelta(days=365)
+#投稿日時はこの日の0時（TIME_ZONE）からさかのぼって作る（実行した日によって内容が変わらないように）
+REFERENCE_DATE = date(2026, 1, 1)
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bulk_create(model, objects, batch_size, **kwargs):
+    #batch_size 件ずつ登録し、登録したオブジェクト（pk設定済み）を返す
+    for batch in _batches(objects, batch_size):
+        with transaction.atomic():
+            yield model.objects.bulk_create(batch, **kwargs)
+
+
+def create_users(rng, count, batch_size, prefix="load", password="password"):
+    #ユーザーとプロフィール（年代・性別・肌質は分布に従う）。作成したユーザーの (id, 年代, 肌質) を返す
+    start = User.objects.filter(username__startswith=prefix).count()
+    hashed = make_password(password)
+
+    users = (
+        User(username=f"{prefix}{start + i:07d}", password=hashed)
+        for i in range(count)
+    )
+    reviewers = []
+    for created in _bulk_create(User, users, batch_size):
+        profiles = []
+        for user in created:
+            profile = Profile(
+                user_id=user.pk,
+                age=rng.choices([value for value, _ in AGE_CHOICES], AGE_WEIGHTS)[0],
+                gender=rng.choices([value for value, _ in GENDER_CHOICES], GENDER_WEIGHTS)[0],
+                skin_type=rng.choices([value for value, _ in SKIN_CHOICES], SKIN_WEIGHTS)[0],
+            )
+            profiles.append(profile)
+            reviewers.append((user.pk, profile.age, profile.skin_type))
+        Profile.objects.bulk_create(profiles)
+    return reviewers
+
+
+def create_products(rng, count, batch_size):
+    categories = [value for value, _ in CosmeForm.CATEGORY_CHOICES if value]
+
+    def products():
+        for i in range(count):
+            category = rng.choice(categories)
+            product = Product(
+                cosme_name=f"{rng.choice(BRANDS)} {rng.choice(SERIES)} {rng.choice(ITEMS[category])} {i + 1}",
+                category=category,
+                price=rng.randrange(500, 10000, 100),
+            )
+            product.search_text = search.build_search_text(product)
+            yield product
+
+    product_ids = []
+    for created in _bulk_create(Product, products(), batch_size):
+        product_ids.extend(product.pk for product in created)
+    return product_ids
+
+
+def create_reviews(rng, count, reviewers, product_ids, batch_size, draft_ratio=0.1, reference_date=REFERENCE_DATE):
+    #商品の人気は偏る（上位の商品ほどレビューが多い）。公開済みレビューのIDを返す
+    popularity = list(accumulate(1 / rank for rank in range(1, len(product_ids) + 1)))
+    until = timezone.make_aware(datetime.combine(reference_date, time.min))
+    seconds = int(POSTED_WITHIN.total_seconds())
+
+    def reviews():
+        for _ in range(count):
+            user_id, age, skin_type = rng.choice(reviewers)
+            is_draft = rng.random() < draft_ratio
+            yield Review(
+                user_id=user_id,
+                product_id=rng.choices(product_ids, cum_weights=popularity)[0],
+                age=age,
+                skin_type=skin_type,
+                rating=rng.choices(range(1, 6), RATING_WEIGHTS)[0],
+                goodpoint_comment="".join(rng.sample(GOOD_POINTS, rng.randint(1, 2))),
+                badpoint_comment=rng.choice(BAD_POINTS),
+                is_draft=is_draft,
+                posted_at=None if is_draft else until - timedelta(seconds=rng.randrange(seconds)),
+            )
+
+    published_ids = []
+    for created in _bulk_create(Review, reviews(), batch_size):
+        published_ids.extend(review.pk for review in created if not review.is_draft)
+    return published_ids
+
+
+def create_favorites(rng, count, reviewers, published_ids, batch_size):
+    #同じ組み合わせは無視するため、作成数は count 以下になる
+    if not reviewers or not published_ids:
+        return
+
+    favorites = (
+        ReviewFavorite(user_id=rng.choice(reviewers)[0], review_id=rng.choice(published_ids))
+        for _ in range(count)
+    )
+    for _ in _bulk_create(ReviewFavorite, favorites, batch_size, ignore_conflicts=True):
+        pass
+
+
+def recount_favorites():
+    counts = (
+        ReviewFavorite.objects
+        .filter(review=OuterRef("pk"))
+        .values("review")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Review.objects.update(favorite_count=Coalesce(Subquery(counts), 0))
+
+
+def check_counts(users, products, reviews):
+    #レビューを作れない指定なら、その理由を返す（0件指定のときは既存のユーザー・商品を使う）
+    if not reviews:
+        return None
+    if not users and not Profile.objects.exists():
+        return "レビューを作成するには、ユーザーが1件以上必要です（--users で作成してください）"
+    if not products and not Product.objects.exists():
+        return "レビューを作成するには、商品が1件以上必要です（--products で作成してください）"
+    return None
+
+
+def generate(users, products, reviews, favorites, draft_ratio=0.1, seed=0, batch_size=5000,
+             reference_date=REFERENCE_DATE, log=None):
+    #同じ seed・reference_date なら同じ内容のデータを作る
+    error = check_counts(users, products, reviews)
+    if error:
+        raise ValueError(error)
+
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    reviewers = create_users(rng, users, batch_size)
+    log(f"ユーザー: {len(reviewers)}件")
+    product_ids = create_products(rng, products, batch_size)
+    log(f"商品: {len(product_ids)}件")
+
+    #0件指定のときは既存のデータを使う
+    reviewers = reviewers or list(Profile.objects.values_list("user_id", "age", "skin_type"))
+    product_ids = product_ids or list(Product.objects.values_list("id", flat=True))
+
+    published_ids = create_reviews(rng, reviews, reviewers, product_ids, batch_size, draft_ratio, reference_date)
+    log(f"レビュー: {reviews}件（公開 {len(published_ids)}件）")
+    published_ids = published_ids or list(Review.objects.filter(is_draft=False).values_list("id", flat=True))
+    create_favorites(rng, favorites, reviewers, published_ids, batch_size)
+    log("お気に入りを登録しました")
+
+    #bulk_create はシグナルを通らないため、集計・お気に入り数・検索索引をまとめて作り直す
+    recount_favorites()
+    ranking.rebuild(batch_size=batch_size)
+    ranking.rebuild_product_stats(batch_size=batch_size)
+    search.rebuild(batch_size=batch_size)
+    bump_version(CATALOG)
+    bump_version(REVIEWS)
+    log("集計と検索索引を再構築しました")
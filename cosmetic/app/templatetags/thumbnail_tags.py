@@ -0,0 +1,48 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
+
+from .. import thumbnails
+
+register = template.Library()
+
+
+def thumbnail_url(name, width, fmt):
+    return reverse("form_app:thumbnail", args=[width, fmt, name])
+
+
+def thumbnail_srcset(name, size, fmt):
+    #1x/2x（高解像度画面）用。同じ段階になる場合は1つにまとめる
+    urls = []
+    for density in (1, 2):
+        width = thumbnails.bucket_for(size * density)
+        url = thumbnail_url(name, width, fmt)
+        if url not in [u for u, _ in urls]:
+            urls.append((url, f"{density}x"))
+    return ", ".join(f"{url} {density}" for url, density in urls)
+
+
+@register.simple_tag
+def thumbnail(image, size, **attrs):
+    #表示サイズ size（CSSの枠の幅）に合わせた縮小画像。WebP非対応ならJPEG
+    if not image:
+        return ""
+
+    name = image.name
+    attrs = {key.replace("_", "-"): value for key, value in attrs.items()}
+    attrs.setdefault("alt", "")
+    attrs.setdefault("loading", "lazy")
+    attrs.setdefault("decoding", "async")
+
+    #縦横比を保って size 四方に収めた大きさ（縦横が読めなければ幅だけ）
+    width, height = thumbnails.display_size(name, size)
+    attrs = {"width": width, **({"height": height} if height else {}), **attrs}
+
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}"{}></picture>',
+        thumbnail_srcset(name, size, "webp"),
+        thumbnail_url(name, thumbnails.bucket_for(size), "jpeg"),
+        thumbnail_srcset(name, size, "jpeg"),
+        format_html_join("", ' {}="{}"', attrs.items()),
+    )
@@ -0,0 +1,18 @@
+import logging
+
+from django.test.runner import DiscoverRunner
+
+PERFORMANCE_LOGGER = "app.performance"
+
+
+class TestRunner(DiscoverRunner):
+    #テスト中は遅いリクエスト・クエリのログを画面に出さない（内容は assertLogs で確かめる）
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        logger = logging.getLogger(PERFORMANCE_LOGGER)
+        self._performance_handlers = logger.handlers
+        logger.handlers = [logging.NullHandler()]
+
+    def teardown_test_environment(self, **kwargs):
+        logging.getLogger(PERFORMANCE_LOGGER).handlers = self._performance_handlers
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1670 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import zipfile
+from datetime import datetime, timedelta
 
-# Create your tests here.
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, router, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import async_views, autocomplete, memory, metrics, product_io, profiling, ranking, review_io, search, storage, synthetic, thumbnails, views
+from . import urls as app_urls
+from .db import retry_on_lock
+from .models import AGE_CHOICES, SKIN_CHOICES, Product, ProductRanking, Review, ReviewFavorite
+from .pagination import FEED_PAGE_SIZE, encode_cursor, keyset_page
+from .routers import STICKY_COOKIE, ReplicaRoutingMiddleware, replica_reads
+from .fragments import fragment_key
+from .versions import CATALOG, REVIEWS, bump_version, get_version
+
+CATEGORIES = ["skincare", "uvcare", "basemake", "pointmake", "bodycare", "haircare", "other"]
+
+#cache.clear() を呼ぶテストは、本番と共有のキャッシュ（BASE_DIR/django_cache や Redis）を消さないようにメモリ上のキャッシュを使う
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def seed(users=20, products=60, reviews_per_user=30, favorites_per_user=20):
+    #ユーザー・商品・レビュー（公開・下書き）・お気に入りを作成し、集計も作り直す
+    rng = random.Random(0)
+
+    staff = User.objects.create_user("staff", password="password", is_staff=True)
+    members = [staff] + [
+        User.objects.create_user(f"user{i}", password="password") for i in range(users)
+    ]
+
+    add_products(products)
+    add_reviews(members, reviews_per_user, favorites_per_user, rng)
+    return staff, members
+
+
+def add_products(count):
+    start = Product.objects.count()
+    Product.objects.bulk_create([
+        Product(
+            cosme_name=f"商品{i}",
+            category=CATEGORIES[i % len(CATEGORIES)],
+            price=1000 + i,
+            image=f"product_images/seed{i}.jpg",
+            search_text=f"商品{i}",
+        )
+        for i in range(start, start + count)
+    ])
+
+
+def add_reviews(members, reviews_per_user, favorites_per_user, rng):
+    now = timezone.now()
+    product_ids = list(Product.objects.values_list("id", flat=True))
+
+    reviews = []
+    for user in members:
+        for i in range(reviews_per_user):
+            is_draft = i % 5 == 0
+            reviews.append(Review(
+                user=user,
+                product_id=rng.choice(product_ids),
+                age=rng.choice(AGE_CHOICES)[0],
+                skin_type=rng.choice(SKIN_CHOICES)[0],
+                rating=rng.randint(1, 5),
+                goodpoint_comment="良い点",
+                badpoint_comment="悪い点",
+                is_draft=is_draft,
+                posted_at=None if is_draft else now - timedelta(minutes=rng.randint(0, 100000)),
+            ))
+    Review.objects.bulk_create(reviews)
+
+    favorited = set(ReviewFavorite.objects.values_list("user_id", "review_id"))
+    published_ids = list(Review.objects.filter(is_draft=False).values_list("id", flat=True))
+    ReviewFavorite.objects.bulk_create([
+        ReviewFavorite(user=user, review_id=review_id)
+        for user in members
+        for review_id in rng.sample(published_ids, favorites_per_user)
+        if (user.id, review_id) not in favorited
+    ])
+
+    #bulk_create はシグナルを通らないため、集計・お気に入り数・検索索引を作り直す
+    counts = (
+        ReviewFavorite.objects
+        .filter(review=OuterRef("pk"))
+        .values("review")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Review.objects.update(favorite_count=Coalesce(Subquery(counts), 0))
+    ranking.rebuild()
+    ranking.rebuild_product_stats()
+    search.rebuild()
+
+
+class QueryPlanTests(TestCase):
+    #各画面で実行されるクエリの実行計画を確認し、レビュー関連のテーブルを全件走査していないこと
+
+    #件数が増え続けるテーブル
+    GROWING_TABLES = ("app_review", "app_reviewfavorite", "app_productranking")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, members = seed()
+        cls.user = members[1]
+        cls.product = Product.objects.order_by("id").first()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def full_scans(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                #データが少ないと索引があっても順次走査を選ぶため、索引が使えるかだけを見る
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql)
+                plan = [row[0] for row in cursor.fetchall()]
+                return [
+                    line.strip() for line in plan
+                    if re.search(r"Seq Scan on (%s)\b" % "|".join(self.GROWING_TABLES), line)
+                ]
+
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            plan = [row[-1] for row in cursor.fetchall()]
+            aliases = self.table_aliases(sql)
+            return [
+                detail for detail in plan
+                if (match := re.fullmatch(r"SCAN (\w+)", detail)) and match.group(1) in aliases
+            ]
+
+    def table_aliases(self, sql):
+        #SQLiteの計画には別名（U0など）で表示されることがあるため、別名も対象にする
+        names = set(self.GROWING_TABLES)
+        for table in self.GROWING_TABLES:
+            names.update(re.findall(r'"%s" (\w+)' % table, sql))
+        return names
+
+    def assert_no_full_scan(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+
+        for query in queries.captured_queries:
+            sql = query["sql"]
+            if not sql.startswith("SELECT") or not any(table in sql for table in self.GROWING_TABLES):
+                continue
+            with self.subTest(url=url, sql=sql):
+                self.assertEqual(self.full_scans(sql), [])
+
+    def cursor_for(self, qs, time_field="posted_at"):
+        rows = list(qs.order_by(f"-{time_field}", "-id"))
+        row = rows[len(rows) // 2]
+        return encode_cursor(getattr(row, time_field), row.pk)
+
+    def test_home(self):
+        self.assert_no_full_scan(reverse("form_app:home"))
+
+    def test_ranking(self):
+        self.assert_no_full_scan(reverse("form_app:ranking_all"))
+        self.assert_no_full_scan(
+            reverse("form_app:ranking_all")
+            + f"?skin_type={SKIN_CHOICES[0][0]}&age={AGE_CHOICES[1][0]}&page=2"
+        )
+        self.assert_no_full_scan(reverse("form_app:ranking_by_category", args=["skincare"]))
+        self.assert_no_full_scan(reverse("form_app:category_product_list", args=["skincare"]))
+
+    def test_product_detail(self):
+        self.assert_no_full_scan(reverse("form_app:product_detail", args=[self.product.pk]))
+
+    def test_my_pages(self):
+        self.assert_no_full_scan(reverse("form_app:my_page"))
+        self.assert_no_full_scan(reverse("form_app:review_list"))
+        self.assert_no_full_scan(reverse("form_app:favorite_review_list"))
+        self.assert_no_full_scan(reverse("form_app:review_draft_list"))
+        self.assert_no_full_scan(reverse("form_app:review_entry"))
+        self.assert_no_full_scan(reverse("form_app:review_create", args=[self.product.pk]))
+
+    def test_admin_my_page(self):
+        self.client.force_login(self.staff)
+        self.assert_no_full_scan(reverse("form_app:admin_my_page"))
+
+    def test_review_feeds(self):
+        published = Review.objects.filter(is_draft=False)
+        feeds = {
+            "latest": ("", published),
+            "product": (f"&product={self.product.pk}", published.filter(product=self.product)),
+            "mine": ("", published.filter(user=self.user)),
+        }
+        for feed, (params, qs) in feeds.items():
+            url = reverse("form_app:review_feed", args=[feed])
+            self.assert_no_full_scan(f"{url}?cursor={self.cursor_for(qs)}{params}")
+
+        favorites = ReviewFavorite.objects.filter(user=self.user)
+        url = reverse("form_app:review_feed", args=["favorites"])
+        self.assert_no_full_scan(f"{url}?cursor={self.cursor_for(favorites, 'created_at')}")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ViewBudgetTests(TestCase):
+    #全URLについて、クエリ数（と指定があれば応答時間）が上限以内であり、件数が増えてもクエリ数が変わらないこと
+
+    #応答時間の上限（秒・キャッシュなしの1リクエスト）。マシンの速さに左右されるため、環境変数で指定したときだけ確認する
+    LATENCY_BUDGET = float(os.environ.get("LATENCY_BUDGET") or 0)
+
+    ROLES = ("anonymous", "user", "staff")
+
+    #URL名: (未ログイン, 一般ユーザー, スタッフ) のクエリ数上限
+    BUDGETS = {
+        "home": (3, 7, 7),
+        "login": (0, 2, 2),
+        "register": (0, 2, 2),
+        "ranking_all": (1, 3, 3),
+        "ranking_by_category": (1, 3, 3),
+        "favorite_review_list": (0, 3, 3),
+        "my_page": (0, 5, 5),
+        "logout": (0, 4, 4),
+        "edit_profile": (0, 3, 3),
+        "password_change": (0, 2, 2),
+        "review_list": (0, 4, 4),
+        "review_feed": (1, 4, 4),
+        "review_entry": (0, 3, 3),
+        "review_create": (0, 6, 6),
+        "review_success": (0, 2, 2),
+        "review_delete": (0, 11, 11),
+        "review_draft_list": (0, 3, 3),
+        "review_draft_edit": (0, 4, 4),
+        "review_draft_delete": (0, 5, 5),
+        "review_edit": (0, 4, 4),
+        "review_favorite": (0, 8, 8),
+        "category_product_list": (1, 3, 3),
+        "search_result": (1, 3, 3),
+        "admin_my_page": (0, 2, 4),
+        "product_create": (0, 2, 2),
+        "product_create_success": (0, 2, 2),
+        "product_import": (0, 2, 2),
+        "product_export": (0, 2, 2),
+        "review_export": (0, 2, 2),
+        "product_search": (1, 3, 3),
+        "product_autocomplete": (1, 1, 1),
+        "thumbnail": (0, 0, 0),
+        "product_list": (0, 2, 3),
+        "product_edit": (0, 2, 3),
+        "product_delete": (0, 2, 10),
+        "product_detail": (2, 5, 5),
+        "memory_report": (0, 2, 2),
+        "metrics": (0, 0, 0),
+        "portfolio": (0, 0, 0),
+    }
+
+    #データを変更するURL（1回だけ計測し、件数を増やしての比較はしない）
+    MUTATING = {"logout", "review_delete", "review_favorite", "review_draft_delete", "product_delete"}
+    POST = {"review_draft_delete", "product_delete"}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, cls.members = seed()
+        cls.user = cls.members[1]
+        cls.product = Product.objects.order_by("id").first()
+
+    def login(self, role):
+        self.client.logout()
+        if role == "user":
+            self.client.force_login(self.user)
+        elif role == "staff":
+            self.client.force_login(self.staff)
+        return {"user": self.user, "staff": self.staff}.get(role, self.user)
+
+    def url_for(self, name, owner):
+        own = Review.objects.filter(user=owner).order_by("id")
+        args = {
+            "ranking_by_category": ["skincare"],
+            "category_product_list": ["skincare"],
+            "review_feed": ["latest"],
+            "review_create": [self.product.pk],
+            "review_draft_edit": [own.filter(is_draft=True).first().pk],
+            "review_draft_delete": [own.filter(is_draft=True).first().pk],
+            "review_edit": [own.filter(is_draft=False).first().pk],
+            "review_delete": [own.filter(is_draft=False).first().pk],
+            "review_favorite": [Review.objects.filter(is_draft=False).order_by("id").first().pk],
+            "product_edit": [self.product.pk],
+            "product_delete": [self.product.pk],
+            "product_detail": [self.product.pk],
+            "thumbnail": [160, "webp", self.product.image.name],
+        }.get(name, [])
+        query = {
+            "search_result": "?q=商品",
+            "product_search": "?q=商品",
+            "product_autocomplete": "?q=商品",
+            "product_export": "?format=csv",
+            "review_export": "?format=csv&category=skincare&date_from=2000-01-01",
+        }.get(name, "")
+        return reverse(f"form_app:{name}", args=args) + query
+
+    def measure(self, role, name):
+        owner = self.login(role)
+        url = self.url_for(name, owner)
+        cache.clear()
+
+        request = self.client.post if name in self.POST else self.client.get
+        #計測ごとに変更を取り消す（削除系のURLが他の計測に影響しないように）
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = request(url)
+                elapsed = time.perf_counter() - started
+            transaction.set_rollback(True)
+
+        self.assertLess(response.status_code, 500, url)
+        return queries, elapsed
+
+    def url_names(self):
+        return [pattern.name for pattern in app_urls.urlpatterns if pattern.name]
+
+    def test_every_url_has_a_budget(self):
+        self.assertEqual(set(self.url_names()), set(self.BUDGETS))
+
+    def test_query_and_latency_budgets(self):
+        for name in self.url_names():
+            for role, budget in zip(self.ROLES, self.BUDGETS[name]):
+                with self.subTest(name=name, role=role):
+                    queries, elapsed = self.measure(role, name)
+                    self.assertLessEqual(
+                        len(queries), budget,
+                        "\n".join(query["sql"] for query in queries.captured_queries),
+                    )
+                    if self.LATENCY_BUDGET:
+                        self.assertLess(elapsed, self.LATENCY_BUDGET)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        names = [name for name in self.url_names() if name not in self.MUTATING]
+        before = {
+            (role, name): len(self.measure(role, name)[0])
+            for name in names for role in self.ROLES
+        }
+
+        add_products(60)
+        add_reviews(self.members, 30, 20, random.Random(1))
+
+        for (role, name), count in before.items():
+            with self.subTest(name=name, role=role):
+                self.assertEqual(len(self.measure(role, name)[0]), count)
+
+
+class WriteContentionTests(TransactionTestCase):
+    #多数のスレッドから同時にお気に入りの切り替え・レビュー投稿を行い、ロック待ちで失敗しないこと
+
+    THREADS = 8
+    ITERATIONS = 5 #奇数回切り替えるため、最後は全員がお気に入り済みになる
+
+    def setUp(self):
+        self.product = Product.objects.create(cosme_name="商品", category="skincare", price=1000)
+        author = User.objects.create_user("author", password="password")
+        self.review = Review.objects.create(
+            user=author,
+            product=self.product,
+            rating=5,
+            goodpoint_comment="良い点",
+            badpoint_comment="悪い点",
+            is_draft=False,
+            posted_at=timezone.now(),
+        )
+        self.users = [
+            User.objects.create_user(f"writer{i}", password="password") for i in range(self.THREADS)
+        ]
+
+    def hammer(self, user, client, barrier, errors):
+        try:
+            barrier.wait(timeout=30)
+            for i in range(self.ITERATIONS):
+                responses = [
+                    client.post(reverse("form_app:review_favorite", args=[self.review.pk])),
+                    client.post(reverse("form_app:review_create", args=[self.product.pk]), {
+                        "rating": 1 + i % 5,
+                        "goodpoint_comment": "しっとりするのにべたつかないところが気に入っています。",
+                        "badpoint_comment": "容器が出しにくいのが少し残念です。冬場は少し乾燥します。",
+                    }),
+                ]
+                errors.extend(
+                    f"{user.username}: {response.status_code}"
+                    for response in responses if response.status_code != 302
+                )
+        except Exception as exc:
+            errors.append(f"{user.username}: {exc!r}")
+        finally:
+            connection.close()
+
+    def test_concurrent_favorites_and_reviews(self):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        threads = []
+        for user in self.users:
+            client = Client()
+            client.force_login(user)
+            threads.append(threading.Thread(target=self.hammer, args=(user, client, barrier, errors)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.review.refresh_from_db()
+        self.assertEqual(self.review.favorite_count, self.THREADS)
+        self.assertEqual(ReviewFavorite.objects.filter(review=self.review).count(), self.THREADS)
+
+        published = self.THREADS * self.ITERATIONS + 1
+        self.assertEqual(Review.objects.filter(is_draft=False).count(), published)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, published)
+
+    def test_only_post_runs_in_a_transaction(self):
+        #フォームの表示では書き込みロックを取らない
+        seen = []
+
+        @retry_on_lock
+        def view(request):
+            seen.append(connection.in_atomic_block)
+
+        view(RequestFactory().get("/"))
+        view(RequestFactory().post("/"))
+        self.assertEqual(seen, [False, True])
+
+
+    def test_review_submit_publishes_only_on_post(self):
+        draft = Review.objects.create(user=self.users[0], product=self.product, rating=3, is_draft=True)
+
+        def request(method):
+            request = getattr(RequestFactory(), method)("/")
+            request.user = self.users[0]
+            return views.review_submit(request, draft.pk)
+
+        self.assertEqual(request("get").status_code, 405)
+        draft.refresh_from_db()
+        self.assertTrue(draft.is_draft)
+
+        self.assertEqual(request("post").status_code, 302)
+        draft.refresh_from_db()
+        self.assertFalse(draft.is_draft)
+        self.assertIsNotNone(draft.posted_at)
+
+class ReplicaStickinessTests(TestCase):
+    #レプリカ対象の画面の表示では書き込みをせず、書き込んだユーザーだけがプライマリに固定されること
+
+    READ_VIEWS = ["home", "ranking_all", "category_product_list", "product_search", "search_result", "product_detail"]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, members = seed(users=3, products=10, reviews_per_user=5, favorites_per_user=2)
+        cls.user = members[1]
+        cls.product = Product.objects.order_by("id").first()
+        cls.review = Review.objects.filter(is_draft=False).exclude(user=cls.user).first()
+
+    def read_url(self, name):
+        args = {"category_product_list": ["skincare"], "product_detail": [self.product.pk]}.get(name, [])
+        query = {"product_search": "?q=商品", "search_result": "?q=商品"}.get(name, "")
+        return reverse(f"form_app:{name}", args=args) + query
+
+    def test_reads_do_not_pin_to_primary(self):
+        self.client.force_login(self.user)
+        for name in self.READ_VIEWS:
+            with self.subTest(name=name):
+                response = self.client.get(self.read_url(name))
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_writes_pin_to_primary(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse("form_app:review_favorite", args=[self.review.pk]))
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReplicaRoutingTests(TransactionTestCase):
+    #レプリカを設定したとき、レプリカ対象の画面はレプリカから読み、書き込みの後はプライマリから読むこと
+    #（レプリカはテスト用DBを指す別の接続。データが見えるように TransactionTestCase でコミットする）
+
+    REPLICA = "replica1"
+
+    @classmethod
+    def setUpClass(cls):
+        #テストの実行前に DATABASES にない接続は使えないため、ここで接続を追加してから databases に加える
+        primary = connections["default"].settings_dict
+        replica = {
+            **primary,
+            "OPTIONS": {name: value for name, value in primary["OPTIONS"].items() if name != "transaction_mode"},
+            "TEST": {**primary["TEST"], "MIRROR": "default"},
+        }
+        connections.settings[cls.REPLICA] = replica
+        cls.replica_settings = override_settings(DATABASE_REPLICAS=[cls.REPLICA])
+        cls.replica_settings.enable()
+        cls.databases = {"default", cls.REPLICA}
+        try:
+            super().setUpClass()
+        except Exception:
+            cls.removeReplica()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            super().tearDownClass()
+        finally:
+            cls.removeReplica()
+
+    @classmethod
+    def removeReplica(cls):
+        cls.replica_settings.disable()
+        connections[cls.REPLICA].close()
+        #PostgreSQL のコネクションプールは接続名ごとに作られ、閉じないとテスト用DBを削除できない
+        if hasattr(connections[cls.REPLICA], "close_pool"):
+            connections[cls.REPLICA].close_pool()
+        del connections[cls.REPLICA]
+        del connections.settings[cls.REPLICA]
+
+    def setUp(self):
+        cache.clear()
+        _, members = seed(users=3, products=10, reviews_per_user=5, favorites_per_user=2)
+        self.user = members[1]
+        self.product = Product.objects.order_by("id").first()
+        self.review = Review.objects.filter(is_draft=False).exclude(user=self.user).first()
+
+    def get_detail(self):
+        #画面の表示で、それぞれの接続に送られたクエリ
+        with CaptureQueriesContext(connections["default"]) as primary, \
+                CaptureQueriesContext(connections[self.REPLICA]) as replica:
+            response = self.client.get(reverse("form_app:product_detail", args=[self.product.pk]))
+        self.assertEqual(response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_queries_go_to_the_replica_until_a_write(self):
+        self.client.force_login(self.user)
+
+        primary, replica = self.get_detail()
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        response = self.client.post(reverse("form_app:review_favorite", args=[self.review.pk]))
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+        primary, replica = self.get_detail()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_search_reads_the_index_and_products_from_the_same_database(self):
+        with CaptureQueriesContext(connections["default"]) as primary, \
+                CaptureQueriesContext(connections[self.REPLICA]) as replica:
+            response = self.client.get(reverse("form_app:search_result"), {"q": self.product.cosme_name})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(primary), 0)
+        self.assertGreater(len(replica), 0)
+        self.assertEqual(list(response.context["products"]), [self.product])
+
+    def test_router_switches_to_primary_after_a_write_in_the_request(self):
+        seen = []
+
+        def read():
+            product = Product.objects.get(pk=self.product.pk)
+            seen.append((router.db_for_read(Product), product._state.db))
+
+        @replica_reads
+        def view(request):
+            read()
+            Product.objects.filter(pk=self.product.pk).update(price=2000)
+            read()
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(lambda request: middleware.process_view(request, view, (), {}) or view(request))
+        response = middleware(RequestFactory().get("/"))
+
+        self.assertEqual(seen, [(self.REPLICA, self.REPLICA), ("default", "default")])
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(router.db_for_read(Product), "default")
+
+
+class ProductImportTests(TestCase):
+    #一括登録で、検証を通った行だけが登録・更新され、検索・ランキングにも反映されること。書き出した内容を読み込み直せること
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, _ = seed(users=3, products=10, reviews_per_user=5, favorites_per_user=2)
+        cls.product = Product.objects.order_by("id").first()
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        #保存済みの画像として指定できるよう、商品の画像ファイルを置く
+        for product in Product.objects.all():
+            path = os.path.join(media_root, product.image.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(b"image")
+        self.client.force_login(self.staff)
+
+    def archive(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            image = io.BytesIO()
+            Image.new("RGB", (32, 32), "pink").save(image, "PNG")
+            archive.writestr("images/new.png", image.getvalue())
+            archive.writestr("images/broken.png", b"not an image")
+        return SimpleUploadedFile("images.zip", buffer.getvalue())
+
+    def upload(self, rows):
+        lines = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows) + "\n{broken\n"
+        return self.client.post(reverse("form_app:product_import"), {
+            "file": SimpleUploadedFile("products.jsonl", lines.encode()),
+            "archive": self.archive(),
+        })
+
+    def test_import(self):
+        new_category = "haircare" if self.product.category != "haircare" else "skincare"
+        response = self.upload([
+            {"cosme_name": "一括登録の化粧水", "category": "skincare", "price": 1200, "image": "images/new.png"},
+            {"cosme_name": "保存済みの画像", "category": "uvcare", "price": 800, "image": self.product.image.name},
+            {"id": self.product.pk, "cosme_name": "名前を変更", "category": new_category, "price": 500},
+            {"cosme_name": "壊れた画像", "category": "skincare", "price": 100, "image": "images/broken.png"},
+            {"cosme_name": "カテゴリー違い", "category": "unknown", "price": 100, "image": "images/new.png"},
+            {"cosme_name": "画像なし", "category": "skincare", "price": 100},
+            {"id": 0, "cosme_name": "存在しない商品", "category": "skincare", "price": 100},
+        ])
+        result = response.context["result"]
+        self.assertEqual((result.created, result.updated, result.error_count), (2, 1, 5))
+        self.assertEqual([line for line, _ in result.errors], [4, 5, 6, 7, 8])
+        self.assertFalse(Product.objects.filter(cosme_name__in=["壊れた画像", "カテゴリー違い", "画像なし"]).exists())
+
+        created = Product.objects.get(cosme_name="一括登録の化粧水")
+        self.assertTrue(created.image.storage.exists(created.image.name))
+        self.assertEqual(Product.objects.get(cosme_name="保存済みの画像").image.name, self.product.image.name)
+        self.assertIn(created, search.search_products("化粧水"))
+
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cosme_name, self.product.price), ("名前を変更", 500))
+        self.assertIn(self.product, search.search_products("名前を変更"))
+        self.assertFalse(
+            ProductRanking.objects.filter(product=self.product)
+            .exclude(category__in=[ranking.ALL, new_category]).exists()
+        )
+
+    def test_image_outside_media_is_a_row_error(self):
+        response = self.upload([
+            {"cosme_name": "外部の画像", "category": "skincare", "price": 100, "image": "../x.jpg"},
+            {"cosme_name": "外部の画像", "category": "skincare", "price": 100, "image": "product_images/../../x.jpg"},
+            {"cosme_name": "外部の画像", "category": "skincare", "price": 100, "image": "/etc/passwd"},
+        ])
+        result = response.context["result"]
+        self.assertEqual((result.created, result.error_count), (0, 4))
+
+    @override_settings(PRODUCT_IMPORT_MAX_FILE_SIZE=10)
+    def test_large_file_is_sent_to_the_command(self):
+        response = self.upload([{"cosme_name": "商品", "category": "skincare", "price": 100}])
+        self.assertIsNone(response.context["result"])
+        self.assertIn("import_products", str(response.context["form"].errors["file"]))
+
+    def test_export_round_trip(self):
+        for fmt in ("csv", "jsonl"):
+            with self.subTest(fmt=fmt):
+                response = self.client.get(reverse("form_app:product_export") + f"?format={fmt}")
+                content = b"".join(response.streaming_content)
+                rows = list(product_io.read_rows(io.BytesIO(content), fmt))
+                self.assertEqual(len(rows), Product.objects.count())
+
+                result = product_io.import_products(rows, batch_size=4)
+                self.assertEqual((result.created, result.updated, result.error_count), (0, len(rows), 0))
+
+
+class ReviewExportTests(TestCase):
+    #公開済みのレビューだけが、投稿日（TIME_ZONE の日付）・カテゴリーで絞り込まれて書き出されること
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, _ = seed(users=3, products=10, reviews_per_user=20, favorites_per_user=2)
+
+    def export(self, **params):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("form_app:review_export"), params)
+        content = b"".join(response.streaming_content)
+        return [row for _, row in product_io.read_rows(io.BytesIO(content), params["format"])]
+
+    def test_filters(self):
+        published = Review.objects.filter(is_draft=False).select_related("product")
+        day = timezone.localdate(published.order_by("posted_at")[len(published) // 2].posted_at)
+        expected = {
+            review.id for review in published
+            if timezone.localdate(review.posted_at) >= day and review.product.category == "skincare"
+        }
+        self.assertTrue(expected)
+
+        for fmt in ("csv", "jsonl"):
+            with self.subTest(fmt=fmt):
+                rows = self.export(format=fmt, date_from=day.isoformat(), category="skincare")
+                self.assertEqual({int(row["id"]) for row in rows}, expected)
+                self.assertEqual(list(rows[0]), review_io.EXPORT_COLUMNS)
+
+        rows = self.export(format="csv", date_to=day.isoformat())
+        self.assertEqual(
+            {int(row["id"]) for row in rows},
+            {review.id for review in published if timezone.localdate(review.posted_at) <= day},
+        )
+
+    def test_invalid_range_shows_form(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("form_app:review_export"), {
+            "format": "csv", "date_from": "2024-02-01", "date_to": "2024-01-01",
+        })
+        self.assertFalse(response.streaming)
+        self.assertIn("date_to", response.context["form"].errors)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncViewTests(TransactionTestCase):
+    #非同期版のビューが（別スレッド・別の接続でクエリを実行しても）同期版と同じページを返すこと
+
+    CSRF_TOKEN = re.compile(r'name="csrfmiddlewaretoken" value="[^"]+"')
+
+    def setUp(self):
+        self.staff, members = seed(users=3, products=10, reviews_per_user=5, favorites_per_user=2)
+        self.user = members[1]
+        self.product = Product.objects.order_by("id").first()
+
+    def request(self, url, user):
+        request = RequestFactory().get(url)
+        request.user = user
+
+        async def auser():
+            return user
+        request.auser = auser
+        return request
+
+    def page(self, response):
+        return self.CSRF_TOKEN.sub("", response.content.decode())
+
+    def test_async_views_render_the_same_pages(self):
+        pages = [
+            ("home", reverse("form_app:home"), {}),
+            ("ranking", reverse("form_app:ranking_by_category", args=["skincare"]), {"category": "skincare"}),
+            ("product_detail", reverse("form_app:product_detail", args=[self.product.pk]), {"pk": self.product.pk}),
+            ("my_page", reverse("form_app:my_page"), {}),
+        ]
+        for user in (AnonymousUser(), self.user):
+            for name, url, kwargs in pages:
+                if name == "my_page" and not user.is_authenticated:
+                    continue
+                with self.subTest(name=name, user=user.username):
+                    cache.clear()
+                    expected = getattr(views, name)(self.request(url, user), **kwargs)
+                    cache.clear()
+                    actual = async_to_sync(getattr(async_views, name))(self.request(url, user), **kwargs)
+                    self.assertEqual(actual.status_code, 200)
+                    self.assertEqual(self.page(actual), self.page(expected))
+
+
+class BenchmarkCommandTests(TestCase):
+    #計測するリクエストがないプロセス・ウォームアップだけの実行でも失敗せずに集計できること
+
+    @classmethod
+    def setUpTestData(cls):
+        seed(users=2, products=5, reviews_per_user=3, favorites_per_user=1)
+
+    def test_rejects_fewer_requests_than_workers(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark", requests=1, workers=2, stdout=io.StringIO())
+
+    def test_reports_every_request(self):
+        out = io.StringIO()
+        call_command("benchmark", requests=3, warmup=0, auth_ratio=0, stdout=out)
+        total = next(line for line in out.getvalue().splitlines() if line.startswith("total"))
+        self.assertEqual(total.split()[1], "3")
+
+
+def worker_fragment(name):
+    #別のワーカープロセスで、ホーム画面の断片のキーとキャッシュされた内容を調べる
+    key = fragment_key(name, REVIEWS, CATALOG)
+    return key, cache.get(key)
+
+
+class SharedCacheTests(TestCase):
+    #バージョン番号の更新が、別のワーカープロセスから見えること（プロセスごとのキャッシュでは古い内容を返し続ける）
+
+    def test_bump_is_seen_by_other_processes(self):
+        with multiprocessing.get_context("spawn").Pool(1, initializer=django.setup) as worker:
+            before = worker.apply(get_version, [CATALOG])
+            self.assertEqual(before, get_version(CATALOG))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                bump_version(CATALOG)
+            after = worker.apply(get_version, [CATALOG])
+
+        self.assertNotEqual(after, before)
+        self.assertEqual(after, get_version(CATALOG))
+
+    def test_fragments_are_invalidated_in_other_processes(self):
+        product = Product.objects.create(cosme_name="商品", category="skincare", price=1000)
+        key = fragment_key("home_ranking", REVIEWS, CATALOG)
+        cache.set(key, "<p>ランキング</p>")
+
+        with multiprocessing.get_context("spawn").Pool(1, initializer=django.setup) as worker:
+            self.assertEqual(worker.apply(worker_fragment, ["home_ranking"]), (key, "<p>ランキング</p>"))
+
+            product.price = 1200
+            with self.captureOnCommitCallbacks(execute=True):
+                product.save()
+            new_key, html = worker.apply(worker_fragment, ["home_ranking"])
+
+        self.assertNotEqual(new_key, key)
+        self.assertIsNone(html)
+
+
+class MediaStorageTests(TestCase):
+    #同じ内容の画像は1ファイルを共有し、どの行からも参照されなくなったときだけ削除されること
+    #未参照ファイルの削除（collect_orphaned_media）が、参照中・保存直後のファイルを残すこと
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def save(self, name, content=b"image"):
+        return default_storage.save(name, ContentFile(content))
+
+    def product(self, image):
+        return Product.objects.create(cosme_name="商品", category="skincare", price=1000, image=image)
+
+    def age(self, name, seconds):
+        path = default_storage.path(name)
+        os.utime(path, (time.time() - seconds, time.time() - seconds))
+
+    def test_identical_uploads_share_one_file(self):
+        first = self.save("product_images/a.jpg")
+        second = self.save("product_images/b.JPG")
+        other = self.save("product_images/c.jpg", b"other")
+
+        self.assertEqual(first, second)
+        self.assertTrue(storage.is_content_addressed(first))
+        self.assertNotEqual(first, other)
+        files = [name for _, _, names in os.walk(self.media_root) for name in names]
+        self.assertEqual(len(files), 2)
+
+    def test_shared_file_is_deleted_with_its_last_reference(self):
+        name = self.save("product_images/a.jpg")
+        first, second = self.product(name), self.product(name)
+        self.age(name, settings.MEDIA_DELETE_MIN_AGE + 60)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=first.pk).delete()
+        self.assertTrue(default_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=second.pk).delete()
+        self.assertFalse(default_storage.exists(name))
+
+    def test_replaced_image_is_deleted(self):
+        old = self.save("product_images/a.jpg")
+        product = self.product(old)
+        self.age(old, settings.MEDIA_DELETE_MIN_AGE + 60)
+
+        product = Product.objects.get(pk=product.pk)
+        product.image = self.save("product_images/b.jpg", b"new")
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertFalse(default_storage.exists(old))
+        self.assertTrue(default_storage.exists(product.image.name))
+
+    def test_file_reused_by_an_uncommitted_upload_is_kept(self):
+        name = self.save("product_images/a.jpg")
+        product = self.product(name)
+        self.age(name, settings.MEDIA_DELETE_MIN_AGE + 60)
+
+        #同じ内容のアップロード（行のコミット前）が既存のファイルを使った直後に、最後の参照が消える
+        self.assertEqual(self.save("product_images/b.jpg"), name)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=product.pk).delete()
+        self.assertTrue(default_storage.exists(name))
+
+        self.product(name)
+        self.assertTrue(default_storage.exists(name))
+
+    def test_collect_orphans(self):
+        referenced = self.save("product_images/a.jpg", b"referenced")
+        orphan = self.save("product_images/b.jpg", b"orphan")
+        young = self.save("product_images/c.jpg", b"young")
+        self.product(referenced)
+        for name in (referenced, orphan):
+            self.age(name, 2 * 24 * 60 * 60)
+
+        count, _ = storage.collect_orphans(min_age=24 * 60 * 60)
+
+        self.assertEqual(count, 1)
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(referenced))
+        self.assertTrue(default_storage.exists(young))
+
+
+
+class ImageProcessingTests(TestCase):
+    #アップロード画像は撮影位置などのメタデータ（EXIF）を除いて保存し直すこと
+    #処理前にプロセスが止まった画像は未処理のまま残り、process_pending_images で処理できること
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, THUMBNAIL_CACHE_DIR=os.path.join(self.media_root, "thumbnails"))
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self):
+        exif = Image.Exif()
+        exif[0x010F] = "Camera" #Make
+        exif[0x8825] = {1: "N", 2: (35.0, 39.0, 0.0)} #GPSInfo
+        image = io.BytesIO()
+        Image.new("RGB", (40, 30), "pink").save(image, "JPEG", exif=exif)
+        return SimpleUploadedFile("photo.jpg", image.getvalue(), content_type="image/jpeg")
+
+    def exif(self, name):
+        with default_storage.open(name, "rb") as file:
+            return Image.open(file).getexif()
+
+    def test_upload_is_stored_without_exif(self):
+        with override_settings(IMAGE_PROCESSING_WORKERS=0), self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(cosme_name="商品", category="skincare", price=1000, image=self.upload())
+        original = product.image.name
+
+        product.refresh_from_db()
+        self.assertTrue(product.image_processed)
+        self.assertNotEqual(product.image.name, original)
+        #元の画像はどの行からも参照されない（保存直後なので、削除は collect_orphaned_media で行われる）
+        self.assertFalse(storage.is_referenced(original))
+        self.assertEqual(dict(self.exif(product.image.name)), {})
+
+    def test_pending_images_are_processed_by_the_command(self):
+        #コミット後の処理を実行しない＝処理待ちのまま Web サーバーが再起動した状態
+        with self.captureOnCommitCallbacks(execute=False):
+            product = Product.objects.create(cosme_name="商品", category="skincare", price=1000, image=self.upload())
+            review = Review.objects.create(
+                user=User.objects.create_user("user"), product=product, rating=5, image=self.upload(),
+            )
+        for row in (product, review):
+            row.refresh_from_db()
+            self.assertFalse(row.image_processed)
+            self.assertTrue(self.exif(row.image.name).get_ifd(0x8825))
+
+        out = io.StringIO()
+        call_command("process_pending_images", stdout=out)
+        self.assertIn("2件", out.getvalue())
+
+        for row in (product, review):
+            row.refresh_from_db()
+            self.assertTrue(row.image_processed)
+            self.assertEqual(dict(self.exif(row.image.name)), {})
+
+
+
+class ThumbnailTests(TestCase):
+    #縮小画像の配信・キャッシュの削除・表示サイズ
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, THUMBNAIL_CACHE_DIR=os.path.join(self.media_root, "thumbnails"))
+        media.enable()
+        self.addCleanup(media.disable)
+
+        image = io.BytesIO()
+        Image.new("RGB", (400, 200), "pink").save(image, "PNG")
+        self.name = default_storage.save("product_images/wide.png", ContentFile(image.getvalue()))
+        self.url = reverse("form_app:thumbnail", args=[160, "webp", self.name])
+
+    def test_pruned_thumbnail_is_rendered_again(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(thumbnails.prune(max_bytes=0), 1)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(b"".join(response.streaming_content))).size, (160, 80))
+        response.close()
+
+    def test_prune_command_removes_least_recently_used(self):
+        for width in thumbnails.WIDTH_BUCKETS:
+            thumbnails.render_thumbnail(self.name, width, "jpeg")
+        oldest = thumbnails.cache_path(self.name, 64, "jpeg")
+        os.utime(oldest, (time.time() - 3600, time.time() - 3600))
+
+        total = sum(path.stat().st_size for path in thumbnails.cache_dir().rglob("*.jpg"))
+        call_command("prune_thumbnails", max_bytes=total - 1, stdout=io.StringIO())
+        self.assertFalse(oldest.exists())
+        self.assertTrue(thumbnails.cache_path(self.name, 640, "jpeg").exists())
+
+    def test_truncated_image_is_not_found(self):
+        image = io.BytesIO()
+        Image.new("RGB", (400, 200), "pink").save(image, "JPEG")
+        name = default_storage.save("product_images/truncated.jpg", ContentFile(image.getvalue()[:len(image.getvalue()) // 2]))
+
+        response = self.client.get(reverse("form_app:thumbnail", args=[160, "webp", name]))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual([path for path in thumbnails.cache_dir().rglob("*") if path.is_file()], [])
+
+    def test_tag_keeps_the_aspect_ratio(self):
+        html = Template("{% load thumbnail_tags %}{% thumbnail image 30 %}").render(
+            Context({"image": Product(image=self.name).image})
+        )
+        self.assertIn('width="30" height="15"', html)
+
+        html = Template("{% load thumbnail_tags %}{% thumbnail image 30 %}").render(
+            Context({"image": Product(image="product_images/missing.png").image})
+        )
+        self.assertIn('width="30"', html)
+        self.assertNotIn("height=", html)
+
+
+
+class RankingMaintenanceTests(TestCase):
+    #レビュー・商品の変更ごとの差分更新が、公開済みレビューから作り直した集計と一致すること
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("user")
+        cls.products = [
+            Product.objects.create(cosme_name=f"商品{i}", category=CATEGORIES[i], price=1000, image="product_images/a.jpg")
+            for i in range(3)
+        ]
+        now = timezone.now()
+        cls.reviews = [
+            Review.objects.create(
+                user=cls.user,
+                product=cls.products[i % 3],
+                age=AGE_CHOICES[i % 2][0],
+                skin_type=SKIN_CHOICES[i % 3][0],
+                rating=[5, 3, None, 4, 1, 2, None, 5][i],
+                posted_at=now,
+            )
+            for i in range(8)
+        ]
+
+    def cube(self):
+        rankings = sorted(
+            ProductRanking.objects
+            .filter(review_count__gt=0)
+            .values_list("product_id", "category", "skin_type", "age", "review_count", "rating_count", "rating_sum", "avg_rating")
+        )
+        stats = list(Product.objects.order_by("id").values_list(*Product.COUNTER_FIELDS))
+        return rankings, stats
+
+    def assertMatchesRebuild(self):
+        maintained = self.cube()
+        ranking.rebuild()
+        ranking.rebuild_product_stats()
+        self.assertEqual(maintained, self.cube())
+
+    def test_create(self):
+        self.assertMatchesRebuild()
+
+    def test_edit_rating(self):
+        self.reviews[0].rating = 2
+        self.reviews[0].save()
+        self.reviews[2].rating = 3 #評価なし→あり
+        self.reviews[2].save()
+        self.reviews[1].rating = None
+        self.reviews[1].save()
+        self.assertMatchesRebuild()
+
+    def test_unpublish(self):
+        self.reviews[3].is_draft = True
+        self.reviews[3].save()
+        self.assertMatchesRebuild()
+
+    def test_delete(self):
+        self.reviews[4].delete()
+        self.products[2].delete()
+        self.assertMatchesRebuild()
+
+    def test_category_move(self):
+        self.products[0].category = "haircare"
+        self.products[0].save()
+        self.assertMatchesRebuild()
+
+    def test_unrated_products_rank_last(self):
+        #件数が同じなら、平均がNULL（評価のないレビューだけ）の商品は最後
+        kept = {self.reviews[0].pk, self.reviews[1].pk, self.reviews[5].pk} #商品0・1・2 に1件ずつ
+        Review.objects.exclude(pk__in=kept).delete()
+        Review.objects.filter(pk=self.reviews[0].pk).update(rating=None)
+        ranking.rebuild()
+        self.assertEqual(list(ranking.ranked_products()), [self.products[1], self.products[2], self.products[0]])
+
+
+
+class ProfilingTests(TestCase):
+    #サンプリングプロファイラーが、対象スレッド（全スレッド指定なら他のスレッドも）の呼び出しを記録すること
+
+    def busy(self, stop):
+        while not stop.is_set():
+            sum(range(1000))
+
+    def profile(self, all_threads):
+        stop = threading.Event()
+        worker = threading.Thread(target=self.busy, args=[stop], name="worker")
+        worker.start()
+        try:
+            with profiling.SamplingProfiler(0.001, all_threads=all_threads) as profiler:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            worker.join()
+        return profiler.folded()
+
+    def test_samples_only_the_calling_thread(self):
+        folded = self.profile(all_threads=False)
+        self.assertIn("ProfilingTests.profile", folded)
+        self.assertNotIn("ProfilingTests.busy", folded)
+
+    def test_samples_all_threads(self):
+        folded = self.profile(all_threads=True)
+        self.assertRegex(folded, r"(?m)^thread worker;.*ProfilingTests\.busy")
+        self.assertIn("ProfilingTests.profile", folded)
+
+
+
+class MemoryProfilingTests(TestCase):
+    #調べる対象のリクエストで、ビューごとに割り当て箇所が記録されること
+
+    @classmethod
+    def setUpTestData(cls):
+        seed(users=2, products=10, reviews_per_user=5, favorites_per_user=2)
+
+    @override_settings(MEMORY_PROFILING=True, MEMORY_PROFILING_FRAMES=5, MEMORY_PROFILING_SAMPLE_EVERY=1)
+    def test_sampled_request_records_allocation_sites(self):
+        self.addCleanup(memory.reset)
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+
+        response = Client().get(reverse("form_app:home"))
+        self.assertEqual(response.status_code, 200)
+
+        stats = {stats.view_name: stats for stats in memory.report()}["form_app:home"]
+        self.assertEqual(stats.samples, 1)
+        sites = stats.top_sites()
+        self.assertTrue(sites)
+        self.assertTrue(all(site["size"] > 0 for site in sites))
+        self.assertFalse(any(site["site"].startswith("app/memory.py") for site in sites))
+
+
+
+class LoadDataTests(TestCase):
+    #負荷試験用のデータは、同じ seed なら実行した日時に関わらず同じ内容になること
+
+    def posted_at(self):
+        reviews = Review.objects.filter(is_draft=False).order_by("id")
+        return [review.posted_at for review in reviews]
+
+    def generate(self):
+        call_command("generate_load_data", users=3, products=3, reviews=20, favorites=10, seed=1, stdout=io.StringIO())
+        return self.posted_at()
+
+    def test_same_seed_gives_same_posted_at(self):
+        first = self.generate()
+        User.objects.all().delete()
+        Product.objects.all().delete()
+
+        self.assertEqual(self.generate(), first)
+        reference = timezone.make_aware(datetime.combine(synthetic.REFERENCE_DATE, datetime.min.time()))
+        self.assertTrue(all(reference - timedelta(days=365) <= posted_at < reference for posted_at in first))
+
+    def test_reviews_need_users_and_products(self):
+        with self.assertRaisesMessage(CommandError, "ユーザーが1件以上必要"):
+            call_command("generate_load_data", users=0, products=3, reviews=5, favorites=0, stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, "商品が1件以上必要"):
+            call_command("generate_load_data", users=3, products=0, reviews=5, favorites=0, stdout=io.StringIO())
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Product.objects.exists())
+
+
+
+class MetricsTests(TestCase):
+    #プロセスごとのファイルへの書き出しと、全プロセス分の合算
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        metrics_dir = override_settings(METRICS_DIR=self.metrics_dir)
+        metrics_dir.enable()
+        self.addCleanup(metrics_dir.disable)
+
+    def read(self, filename):
+        with open(os.path.join(self.metrics_dir, filename), encoding="utf-8") as file:
+            return json.load(file)
+
+    def test_render_uses_the_exposition_format(self):
+        metrics.inc("app_review_posts_total", 2, test="render")
+        metrics.observe("app_upload_size_bytes", 300_000, test="render")
+        metrics.observe("app_upload_size_bytes", 50_000_000, test="render")
+        lines = metrics.render().splitlines()
+
+        self.assertIn("# TYPE app_review_posts_total counter", lines)
+        self.assertIn('app_review_posts_total{test="render"} 2', lines)
+        self.assertIn("# TYPE app_upload_size_bytes histogram", lines)
+        #区切りごとの件数は累積（le 以下の件数）。最後の区切りを超えたものは +Inf にだけ入る
+        self.assertIn('app_upload_size_bytes_bucket{test="render",le="100000"} 0', lines)
+        self.assertIn('app_upload_size_bytes_bucket{test="render",le="500000"} 1', lines)
+        self.assertIn('app_upload_size_bytes_bucket{test="render",le="20000000"} 1', lines)
+        self.assertIn('app_upload_size_bytes_bucket{test="render",le="+Inf"} 2', lines)
+        self.assertIn('app_upload_size_bytes_sum{test="render"} 50300000', lines)
+        self.assertIn('app_upload_size_bytes_count{test="render"} 2', lines)
+
+    def test_files_of_other_processes_are_merged(self):
+        histogram = [0] * (len(metrics.UPLOAD_BUCKETS) + 3)
+        histogram[0], histogram[-2], histogram[-1] = 1, 1000, 1
+        for pid in (1, 2):
+            with open(os.path.join(self.metrics_dir, f"{pid}-0.json"), "w", encoding="utf-8") as file:
+                json.dump([
+                    ["app_review_posts_total", [["test", "merge"]], pid],
+                    ["app_upload_size_bytes", [["test", "merge"]], histogram],
+                    ["unknown_metric", [], 1],
+                ], file)
+        #書きかけ（.tmp）・壊れたファイルは読み飛ばす
+        with open(os.path.join(self.metrics_dir, "3-0.json"), "w", encoding="utf-8") as file:
+            file.write("[")
+        with open(os.path.join(self.metrics_dir, "4-0.json.tmp"), "w", encoding="utf-8") as file:
+            file.write("[]")
+        metrics.inc("app_review_posts_total", 10, test="merge")
+
+        merged = metrics.collect()
+        self.assertEqual(merged[("app_review_posts_total", (("test", "merge"),))], 13)
+        self.assertEqual(merged[("app_upload_size_bytes", (("test", "merge"),))][-3:], [0, 2000, 2])
+        self.assertNotIn("unknown_metric", {name for name, _ in merged})
+
+    @override_settings(METRICS_TOKEN="secret", METRICS_ALLOWED_IPS=[])
+    def test_endpoint_requires_the_token(self):
+        url = reverse("form_app:metrics")
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer wrong"}).status_code, 404)
+        response = self.client.get(url, headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE app_http_request_duration_seconds histogram", response.content.decode())
+
+    def test_endpoint_without_a_token(self):
+        url = reverse("form_app:metrics")
+        #接続元 127.0.0.1（プロキシの後ろでは全リクエストがこうなる）でも、指定がなければ返さない
+        with override_settings(METRICS_TOKEN="", METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer "}).status_code, 404)
+        with override_settings(METRICS_TOKEN="", METRICS_ALLOWED_IPS=["127.0.0.1"]):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "fork が使える環境のみ")
+    def test_forked_workers_write_their_own_files(self):
+        #アプリを読み込んでから fork するサーバーと同じ状態
+        metrics.inc("app_favorite_toggles_total", 3, test="parent")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.inc("app_favorite_toggles_total", 5, test="child")
+                metrics.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        metrics.flush()
+
+        files = sorted(os.listdir(self.metrics_dir))
+        self.assertEqual(len(files), 2)
+        child = next(filename for filename in files if filename.startswith(f"{pid}-"))
+        self.assertEqual(self.read(child), [["app_favorite_toggles_total", [["test", "child"]], 5]])
+
+        merged = metrics.collect()
+        self.assertEqual(merged[("app_favorite_toggles_total", (("test", "parent"),))], 3)
+        self.assertEqual(merged[("app_favorite_toggles_total", (("test", "child"),))], 5)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RequestTimingTests(TestCase):
+    #スタッフへの Server-Timing ヘッダーと、遅いリクエスト・クエリのログ
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff, members = seed(users=2, products=10, reviews_per_user=5, favorites_per_user=2)
+        cls.user = members[1]
+
+    def setUp(self):
+        cache.clear()
+
+    def get_home(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("form_app:home"))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_server_timing_is_sent_to_staff(self):
+        self.client.force_login(self.staff)
+        response, query_count = self.get_home()
+
+        timings = dict(
+            (entry.split(";")[0].strip(), entry)
+            for entry in response["Server-Timing"].split(",")
+        )
+        self.assertEqual(set(timings), {"db", "tpl", "view", "total"})
+        self.assertRegex(timings["db"], r'^db;desc="%d queries";dur=\d+\.\d$' % query_count)
+        for name in ("tpl", "view", "total"):
+            self.assertRegex(timings[name], r"dur=\d+\.\d$")
+
+    def test_server_timing_is_not_sent_to_others(self):
+        response, _ = self.get_home()
+        self.assertNotIn("Server-Timing", response)
+
+        self.client.force_login(self.user)
+        response, _ = self.get_home()
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(SLOW_REQUEST_MS=0, SLOW_QUERY_MS=10 ** 6)
+    def test_slow_request_is_logged(self):
+        with self.assertLogs("app.performance", "WARNING") as logs:
+            _, query_count = self.get_home()
+
+        self.assertEqual(len(logs.records), 1)
+        event = json.loads(logs.records[0].getMessage())
+        self.assertEqual(event["event"], "slow_request")
+        self.assertEqual(event["view"], "form_app:home")
+        self.assertEqual(event["status"], 200)
+        self.assertEqual(event["query_count"], query_count)
+        self.assertLessEqual(len(event["slowest_queries"]), query_count)
+
+    @override_settings(SLOW_REQUEST_MS=10 ** 6, SLOW_QUERY_MS=0)
+    def test_slow_queries_are_logged_without_literals(self):
+        with self.assertLogs("app.performance", "WARNING") as logs:
+            _, query_count = self.get_home()
+
+        events = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual(len(events), query_count)
+        self.assertTrue(all(event["event"] == "slow_query" for event in events))
+        self.assertFalse(any(re.search(r"'|\b\d+\b", event["sql"]) for event in events))
+
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs("app.performance", "WARNING"):
+            with override_settings(SLOW_REQUEST_MS=10 ** 6, SLOW_QUERY_MS=10 ** 6):
+                self.get_home()
+
+
+class ProductStatsTests(TestCase):
+    #星の数（平均評価の整数）は四捨五入（x.5 は切り上げ）
+
+    def test_avg_rating_int_rounds_half_up(self):
+        cases = [
+            ({"rating_2_count": 1, "rating_3_count": 1}, 3), #2.5
+            ({"rating_4_count": 1, "rating_5_count": 1}, 5), #4.5
+            ({"rating_3_count": 2, "rating_4_count": 1}, 3), #3.33
+            ({"rating_1_count": 1, "rating_2_count": 1, "rating_3_count": 1, "rating_4_count": 1}, 3), #2.5
+        ]
+        for counts, expected in cases:
+            with self.subTest(counts=counts):
+                rating_sum = sum(int(name[7]) * count for name, count in counts.items())
+                product = Product(rating_sum=rating_sum, **counts)
+                self.assertEqual(product.avg_rating_int, expected)
+        self.assertIsNone(Product().avg_rating_int)
+
+
+class FavoriteCountTests(TestCase):
+    #レビューのお気に入り数は、お気に入りの追加・解除（ユーザーの削除を含む）で増減し、0 より小さくならないこと
+
+    def setUp(self):
+        self.author = User.objects.create_user("author", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        product = Product.objects.create(cosme_name="商品", category="skincare", price=1000, image="product_images/a.jpg")
+        self.review = Review.objects.create(
+            user=self.author,
+            product=product,
+            rating=5,
+            goodpoint_comment="良い点",
+            badpoint_comment="悪い点",
+            posted_at=timezone.now(),
+        )
+
+    def count(self):
+        return Review.objects.get(pk=self.review.pk).favorite_count
+
+    def toggle(self, user):
+        self.client.force_login(user)
+        self.client.post(reverse("form_app:review_favorite", args=[self.review.pk]))
+
+    def test_favorite_and_unfavorite(self):
+        self.toggle(self.member)
+        self.toggle(self.author)
+        self.assertEqual(self.count(), 2)
+
+        self.toggle(self.member)
+        self.assertEqual(self.count(), 1)
+        self.assertEqual(self.count(), ReviewFavorite.objects.filter(review=self.review).count())
+
+    def test_deleting_a_user_removes_their_favorites(self):
+        self.toggle(self.member)
+        self.toggle(self.author)
+        self.member.delete()
+        self.assertEqual(self.count(), 1)
+
+    def test_deleting_the_review_deletes_its_favorites(self):
+        self.toggle(self.member)
+        self.review.delete()
+        self.assertFalse(ReviewFavorite.objects.exists())
+
+    def test_double_delete_does_not_go_below_zero(self):
+        self.toggle(self.member)
+        #同時に届いた2つの解除リクエストが、それぞれ同じ行を読み込んで削除する
+        first, second = ReviewFavorite.objects.get(), ReviewFavorite.objects.get()
+        first.delete()
+        second.delete()
+        self.assertEqual(self.count(), 0)
+
+
+class SearchTests(TestCase):
+    #表記の違い（全角/半角・大文字/小文字・カタカナ/ひらがな）を吸収し、3文字未満の語は2文字の索引で探す
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lotion = Product.objects.create(cosme_name="薬用美白化粧水", category="skincare", price=1000, image="product_images/a.jpg")
+        cls.milk = Product.objects.create(cosme_name="ハトムギ乳液", category="skincare", price=1000, image="product_images/b.jpg")
+        cls.uv = Product.objects.create(cosme_name="UVミルクEX", category="uvcare", price=1000, image="product_images/c.jpg")
+
+    def names(self, query):
+        return [product.cosme_name for product in search.search_products(query)]
+
+    def test_normalize(self):
+        self.assertEqual(search.normalize("ﾊﾄﾑｷﾞ"), "はとむぎ")
+        self.assertEqual(search.normalize("ＵＶミルク"), "uvみるく")
+        self.assertEqual(search.normalize("UvMilk"), "uvmilk")
+
+    def test_spelling_differences_match(self):
+        for query in ["ﾊﾄﾑｷﾞ", "はとむぎ", "ハトムギ"]:
+            with self.subTest(query=query):
+                self.assertEqual(self.names(query), ["ハトムギ乳液"])
+        for query in ["uvみるく", "ＵＶミルク", "Uvミルク"]:
+            with self.subTest(query=query):
+                self.assertEqual(self.names(query), ["UVミルクEX"])
+
+    def test_short_terms_use_the_gram_index(self):
+        cases = {
+            "化粧": ["薬用美白化粧水"],
+            "水": ["薬用美白化粧水"],
+            "ex": ["UVミルクEX"],
+            "x": ["UVミルクEX"],
+            "美白 化粧水": ["薬用美白化粧水"],
+            "る ケア": ["UVミルクEX"],
+            "乳液 化粧": [],
+        }
+        for query, expected in cases.items():
+            with self.subTest(query=query):
+                with CaptureQueriesContext(connection) as queries:
+                    names = self.names(query)
+                self.assertEqual(names, expected)
+                self.assertTrue(any("app_productsearchgram" in q["sql"] for q in queries))
+
+    def test_gram_index_follows_product_changes(self):
+        self.milk.cosme_name = "ハトムギ化粧水"
+        self.milk.save()
+        self.assertEqual(self.names("乳液"), [])
+        self.assertCountEqual(self.names("化粧"), ["ハトムギ化粧水", "薬用美白化粧水"])
+
+        self.lotion.delete()
+        self.assertEqual(self.names("化粧"), ["ハトムギ化粧水"])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "PostgreSQL のみ")
+    def test_postgres_uses_trigram_similarity(self):
+        #3文字以上の語は pg_trgm の類似度で並べ、GIN 索引を使える LIKE で絞り込む
+        self.assertIsInstance(search.get_backend(), search.PostgresTrigramBackend)
+        Product.objects.create(cosme_name="美白美容液", category="skincare", price=1000, image="product_images/d.jpg")
+
+        with CaptureQueriesContext(connection) as queries:
+            names = self.names("美白化")
+        self.assertEqual(names, ["薬用美白化粧水"])
+        self.assertIn("WORD_SIMILARITY", queries[-1]["sql"].upper())
+        self.assertEqual(self.names("美白"), ["美白美容液", "薬用美白化粧水"])
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'app_product'")
+            indexes = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(any("gin_trgm_ops" in index for index in indexes), indexes)
+
+
+@unittest.skipUnless(settings.DATABASES["default"].get("OPTIONS", {}).get("pool"), "POSTGRES_POOL_MAX_SIZE を指定したときのみ")
+class ConnectionPoolTests(TransactionTestCase):
+    #コネクションプールを使うとき、スレッドごとの接続はプールから借りて、閉じるとプールへ返すこと
+
+    def test_threads_share_the_pool(self):
+        pool = connection.pool
+        self.assertEqual(pool.max_size, settings.POSTGRES_POOL_MAX_SIZE)
+        errors = []
+
+        def query():
+            try:
+                Product.objects.count()
+            except Exception as exc:
+                errors.append(repr(exc))
+            finally:
+                connection.close()
+
+        #プールの上限より多いスレッドでも、返された接続を待って使い回す
+        threads = [threading.Thread(target=query) for _ in range(pool.max_size * 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(pool.get_stats()["pool_size"], pool.max_size)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AutocompleteTests(TestCase):
+    #入力補完は商品名・各語の前方一致をキーの昇順で返し、商品の追加・名前の変更・削除で索引を作り直すこと
+
+    def setUp(self):
+        for name in ["薬用 化粧水", "化粧水 しっとり", "化粧下地", "美白 美容液", "ハトムギ乳液"]:
+            self.add(name)
+
+    def add(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Product.objects.create(cosme_name=name, category="skincare", price=1000, image="product_images/a.jpg")
+
+    def names(self, prefix, **kwargs):
+        return [name for _, name in autocomplete.suggest(prefix, **kwargs)]
+
+    def test_prefix_matching_and_order(self):
+        #名前全体の一致と途中の語の一致を、キー（正規化した文字列）の昇順で並べる
+        self.assertEqual(self.names("化粧"), ["化粧下地", "薬用 化粧水", "化粧水 しっとり"])
+        self.assertEqual(self.names("化粧水"), ["薬用 化粧水", "化粧水 しっとり"])
+        self.assertEqual(self.names("しっとり"), ["化粧水 しっとり"])
+        self.assertEqual(self.names("ﾊﾄﾑｷﾞ"), ["ハトムギ乳液"])
+        self.assertEqual(self.names("乳液"), [])
+        self.assertEqual(self.names("  "), [])
+
+    def test_product_is_listed_once(self):
+        #「美白 美容液」は「美白 美容液」「美容液」の両方のキーで一致する
+        self.assertEqual(self.names("美"), ["美白 美容液"])
+
+    def test_result_limit(self):
+        for i in range(autocomplete.AUTOCOMPLETE_LIMIT + 5):
+            self.add(f"テスト{i:02d}")
+
+        expected = [f"テスト{i:02d}" for i in range(autocomplete.AUTOCOMPLETE_LIMIT)]
+        self.assertEqual(self.names("テスト"), expected)
+        self.assertEqual(self.names("テスト", limit=3), expected[:3])
+
+        response = self.client.get(reverse("form_app:product_autocomplete"), {"q": "テスト"})
+        self.assertEqual([row["name"] for row in response.json()["results"]], expected)
+
+    def test_index_is_reused_until_the_catalog_changes(self):
+        autocomplete.suggest("化粧")
+        #シグナルを通らない更新ではバージョンが変わらず、作った索引をそのまま使う
+        Product.objects.filter(cosme_name="化粧下地").update(cosme_name="リキッド下地")
+        with self.assertNumQueries(0):
+            self.assertIn("化粧下地", self.names("化粧"))
+
+    def test_index_follows_product_changes(self):
+        self.assertEqual(self.names("リキッド"), [])
+
+        product = self.add("リキッドファンデ")
+        self.assertEqual(self.names("リキッド"), ["リキッドファンデ"])
+
+        product.cosme_name = "クッションファンデ"
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(self.names("リキッド"), [])
+        self.assertEqual(self.names("クッション"), ["クッションファンデ"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.names("クッション"), [])
+
+
+class KeysetPaginationTests(TestCase):
+    #投稿日時が同じレビューがページの境目にあっても抜け・重複がなく、不正なカーソルは先頭ページになること
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("user", password="password")
+        product = Product.objects.create(cosme_name="商品", category="skincare", price=1000, image="product_images/a.jpg")
+        base = timezone.now().replace(microsecond=0)
+        #7件ずつ同じ投稿日時にして、どのページの境目にも同順位がくるようにする
+        Review.objects.bulk_create([
+            Review(
+                user=cls.user,
+                product=product,
+                rating=5,
+                goodpoint_comment="良い点",
+                badpoint_comment="悪い点",
+                posted_at=base - timedelta(minutes=i // 7),
+            )
+            for i in range(FEED_PAGE_SIZE * 2 + 5)
+        ])
+        cls.expected = list(Review.objects.order_by("-posted_at", "-id").values_list("id", flat=True))
+
+    def test_ties_are_neither_skipped_nor_repeated(self):
+        for page_size in [1, 2, 3, 7, 10]:
+            with self.subTest(page_size=page_size):
+                ids, cursor = [], None
+                while True:
+                    rows, cursor = keyset_page(Review.objects.all(), cursor, page_size=page_size)
+                    ids += [row.pk for row in rows]
+                    if cursor is None:
+                        break
+                self.assertEqual(ids, self.expected)
+
+    def test_feed_follows_next_links_to_the_last_page(self):
+        url = reverse("form_app:review_feed", args=["latest"])
+        ids, query, pages = [], "", 0
+        while True:
+            response = self.client.get(f"{url}?{query}")
+            self.assertEqual(response.status_code, 200)
+            ids += [review.pk for review in response.context["reviews"]]
+            pages += 1
+            query = response.context["next_query"]
+            if not query:
+                break
+        self.assertEqual(ids, self.expected)
+        self.assertEqual(pages, 3)
+        #最後のページには「もっと見る」を出さない
+        self.assertNotContains(response, "js-feed-more")
+
+    def test_malformed_cursor_returns_the_first_page(self):
+        first = self.client.get(reverse("form_app:review_feed", args=["latest"]))
+        first_ids = [review.pk for review in first.context["reviews"]]
+
+        def encode(raw):
+            return base64.urlsafe_b64encode(raw.encode()).decode()
+
+        cursors = [
+            "!!!",
+            "あ",
+            "abc",
+            encode("2024-01-01T00:00:00+00:00"),
+            encode("not a date|1"),
+            encode("2024-01-01T00:00:00+00:00|x"),
+            encode("2024-01-01T00:00:00+00:00|1|2"),
+            encode(f"2024-01-01T00:00:00+00:00|{2 ** 64}"),
+            encode("2024-01-01T00:00:00+00:00|-1"),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse("form_app:review_feed", args=["latest"]), {"cursor": cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([review.pk for review in response.context["reviews"]], first_ids)
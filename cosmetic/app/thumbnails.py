@@ -0,0 +1,178 @@
+import contextlib
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .metrics import inc
+
+#縮小幅はこの段階のみ（任意の幅を受け付けるとキャッシュが際限なく増えるため）
+WIDTH_BUCKETS = (64, 160, 320, 640)
+
+FORMATS = {
+    #URL上の形式: (Pillowの形式, 拡張子, Content-Type)
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+QUALITY = 80
+
+#書き込み量がこの割合を超えたらキャッシュ全体を確認して古いものから削除
+SWEEP_RATIO = 0.1
+PRUNE_TARGET_RATIO = 0.9
+
+
+def cache_dir():
+    return Path(settings.THUMBNAIL_CACHE_DIR)
+
+
+def bucket_for(size):
+    #表示サイズ以上で最小の段階
+    for width in WIDTH_BUCKETS:
+        if width >= size:
+            return width
+    return WIDTH_BUCKETS[-1]
+
+
+def cache_path(name, width, fmt):
+    #元ファイル名はハッシュ化して保存（パス操作を防ぎ、ディレクトリも分散させる）
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    return cache_dir() / fmt / str(width) / digest[:2] / f"{digest}.{FORMATS[fmt][1]}"
+
+
+def render_thumbnail(name, width, fmt):
+    with default_storage.open(name, "rb") as source:
+        image = Image.open(source)
+        #JPEGは縮小しながらデコードして負荷を下げる
+        image.draft("RGB", (width * 2, width * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width), Image.Resampling.LANCZOS)
+
+        if fmt == "jpeg" or image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if fmt == "webp" and "A" in image.getbands() else "RGB")
+
+        path = cache_path(name, width, fmt)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        #書き込み途中のファイルを配信しないよう、一時ファイルから置き換える
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                image.save(out, FORMATS[fmt][0], quality=QUALITY)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    _record_write(path.stat().st_size)
+    return path
+
+
+def open_thumbnail(name, width, fmt):
+    #キャッシュ済みならそれを開いて返し、なければ生成して開く。元画像がなければNone
+    #先に開いておく（開いた後にキャッシュの削除で消えても、開いたファイルは最後まで読める）
+    path = cache_path(name, width, fmt)
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        inc("app_cache_requests_total", cache="thumbnail", result="miss")
+    else:
+        inc("app_cache_requests_total", cache="thumbnail", result="hit")
+        #更新日時を最終利用日時として使う（LRU）
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return file
+
+    try:
+        path = render_thumbnail(name, width, fmt)
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            #生成直後にキャッシュの削除で消えた場合は作り直す
+            return open(render_thumbnail(name, width, fmt), "rb")
+    except (OSError, Image.DecompressionBombError):
+        #OSError は元画像がない・画像でない（UnidentifiedImageError）・途中で切れている場合を含む
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _image_size(name):
+    with default_storage.open(name, "rb") as file:
+        return get_image_dimensions(file)
+
+
+def display_size(name, size):
+    #size 四方の枠に収めたときの幅・高さ。読めない画像は (size, None)
+    #画像名は内容のハッシュで、同じ名前の内容は変わらないため、プロセス内で覚えておく
+    try:
+        width, height = _image_size(name)
+    except (OSError, SuspiciousFileOperation):
+        width = height = None
+    if not width or not height:
+        return size, None
+    scale = size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+_written = 0
+_lock = threading.Lock()
+_pruning = threading.Lock()
+
+
+def _record_write(size):
+    global _written
+    with _lock:
+        _written += size
+        if _written < settings.THUMBNAIL_CACHE_MAX_BYTES * SWEEP_RATIO:
+            return
+        _written = 0
+    #キャッシュ全体の確認はリクエストを待たせないよう別のスレッドで行う（同時に1つだけ）
+    #定期的な削除は prune_thumbnails コマンドでも行える
+    if _pruning.acquire(blocking=False):
+        threading.Thread(target=_prune_in_background, daemon=True).start()
+
+
+def _prune_in_background():
+    try:
+        prune()
+    finally:
+        _pruning.release()
+
+
+def prune(max_bytes=None):
+    #上限を超えていたら、最終利用が古い順に削除する
+    max_bytes = settings.THUMBNAIL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    total = 0
+    for root, _, files in os.walk(cache_dir()):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    target = max_bytes * PRUNE_TARGET_RATIO
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
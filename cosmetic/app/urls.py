@@ -1,20 +1,24 @@
+from django.conf import settings
 from django.urls import path,reverse_lazy
 from django.contrib.auth import views as auth_views
-from . import views
+from . import async_views, views
 from .views import admin_my_page
 from .forms import CustomPasswordChangeForm
 
 app_name = 'form_app'
 
+#ASGI では、読み込みの多いページを非同期版のビューで返す
+read_views = async_views if settings.ASYNC_VIEWS else views
+
 urlpatterns = [
-    path('', views.home, name='home'),
+    path('', read_views.home, name='home'),
     path('login/', views.login_view, name='login'),
     path('register/', views.register, name='register'),
-    path('ranking/', views.ranking, name='ranking_all'),
-    path('ranking/<str:category>/', views.ranking, name='ranking_by_category'),
+    path('ranking/', read_views.ranking, name='ranking_all'),
+    path('ranking/<str:category>/', read_views.ranking, name='ranking_by_category'),
     
     path('favorites/', views.favorite_review_list, name='favorite_review_list'),
-    path('my_page/', views.my_page, name='my_page'),   
+    path('my_page/', read_views.my_page, name='my_page'),   
     path('logout/', views.user_logout, name='logout'),
     path('edit_profile/', views.edit_profile, name='edit_profile'),
     path('password_change/', 
@@ -23,6 +27,7 @@ urlpatterns = [
          ),
 
     path('reviews/', views.review_list, name='review_list'),
+    path('reviews/feed/<str:feed>/', views.review_feed, name='review_feed'),
     #レビュー投稿の入り口
     path('review/entry/', views.review_entry, name='review_entry'),
     #実際のレビュー作成
@@ -40,11 +45,18 @@ urlpatterns = [
     path('admin_my_page/', views.admin_my_page, name='admin_my_page'),
     path('product_create/', views.product_create, name='product_create'),
     path('product/create/success/', views.product_create_success, name='product_create_success'),
+    path('products/import/', views.product_import, name='product_import'),
+    path('products/export/', views.product_export, name='product_export'),
+    path('reviews/export/', views.review_export, name='review_export'),
     path('products/search/', views.product_search, name='product_search'),
+    path('products/autocomplete/', views.product_autocomplete, name='product_autocomplete'),
+    path('thumbnails/<int:width>/<str:fmt>/<path:name>', views.thumbnail, name='thumbnail'),
     path('products/', views.product_list, name='product_list'),
     path('product/<int:pk>/edit/', views.product_edit, name='product_edit'),
     path('product/<int:pk>/delete/', views.product_delete, name='product_delete'),
-    path('product/<int:pk>/', views.product_detail, name='product_detail'),
+    path('product/<int:pk>/', read_views.product_detail, name='product_detail'),
+    path('performance/memory/', views.memory_report, name='memory_report'),
+    path('metrics', views.metrics_view, name='metrics'),
     
     #ポートフォリオ表示用（既存アプリとは独立）
     path('portfolio/', views.portfolio, name='portfolio'),    
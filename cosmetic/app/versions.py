@@ -0,0 +1,35 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+#キャッシュ無効化用のバージョン番号（settings の CACHES で全ワーカープロセスに共有する）
+#更新のたびに新しい値にする。incr はバックエンド（ファイル・DB）によっては読み込みと書き込みが別になり、
+#同時に更新すると片方が失われ、コミット前の内容で作ったキャッシュが新しいバージョンで使われてしまうため
+CATALOG = "catalog" #商品の追加・編集・削除で更新
+REVIEWS = "reviews" #公開済みレビューの投稿・編集・削除で更新
+
+
+def _key(name):
+    return f"version:{name}"
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def get_version(name):
+    version = cache.get(_key(name))
+    if version is None:
+        #未設定・追い出し時は新しい番号から始める（既存のキャッシュは使われなくなる）
+        cache.add(_key(name), _new_version(), None)
+        version = cache.get(_key(name), "")
+    return version
+
+
+def bump_version(name):
+    def bump():
+        cache.set(_key(name), _new_version(), None)
+
+    #コミット前の内容でキャッシュが作られないよう、コミット後に更新
+    transaction.on_commit(bump)
@@ -1,4 +1,6 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.http import JsonResponse, Http404, FileResponse, HttpResponse, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 from django.contrib.auth import login as auth_login, logout
 from django.contrib.auth.decorators import login_required
@@ -7,13 +9,26 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 
 from django.utils import timezone
 from django.views.decorators.http import require_POST
-from django.db.models import Count, Avg, Q, Exists, OuterRef, IntegerField, Value, BooleanField
-from django.db.models.functions import Cast, Round
-from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.utils.http import urlencode
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
+from django.conf import settings
 from functools import wraps
+import hmac
+import os
 
-from .forms import LoginForm, UserForm, CosmeForm, ReviewForm, UserEditForm, ProfileForm, CustomPasswordChangeForm
+from .forms import LoginForm, UserForm, CosmeForm, ReviewForm, UserEditForm, ProfileForm, CustomPasswordChangeForm, ProductImportUploadForm, ReviewExportForm
 from .models import Product, Review, ReviewFavorite, Profile, SKIN_CHOICES, AGE_CHOICES
+from .ranking import ranked_products
+from .search import search_products
+from .autocomplete import suggest
+from .pagination import keyset_page
+from .fragments import cached_fragment, fragment_key, overlay_review_state
+from .versions import CATALOG, REVIEWS
+from .metrics import inc
+from .db import retry_on_lock
+from .routers import replica_reads
+from . import memory, metrics, product_io, review_io, thumbnails
 
 
 def login_view(request):
@@ -45,56 +60,147 @@ def staff_required(view_func):
 
 
 
+def attach_favorite_state(reviews, user):
+    #表示するレビューのうち、ログインユーザーがお気に入り済みのIDを1回のクエリで取得
+    reviews = list(reviews)
+    favorited_ids = set()
+
+    if user.is_authenticated and reviews:
+        favorited_ids = set(
+            ReviewFavorite.objects
+            .filter(user=user, review_id__in=[review.id for review in reviews])
+            .values_list("review_id", flat=True)
+        )
+
+    for review in reviews:
+        review.is_favorited = review.id in favorited_ids
+    return reviews
+
+
+#レビュー一覧（カーソルページング）
+REVIEW_FEEDS = {
+    #feed名: (ログイン必須か, 部分テンプレート)
+    "latest": (False, "form_app/_review_feed_items.html"),
+    "product": (False, "form_app/_review_feed_items.html"),
+    "mine": (True, "form_app/_my_review_items.html"),
+    "favorites": (True, "form_app/_favorite_review_items.html"),
+}
+
+
+def review_feed_page(request, feed, product_id=None):
+    #(表示する行, 次のカーソル)。お気に入り状態はまだ付けない
+    published = Q(is_draft=False, posted_at__isnull=False)
+
+    if feed == "favorites":
+        qs = (
+            ReviewFavorite.objects
+            .filter(user=request.user)
+            .select_related("review", "review__product", "review__user")
+        )
+        return keyset_page(qs, request.GET.get("cursor"), time_field="created_at")
+
+    qs = Review.objects.filter(published).select_related("user", "product")
+    if feed == "product":
+        qs = qs.filter(product_id=product_id)
+    elif feed == "mine":
+        qs = qs.filter(user=request.user)
+    return keyset_page(qs, request.GET.get("cursor"))
+
+
+def build_review_feed(request, feed, product_id=None):
+    items, next_cursor = review_feed_page(request, feed, product_id)
+    if feed != "favorites":
+        items = attach_favorite_state(items, request.user)
+    return review_feed_context(request, feed, items, next_cursor, product_id)
+
+
+def review_feed_context(request, feed, items, next_cursor, product_id=None):
+    try:
+        start = max(int(request.GET.get("start", 0)), 0)
+    except ValueError:
+        start = 0
+
+    next_query = ""
+    if next_cursor:
+        params = {"cursor": next_cursor, "start": start + len(items)}
+        if product_id is not None:
+            params["product"] = product_id
+        next_query = urlencode(params)
+
+    context = {
+        "feed": feed,
+        "feed_template": REVIEW_FEEDS[feed][1],
+        "feed_url": reverse("form_app:review_feed", args=[feed]),
+        "next_query": next_query,
+        "start": start,
+    }
+    if feed == "favorites":
+        context["favorites"] = items
+    else:
+        context["reviews"] = items
+    return context
+
+
+#無限スクロール用の続き（HTML断片）
+def review_feed(request, feed):
+    if feed not in REVIEW_FEEDS:
+        raise Http404
+    if REVIEW_FEEDS[feed][0] and not request.user.is_authenticated:
+        raise PermissionDenied
+
+    product_id = None
+    if feed == "product":
+        try:
+            product_id = int(request.GET.get("product", ""))
+        except ValueError:
+            raise Http404
+
+    return render(
+        request,
+        "form_app/review_feed_fragment.html",
+        build_review_feed(request, feed, product_id))
+
+
+@replica_reads
 def product_detail(request, pk):
     product = get_object_or_404(Product,pk=pk)
     
-    reviews = Review.objects.filter(
-        product=product,
-        is_draft=False
-        )
-    
-    if request.user.is_authenticated:
-        reviews = reviews.annotate(
-            is_favorited=Exists(
-                ReviewFavorite.objects.filter(
-                    review=OuterRef("pk"),
-                    user=request.user)
-                )
-            )
-    else:
-        reviews = reviews.annotate(
-            is_favorited = Value(False, output_field=BooleanField())
-        )
+    context = build_review_feed(request, "product", product.id)
+    context["product"] = product
     
     return render(
         request,
         'form_app/product_detail.html',
-        {'product':product,"reviews":reviews})
+        context)
 
 
-def build_popular_ranking_qs(category=None, skin_type=None, age=None):           
-    filters = Q(reviews__is_draft=False, reviews__posted_at__isnull=False)
+def build_popular_ranking_qs(category=None, skin_type=None, age=None):
+    #集計済みのランキング（ProductRanking）から読み込む
+    return ranked_products(category=category, skin_type=skin_type, age=age)
+
+
+RANKING_PAGE_SIZE = 20
+RANKING_LIMIT = 100 #上位N件まで表示
 
-    if skin_type:
-        filters &= Q(reviews__skin_type=skin_type)
-    if age:
-        filters &= Q(reviews__age=age)
-        
-    qs = Product.objects.all()
-    if category is not None:
-        qs = qs.filter(category=category)
-        
-    return (
-        qs.annotate(#集計
-            review_count=Count("reviews", filter=filters, distinct=True),
-            avg_rating=Avg("reviews__rating", filter=filters),
-        )
-        .filter(review_count__gt=0) #0件商品を除外
-        .order_by("-review_count","-avg_rating")#並び替え
-    )
 
+def paginate_ranking(request, qs, page_size=RANKING_PAGE_SIZE, limit=RANKING_LIMIT):
+    #件数は数えず、1件多く取得して次ページの有無を判定
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
 
-def ranking(request, category=None):   
+    offset = (page - 1) * page_size
+    stop = min(offset + page_size, limit)
+    if offset >= stop:
+        return [], page, False
+
+    rows = list(qs[offset:stop + 1])
+    has_next = len(rows) > stop - offset and stop < limit
+    return rows[:stop - offset], page, has_next
+
+
+def build_ranking_context(request, category=None):
     skin_type = request.GET.get("skin_type")
     age = request.GET.get("age")
     
@@ -105,43 +211,72 @@ def ranking(request, category=None):
     else:
         category_label = f"{CATEGORY_LABEL.get(category, category)}人気"
         
-    products = build_popular_ranking_qs(category=category, skin_type=skin_type, age=age)
+    products, page, has_next = paginate_ranking(
+        request,
+        build_popular_ranking_qs(category=category, skin_type=skin_type, age=age)
+    )
            
-    return render(request,"form_app/ranking.html",{
+    return {
         "products": products,
-        "products_count": products.count(),
+        "page": page,
+        "has_next": has_next,
+        "rank_offset": (page - 1) * RANKING_PAGE_SIZE,
         "category_label": category_label,
         "category": category,
         "skin_type": skin_type,
         "age": age,
         "SKIN_CHOICES": SKIN_CHOICES,
         "AGE_CHOICES": AGE_CHOICES,
-        }
+    }
+
+
+@replica_reads
+def ranking(request, category=None):
+    return render(request, "form_app/ranking.html", build_ranking_context(request, category))
+
+
+def render_home_latest_reviews(request):
+    context = build_review_feed(request, "latest")
+    context["fragment_cache"] = True
+    return {
+        "html": render_to_string("form_app/_home_latest_reviews.html", context, request=request),
+        "review_ids": [review.id for review in context["reviews"]],
+    }
+
+
+#ランキングと新着レビューは描画済みHTMLをキャッシュ（レビュー・商品の更新で無効化）
+def home_ranking_html():
+    return cached_fragment(
+        fragment_key("home_ranking", REVIEWS, CATALOG),
+        lambda: render_to_string(
+            "form_app/_home_ranking.html",
+            {"ranking_products": build_popular_ranking_qs()[:5]},
+        ),
     )
 
 
-def home(request):
-    ranking_products = build_popular_ranking_qs()[:5]
-    
-    reviews = Review.objects.all()
+def home_latest_reviews(request):
+    if request.GET.get("cursor"):
+        #「もっと見る」で遷移した続きのページはキャッシュしない
+        return render_home_latest_reviews(request)
+    return cached_fragment(
+        fragment_key(
+            "home_latest_reviews", REVIEWS, CATALOG,
+            vary_on=[request.user.is_authenticated],
+        ),
+        lambda: render_home_latest_reviews(request),
+    )
 
-    if request.user.is_authenticated:
-        reviews = reviews.annotate(
-            is_favorited=Exists(
-                ReviewFavorite.objects.filter(
-                    review=OuterRef("pk"),
-                    user=request.user)
-                )
-            )
-    else:
-        reviews = reviews.annotate(
-            is_favorited = Value(False, output_field=BooleanField())
-        )
+
+@replica_reads
+def home(request):
+    ranking_html = home_ranking_html()
+    latest = home_latest_reviews(request)
     
     return render(
         request, 'form_app/home.html',
-        {'ranking_products':ranking_products,
-         'reviews':reviews})
+        {'ranking_html': ranking_html,
+         'latest_reviews_html': overlay_review_state(request, latest["html"], latest["review_ids"])})
     
 
 #新規アカウント登録
@@ -170,18 +305,25 @@ def register(request):
         context={'form':form}
         )
 
+@replica_reads
 def category_product_list(request, category):
     #form.pyのchoicesを辞書化
     CATEGORY_LABEL = dict(CosmeForm.CATEGORY_CHOICES)
     category_label = CATEGORY_LABEL.get(category, category)
     
-    products = build_popular_ranking_qs(category=category)
+    products, page, has_next = paginate_ranking(
+        request,
+        build_popular_ranking_qs(category=category)
+    )
     
     return render(
         request,
         "form_app/category_product_list.html",
         {
             "products":products,
+            "page":page,
+            "has_next":has_next,
+            "rank_offset":(page - 1) * RANKING_PAGE_SIZE,
             "category":category,
             "category_label":category_label,
             }
@@ -190,6 +332,7 @@ def category_product_list(request, category):
 
 #レビューお気に入り追加（トグル処理）
 @login_required
+@retry_on_lock
 def review_favorite(request, review_id):
    
     review=get_object_or_404(Review, id=review_id)
@@ -200,20 +343,17 @@ def review_favorite(request, review_id):
     )
     if not created:
         favorite.delete()
+    inc("app_favorite_toggles_total", action="add" if created else "remove")
         
     return redirect(request.META.get("HTTP_REFERER","/"))
 
 #お気に入りタブ
 @login_required(login_url="form_app:login")
 def favorite_review_list(request):
-    favorites = ReviewFavorite.objects.filter(
-        user=request.user
-    ).select_related('review','review__product')
-    
     return render(
         request,
         'form_app/favorite_review_list.html',
-        {'favorites':favorites})
+        build_review_feed(request, "favorites"))
 
 
 @login_required
@@ -221,15 +361,13 @@ def user_logout(request):
     logout(request)
     return redirect(reverse('form_app:login'))
 
+@replica_reads
 def search_result_view(request):
     query = request.GET.get('q')
     products = Product.objects.none()
 
     if query:
-        products = (
-            Product.objects
-            .filter(cosme_name__icontains=query)
-            )
+        products = search_products(query)
     
     return render(request, "form_app/search_result.html",{
         "query": query,
@@ -276,23 +414,75 @@ def product_create_success(request):
     return render(request,'form_app/product_create_success.html')
 
 
+#商品の一括登録（CSV / JSON Lines。画像はZIPでまとめるか、保存済みの画像の名前で指定）
+@staff_required
+def product_import(request):
+    result = None
+    if request.method == 'POST':
+        form = ProductImportUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            file = form.cleaned_data['file']
+            try:
+                with product_io.ImageSource(form.cleaned_data['archive']) as images:
+                    result = product_io.import_products(
+                        product_io.read_rows(file, product_io.product_format(file.name)),
+                        images,
+                    )
+            except UnicodeDecodeError:
+                form.add_error('file', 'UTF-8 で保存したファイルを選択してください。')
+    else:
+        form = ProductImportUploadForm()
+
+    return render(request, 'form_app/product_import.html', {
+        'form': form,
+        'result': result,
+        'max_file_mb': settings.PRODUCT_IMPORT_MAX_FILE_SIZE // (1024 * 1024),
+        'max_archive_mb': settings.PRODUCT_IMPORT_MAX_ARCHIVE_SIZE // (1024 * 1024),
+    })
+
+
+#商品の一括書き出し（?format=csv / jsonl）。全商品を読み込まず、少しずつ返す
+@staff_required
+def product_export(request):
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in product_io.FORMATS.values():
+        raise Http404
+    return export_response(product_io.export_products(fmt), fmt, 'products')
+
+
+def export_response(chunks, fmt, name):
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(chunks, content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{name}.{fmt}"'
+    return response
+
+
+#公開済みレビューの書き出し（運営の分析用）。format を指定すると、投稿日・カテゴリーで絞り込んで少しずつ返す
+@staff_required
+def review_export(request):
+    if 'format' not in request.GET:
+        return render(request, 'form_app/review_export.html', {'form': ReviewExportForm()})
+
+    form = ReviewExportForm(request.GET)
+    if not form.is_valid():
+        return render(request, 'form_app/review_export.html', {'form': form})
+
+    data = form.cleaned_data
+    chunks = review_io.export_reviews(
+        data['format'], data['date_from'], data['date_to'], data['category'],
+    )
+    return export_response(chunks, data['format'], 'reviews')
+
+
 #商品検索
+@replica_reads
 def product_search(request):
     query = request.GET.get("q","")
     products = Product.objects.none()
     
     if query:
-        published = Q(reviews__is_draft=False, reviews__posted_at__isnull=False)
-        
-        products = (
-            Product.objects
-            .filter(cosme_name__icontains=query)
-            .annotate(
-                avg_rating=Avg('reviews__rating', filter=published),
-                avg_rating_int=Cast(Round(Avg('reviews__rating', filter=published)),IntegerField()),
-                review_count=Count('reviews', filter=published, distinct=True),
-                )
-            )
+        #件数・平均評価は Product の集計列を使う（Review は結合しない）
+        products = search_products(query)
         
     
     mode = request.GET.get("mode","normal")
@@ -308,7 +498,45 @@ def product_search(request):
     })
 
 
+#検索窓の入力補完（DBを使わずワーカー内の前方一致索引から返す）
+def product_autocomplete(request):
+    query = request.GET.get("q", "")
+
+    return JsonResponse({
+        "results": [
+            {
+                "id": product_id,
+                "name": name,
+                "url": reverse("form_app:product_detail", args=[product_id]),
+            }
+            for product_id, name in suggest(query)
+        ]
+    })
+
+
+THUMBNAIL_MAX_AGE = 60 * 60 * 24 * 30
+
+
+def thumbnail(request, width, fmt, name):
+    #一覧用の縮小画像。生成済みならディスクキャッシュから返す
+    if width not in thumbnails.WIDTH_BUCKETS or fmt not in thumbnails.FORMATS:
+        raise Http404
+
+    try:
+        file = thumbnails.open_thumbnail(name, width, fmt)
+    except SuspiciousFileOperation:
+        file = None
+    if file is None:
+        raise Http404
+
+    response = FileResponse(file, content_type=thumbnails.FORMATS[fmt][2])
+    #アップロード時に既存ファイルは上書きされない（同名なら別名になる）ため、長期間キャッシュさせてよい
+    response["Cache-Control"] = f"public, max-age={THUMBNAIL_MAX_AGE}, immutable"
+    return response
+
+
 @login_required
+@retry_on_lock
 def review_create(request, product_id):
     product = get_object_or_404(Product, id=product_id)
     
@@ -405,8 +633,10 @@ def review_create(request, product_id):
     
 #レビュー確定後の処理
 @login_required
+@require_POST
+@retry_on_lock
 def review_submit(request,pk):
-    review = Review.objects.get(pk=pk, user=request.user)
+    review = get_object_or_404(Review, pk=pk, user=request.user)
     
     review.is_draft = False
     review.posted_at=timezone.now() #投稿した日時
@@ -430,6 +660,7 @@ def review_draft_list(request):
     
 #下書きを編集画面に復元
 @login_required
+@retry_on_lock
 def review_draft_edit(request, pk):
     review = get_object_or_404(
         Review, pk=pk, user=request.user,
@@ -440,8 +671,7 @@ def review_draft_edit(request, pk):
         
         # ★ まずクリア処理
         if request.POST.get("image-clear") == "on":
-            if review.image:
-                review.image.delete(save=False)  # ファイル削除
+            #ファイルは保存後に削除される（他のレビュー・商品が同じ画像を参照していなければ）
             review.image = None                  # DB参照を空に
         
         #下書き保存はバリエーション通さず
@@ -475,6 +705,7 @@ def review_draft_edit(request, pk):
 
 #一時保存の削除
 @login_required
+@retry_on_lock
 def review_draft_delete(request, pk):
     draft = get_object_or_404(
         Review, pk=pk, user=request.user,
@@ -487,6 +718,7 @@ def review_draft_delete(request, pk):
     return redirect("form_app:review_draft_list")
 
 @login_required
+@retry_on_lock
 def review_edit(request, review_id):
     review=get_object_or_404(
         Review,
@@ -572,6 +804,7 @@ def review_success(request):
 
 #レビュー削除ボタン
 @login_required
+@retry_on_lock
 def review_delete(request, pk):
     if request.user.is_staff:
         review=get_object_or_404(Review, pk=pk)
@@ -622,17 +855,9 @@ def review_entry(request):
 #マイページから遷移できるレビュー一覧
 @login_required
 def review_list(request):
-    reviews = (Review.objects
-               .filter(user=request.user,
-                       is_draft=False,
-                       posted_at__isnull=False
-                    )
-               .select_related("product","user")
-               .order_by("-posted_at")
-               )
     return render(request, 
                   'form_app/review_list.html',
-                  {'reviews':reviews})
+                  build_review_feed(request, "mine"))
 
 
 #商品編集,商品更新
@@ -673,6 +898,32 @@ def product_list(request):
         {'products':products})
     
 
+#ビューごとのメモリ使用量（MEMORY_PROFILING が有効なときに集計）
+@staff_required
+def memory_report(request):
+    return render(request, 'form_app/memory_report.html', {
+        'enabled': settings.MEMORY_PROFILING,
+        'pid': os.getpid(),
+        'views': memory.report(),
+    })
+
+
+#Prometheus からの収集用（METRICS_TOKEN を「Authorization: Bearer」で送ったリクエスト以外は404）
+def metrics_allowed(request):
+    token = settings.METRICS_TOKEN
+    if token:
+        scheme, _, value = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(value.strip().encode(), token.encode()):
+            return True
+    return request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        raise Http404
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 def portfolio(request):
 #ポートフォリオ表示用（既存アプリとは独立）
     return render(request, "portfolio/index.html")
\ No newline at end of file
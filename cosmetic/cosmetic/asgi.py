@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cosmetic.settings')
+#読み込みの多いページは、クエリを同時に実行する非同期版のビューを使う（ASYNC_VIEWS=0 で無効）
+#起動例: uvicorn cosmetic.asgi:application --workers 4
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
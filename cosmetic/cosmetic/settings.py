@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+
+from django.core.exceptions import ImproperlyConfigured
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -44,11 +46,19 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    #処理時間の計測（他のミドルウェアの時間も含めるため先頭に置く）
+    'app.instrumentation.RequestTimingMiddleware',
+    #ビューごとのメモリ使用量（MEMORY_PROFILING = True のときだけ有効）
+    'app.memory.MemoryProfilingMiddleware',
+    #読み込みのレプリカへの振り分け（セッションの保存など、他のミドルウェアの書き込みも検知するため外側に置く）
+    'app.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    #スタッフ向けのプロファイラー（ユーザーを参照するため認証より後に置く）
+    'app.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -65,7 +75,8 @@ ROOT_URLCONF = 'cosmetic.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        #描画時間を計測するため、DjangoTemplates を拡張したものを使う
+        'BACKEND': 'app.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -80,16 +91,128 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'cosmetic.wsgi.application'
 
+#これ以上かかったリクエスト・クエリをログ（app.performance）に出力する（ミリ秒）
+SLOW_REQUEST_MS = 500
+SLOW_QUERY_MS = 100
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json_line': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'performance': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json_line',
+        },
+    },
+    'loggers': {
+        'app.performance': {
+            'handlers': ['performance'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
+#テスト中は app.performance のログを出力しない
+TEST_RUNNER = 'app.test_runner.TestRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#使用するDBは環境変数 DATABASE_ENGINE で選ぶ（sqlite / postgresql、未指定なら sqlite）
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+    #接続先は公式のDockerイメージと同じ名前の環境変数から
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'cosmetic'),
+            'USER': os.environ.get('POSTGRES_USER', 'cosmetic'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            #使い回す接続が切れていないか、リクエストの最初に確認する
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', '0'))
+    if POSTGRES_POOL_MAX_SIZE:
+        #psycopg のコネクションプール（ワーカー内のスレッドで共有。プールを使うときは CONN_MAX_AGE = 0）
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', '2')),
+            'max_size': POSTGRES_POOL_MAX_SIZE,
+            'timeout': 10,
+        }
+    else:
+        #リクエストをまたいで接続を使い回す秒数
+        DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('POSTGRES_CONN_MAX_AGE', '60'))
+    #トライグラム検索（pg_trgm）の関数・索引
+    INSTALLED_APPS.append('django.contrib.postgres')
+
+elif DATABASE_ENGINE == 'sqlite':
+    #SQLite の接続ごとの設定
+    #WAL: 読み込みと書き込みを同時に行える / synchronous=NORMAL: WAL ではコミットごとの fsync を省いても壊れない
+    #cache_size（負の値はKiB）・mmap_size で読み込みをメモリ上で済ませ、busy_timeout の間は書き込みロックを待つ
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
     }
-}
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+                #トランザクションの開始時に書き込みロックを取る（途中でロックを取りに行くと待たずに失敗するため）
+                'transaction_mode': 'IMMEDIATE',
+            },
+            #テストもファイルのDBで行う（メモリ上のDBでは WAL・ロック待ちが再現されない）
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
+        }
+    }
+
+else:
+    raise ImproperlyConfigured(f"DATABASE_ENGINE は sqlite か postgresql を指定してください: {DATABASE_ENGINE}")
+
+#読み込み専用のレプリカ。環境変数 DATABASE_REPLICAS にカンマ区切りで指定する
+#（PostgreSQL はホスト名、SQLite はファイルのパス。SQLite はプライマリのファイルを複製したもので動作確認できる）
+for i, source in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), 1):
+    replica = {
+        **DATABASES['default'],
+        'OPTIONS': dict(DATABASES['default'].get('OPTIONS', {})),
+        #テストではプライマリと同じDBを使う
+        'TEST': {'MIRROR': 'default'},
+    }
+    #レプリカは読み込みだけなので、トランザクションの開始時に書き込みロックを取らない
+    replica['OPTIONS'].pop('transaction_mode', None)
+    replica['HOST' if DATABASE_ENGINE == 'postgresql' else 'NAME'] = source.strip()
+    DATABASES[f'replica{i}'] = replica
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+#書き込み後、プライマリから読み続ける秒数（レプリカの遅延より長くする）
+REPLICA_STICKY_SECONDS = 10
+
+#トップ・ランキング・商品詳細・マイページを非同期版のビューで返す（asgi.py で有効にする）
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
+
+#書き込みロックが取れなかったときのやり直し回数・最初の待ち時間（秒、回ごとに倍）
+DB_LOCK_RETRIES = 3
+DB_LOCK_RETRY_DELAY = 0.05
 
 
 # Password validation
@@ -139,6 +262,74 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+#行の削除・画像の差し替えで使われなくなった画像でも、保存（同じ内容の再利用を含む）からこの秒数の間は削除しない
+#（同じ画像を保存中の別のリクエストが、まだ行をコミットしていない場合があるため。一括登録の1バッチより長くする）
+MEDIA_DELETE_MIN_AGE = 15 * 60
+
+#未参照の画像を削除せずに移す場所（collect_orphaned_media --quarantine）
+MEDIA_QUARANTINE_ROOT = BASE_DIR / 'media_quarantine'
+
+#画像は内容のハッシュ名で階層ディレクトリに保存（同じ画像は1ファイルを共有）
+STORAGES = {
+    "default": {
+        "BACKEND": "app.storage.ContentAddressedStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
+#キャッシュ（表示の断片・キャッシュ無効化用のバージョン番号・プロファイラーの実行間隔）は全ワーカープロセスで共有する
+#REDIS_URL を指定すると Redis（redis パッケージが必要）、未指定なら同じサーバー上のプロセスで共有するファイルのキャッシュ
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'django_cache',
+            #上限を超えると一部を消す（バージョン番号が消えても、新しい番号になりキャッシュが使われなくなるだけ）
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+
+#画面からの商品の一括登録の上限（リクエストの中で登録するため。大きなファイルは manage.py import_products で登録する）
+PRODUCT_IMPORT_MAX_FILE_SIZE = 1024 * 1024 #約1万行
+PRODUCT_IMPORT_MAX_ARCHIVE_SIZE = 50 * 1024 * 1024
+
+#一覧表示用の縮小画像（オンデマンド生成）のキャッシュ
+THUMBNAIL_CACHE_DIR = BASE_DIR / 'thumbnail_cache'
+THUMBNAIL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+#/metrics（Prometheus 形式）。複数のワーカープロセスで動かすときは METRICS_DIR に共有のディレクトリを指定する
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 10
+#/metrics の認証。Prometheus から「Authorization: Bearer <METRICS_TOKEN>」を送る（未設定なら誰にも返さない）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+#トークンなしで許可する接続元（REMOTE_ADDR）。アプリへ直接つなぐ構成の場合のみ使う
+#リバースプロキシ（nginx → gunicorn など）の後ろでは全リクエストの接続元がプロキシになり、外部に公開されてしまうため指定しないこと
+METRICS_ALLOWED_IPS = []
+
+#スタッフ向けプロファイラーの結果の保存先・サンプリング間隔（ミリ秒）・実行間隔の下限（秒、サイト全体）
+PROFILING_DIR = BASE_DIR / 'profiles'
+PROFILING_INTERVAL_MS = 5
+PROFILING_MIN_INTERVAL = 60
+
+#tracemalloc によるビューごとのメモリ計測。有効にすると全体が遅くなるため調査時のみ True にする
+#FRAMES は記録する呼び出し履歴の深さ、SAMPLE_EVERY 件に1件は割り当て箇所まで調べる（そのリクエストは1秒程度遅くなる）
+MEMORY_PROFILING = False
+MEMORY_PROFILING_FRAMES = 25
+MEMORY_PROFILING_SAMPLE_EVERY = 100
+
+#アップロード画像の後処理（回転補正・EXIF除去・再圧縮）を行うプロセス数。0ならコミット直後に同じプロセスで処理
+IMAGE_PROCESSING_WORKERS = 2
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field